@@ -0,0 +1,158 @@
+import logging
+import re
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+# التشكيل وعلامات القرآن والتطويل تحذف، وأشكال الألف توحد
+_DIACRITICS = [*range(0x0610, 0x061B), *range(0x064B, 0x0660), 0x0670, *range(0x06D6, 0x06EE)]
+_TRANSLATION = {code: None for code in _DIACRITICS}
+_TRANSLATION.update({
+    0x0640: None,                                   # ـ التطويل
+    ord('أ'): 'ا', ord('إ'): 'ا', ord('آ'): 'ا', ord('ٱ'): 'ا',
+    ord('ى'): 'ي',
+    ord('؟'): ' ', ord('،'): ' ', ord('؛'): ' '
+})
+_PUNCTUATION = re.compile(r'[^\w\s]+')
+
+
+def normalize_question(text):
+    """مفتاح السؤال: بلا تشكيل أو تطويل، ألف موحدة، بلا ترقيم، ومسافات مفردة"""
+    if not text:
+        return ''
+    text = str(text).translate(_TRANSLATION).casefold()
+    return ' '.join(_PUNCTUATION.sub(' ', text).split())
+
+
+class AnswerCache:
+    """ذاكرة إجابات Fasl AI حسب نص السؤال الموحد - حجم محدود مع إخراج LRU ومدة صلاحية"""
+
+    def __init__(self, maxsize=5000, ttl=24 * 3600, min_length=10, shared=None, clock=time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        # الأسئلة القصيرة جداً (مثل "مرحبا") لا تخزن لأن إجابتها تعتمد على السياق
+        self.min_length = min_length
+        self._clock = clock
+        # المفتاح -> (الإجابة، وقت الانتهاء)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # مخزن مشترك اختياري بين العمال (يوفر add_cache_invalidation / cache_invalidations)
+        # حتى يصل الحذف اليدوي لذاكرة كل عامل؛ نبدأ من آخر سجل لأن الذاكرة فارغة عند الإقلاع
+        self.shared = shared
+        self._seq = 0
+        self._sync()
+
+    def _sync(self):
+        """تطبيق عمليات الحذف التي سجلها العمال الآخرون منذ آخر فحص"""
+        if self.shared is None:
+            return
+        try:
+            rows = self.shared.cache_invalidations(self._seq)
+        except Exception as e:
+            # عند تعذر الوصول للمخزن المشترك نكتفي بالذاكرة المحلية
+            logger.error(f"❌ خطأ في قراءة حذف ذاكرة الإجابات المشترك: {e}")
+            return
+        if not rows:
+            return
+        with self._lock:
+            # سجلات محذوفة من المخزن قبل قراءتها: لا نعرف ما فاتنا فنمسح الكل
+            if self._seq and rows[0][0] > self._seq + 1:
+                self._entries.clear()
+            for seq, fragment in rows:
+                if seq <= self._seq:
+                    continue
+                if fragment:
+                    self._invalidate_locked(fragment)
+                else:
+                    self._entries.clear()
+                self._seq = seq
+
+    def _share(self, fragment):
+        if self.shared is None:
+            return
+        try:
+            self.shared.add_cache_invalidation(fragment)
+        except Exception as e:
+            logger.error(f"❌ خطأ في تسجيل حذف ذاكرة الإجابات المشترك: {e}")
+
+    def key_for(self, question):
+        key = normalize_question(question)
+        return key if len(key) >= self.min_length else None
+
+    def get(self, question):
+        """الإجابة المخزنة للسؤال أو None"""
+        key = self.key_for(question)
+        if key is None:
+            return None
+        if self._entries:
+            self._sync()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[1] <= self._clock():
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, question, answer):
+        """تخزين إجابة - يعيد False إذا كان السؤال قصيراً جداً أو الإجابة فارغة"""
+        key = self.key_for(question)
+        if key is None or not answer:
+            return False
+        # تطبيق الحذف المعلق أولاً حتى لا يمسح لاحقاً إجابة أحدث منه
+        self._sync()
+        with self._lock:
+            self._entries[key] = (answer, self._clock() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+        return True
+
+    def invalidate(self, question):
+        """حذف إجابة السؤال، أو كل الأسئلة التي تحتوي النص إذا لم يطابق سؤالاً بعينه - يعيد عدد المحذوف"""
+        fragment = normalize_question(question)
+        if not fragment:
+            return 0
+        with self._lock:
+            count = self._invalidate_locked(fragment)
+        self._share(fragment)
+        return count
+
+    def _invalidate_locked(self, fragment):
+        if self._entries.pop(fragment, None) is not None:
+            return 1
+        keys = [key for key in self._entries if fragment in key]
+        for key in keys:
+            del self._entries[key]
+        return len(keys)
+
+    def clear(self):
+        with self._lock:
+            count = len(self._entries)
+            self._entries.clear()
+        self._share('')
+        return count
+
+    def stats(self):
+        with self._lock:
+            entries = len(self._entries)
+            size = sum(sys.getsizeof(key) + sys.getsizeof(answer) for key, (answer, _) in self._entries.items())
+        lookups = self.hits + self.misses
+        return {
+            'entries': entries,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': round(self.hits / lookups, 3) if lookups else 0,
+            'evictions': self.evictions,
+            'approx_memory_kb': round(size / 1024, 1)
+        }
@@ -0,0 +1,271 @@
+import html
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# حالات الطلب داخل القائمة
+PENDING = None
+APPROVED = 'approved'
+REJECTED = 'rejected'
+RESOLVED = 'resolved'
+EXPIRED = 'expired'
+
+_STATUS_ICONS = {
+    PENDING: '⏳',
+    APPROVED: '✅',
+    REJECTED: '❌',
+    RESOLVED: 'ℹ️',
+    EXPIRED: '⌛'
+}
+
+# بادئة بيانات أزرار القائمة: digest:<الإجراء>:<رقم القائمة>:<المستخدم أو الصفحة>
+CALLBACK_PREFIX = 'digest:'
+
+
+class _DigestEntry:
+    __slots__ = ('user_id', 'user_name', 'chat_id', 'status')
+
+    def __init__(self, user_id, user_name, chat_id, status=PENDING):
+        self.user_id = user_id
+        self.user_name = user_name
+        self.chat_id = chat_id
+        self.status = status
+
+
+class Digest:
+    """لقطة من قائمة طلبات انضمام منشورة في رسالة واحدة لدى المدير ومقسمة إلى صفحات
+
+    القائمة نفسها محفوظة في مخزن الحالة - اللقطة للعرض فقط ولا تعدل."""
+
+    def __init__(self, digest_id, entries, page_size, page=0, message_id=None):
+        self.digest_id = digest_id
+        self.entries = entries
+        self.page_size = page_size
+        self.page = page
+        self.message_id = message_id
+
+    @classmethod
+    def from_record(cls, record):
+        entries = [_DigestEntry(*entry) for entry in record['entries']]
+        return cls(record['digest_id'], entries, record['page_size'], record['page'], record['message_id'])
+
+    @property
+    def pages(self):
+        return max(1, (len(self.entries) + self.page_size - 1) // self.page_size)
+
+    def page_entries(self, page):
+        start = page * self.page_size
+        return self.entries[start:start + self.page_size]
+
+    def pending_on_page(self, page):
+        return [entry.user_id for entry in self.page_entries(page) if entry.status is PENDING]
+
+    def pending(self):
+        return [entry for entry in self.entries if entry.status is PENDING]
+
+    def _callback(self, action, arg):
+        return f"{CALLBACK_PREFIX}{action}:{self.digest_id}:{arg}"
+
+    def render(self):
+        """نص الصفحة الحالية وأزرارها"""
+        page = min(self.page, self.pages - 1)
+        lines = [
+            f"📋 طلبات انضمام جديدة ({len(self.entries)}) - الصفحة {page + 1}/{self.pages}",
+            f"⏳ بانتظار القرار: {len(self.pending())}",
+            ""
+        ]
+        keyboard = []
+        start = page * self.page_size
+        for number, entry in enumerate(self.page_entries(page), start + 1):
+            name = html.escape(entry.user_name or '-')
+            lines.append(f"{number}. {_STATUS_ICONS[entry.status]} {name} - <code>{entry.user_id}</code>")
+            if entry.status is PENDING:
+                keyboard.append([
+                    {'text': f"✅ {number}", 'callback_data': self._callback('approve', entry.user_id)},
+                    {'text': f"❌ {number}", 'callback_data': self._callback('reject', entry.user_id)}
+                ])
+        if any(entry.status is PENDING for entry in self.page_entries(page)):
+            keyboard.append([
+                {'text': '✅ قبول الكل في الصفحة', 'callback_data': self._callback('approve_page', page)},
+                {'text': '❌ رفض الكل في الصفحة', 'callback_data': self._callback('reject_page', page)}
+            ])
+        if self.pages > 1:
+            keyboard.append([
+                {'text': '◀️', 'callback_data': self._callback('page', max(0, page - 1))},
+                {'text': f"{page + 1}/{self.pages}", 'callback_data': self._callback('page', page)},
+                {'text': '▶️', 'callback_data': self._callback('page', min(self.pages - 1, page + 1))}
+            ])
+        return '\n'.join(lines), {'inline_keyboard': keyboard}
+
+
+def parse_callback(data):
+    """تحليل بيانات زر القائمة - يعيد (الإجراء، رقم القائمة، المعامل) أو None"""
+    if not data or not data.startswith(CALLBACK_PREFIX):
+        return None
+    try:
+        action, digest_id, arg = data[len(CALLBACK_PREFIX):].split(':')
+        return action, int(digest_id), int(arg)
+    except ValueError:
+        return None
+
+
+class ApprovalDigest:
+    """تجميع طلبات الانضمام خلال نافذة زمنية ونشرها كقائمة واحدة بدل رسالة لكل مستخدم
+
+    القوائم المنشورة تحفظ في مخزن الحالة فيخدم أزرارها أي عامل حتى بعد إعادة التشغيل."""
+
+    def __init__(self, on_publish, store, window=30.0, page_size=10, max_entries=500, keep=20,
+                 clock=time.monotonic):
+        # on_publish(digest) - تستدعى من خيط التجميع عند انتهاء النافذة
+        self.on_publish = on_publish
+        self.store = store
+        self.window = window
+        self.page_size = page_size
+        self.max_entries = max_entries
+        # عدد القوائم المنشورة المحتفظ بها (الأقدم تفقد أزرارها الجماعية)
+        self.keep = keep
+        self._clock = clock
+        self._cond = threading.Condition()
+        self._collecting = []
+        self._deadline = None
+        # القوائم التي تغيرت في هذا العامل ولم تعدل رسالتها بعد
+        self._dirty = set()
+        self._thread = None
+        self.requests = 0
+        self.published = 0
+        self.requeued = 0
+
+    def add(self, user_id, user_name, chat_id):
+        """إضافة طلب إلى القائمة الحالية - النافذة تبدأ مع أول طلب"""
+        publish_now = None
+        with self._cond:
+            self._collecting.append(_DigestEntry(int(user_id), user_name, chat_id))
+            self.requests += 1
+            if len(self._collecting) >= self.max_entries:
+                publish_now = self._close_locked()
+            else:
+                self._start_window_locked()
+        if publish_now is not None:
+            self._publish(publish_now)
+
+    def _start_window_locked(self):
+        if self._deadline is not None:
+            return
+        self._deadline = self._clock() + self.window
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='approval-digest', daemon=True)
+            self._thread.start()
+        self._cond.notify()
+
+    def _close_locked(self):
+        entries, self._collecting = self._collecting, []
+        self._deadline = None
+        return entries
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if self._deadline is None:
+                    self._cond.wait()
+                    continue
+                remaining = self._deadline - self._clock()
+                if remaining > 0:
+                    self._cond.wait(remaining)
+                    continue
+                entries = self._close_locked()
+            self._publish(entries)
+
+    def _publish(self, entries):
+        try:
+            digest_id = self.store.create_digest(
+                [(entry.user_id, entry.user_name, entry.chat_id) for entry in entries], self.page_size, self.keep
+            )
+        except Exception as e:
+            logger.error(f"❌ خطأ في حفظ قائمة طلبات الانضمام: {e}")
+            self._restore(entries)
+            return
+        self.published += 1
+        digest = Digest(digest_id, entries, self.page_size)
+        try:
+            self.on_publish(digest)
+        except Exception as e:
+            logger.error(f"❌ خطأ في نشر قائمة طلبات الانضمام {digest_id}: {e}")
+            self.requeue(digest)
+
+    def _restore(self, entries):
+        """إعادة طلبات إلى بداية القائمة الحالية وبدء نافذة جديدة"""
+        if not entries:
+            return
+        with self._cond:
+            self._collecting[:0] = entries
+            self.requeued += len(entries)
+            self._start_window_locked()
+
+    def flush(self):
+        """نشر الطلبات المجمعة فوراً"""
+        with self._cond:
+            entries = self._close_locked() if self._collecting else None
+        if entries:
+            self._publish(entries)
+
+    def requeue(self, digest):
+        """قائمة لم تصل للمدير: حذفها وإعادة طلباتها المعلقة إلى القائمة التالية - يعيد عددها"""
+        record = self.store.load_digest(digest.digest_id)
+        if record is not None:
+            digest = Digest.from_record(record)
+        self.store.delete_digest(digest.digest_id)
+        with self._cond:
+            self._dirty.discard(digest.digest_id)
+        entries = [_DigestEntry(entry.user_id, entry.user_name, entry.chat_id) for entry in digest.pending()]
+        self._restore(entries)
+        return len(entries)
+
+    def get(self, digest_id):
+        """لقطة القائمة من المخزن أو None إذا حذفت"""
+        record = self.store.load_digest(digest_id)
+        return Digest.from_record(record) if record is not None else None
+
+    def set_page(self, digest_id, page):
+        """تغيير الصفحة المعروضة - يعيد True إذا تحتاج الرسالة تعديلاً"""
+        digest = self.get(digest_id)
+        if digest is None:
+            return False
+        page = min(max(0, page), digest.pages - 1)
+        if not self.store.update_digest(digest_id, page=page):
+            return False
+        self.mark_dirty(digest_id)
+        return True
+
+    def set_message_id(self, digest_id, message_id):
+        self.store.update_digest(digest_id, message_id=message_id)
+
+    def mark(self, user_id, status):
+        """تحديث حالة المستخدم في كل قائمة تعرضه - يعيد أرقام القوائم التي تحتاج تعديلاً"""
+        digest_ids = self.store.mark_digest_entries(user_id, status)
+        with self._cond:
+            self._dirty.update(digest_ids)
+        return digest_ids
+
+    def mark_dirty(self, digest_id):
+        with self._cond:
+            self._dirty.add(digest_id)
+
+    def take_dirty(self, digest_id):
+        """هل تحتاج الرسالة تعديلاً؟ (يمسح العلامة حتى يجمع تعديل واحد عدة قرارات متتالية)"""
+        with self._cond:
+            if digest_id not in self._dirty:
+                return False
+            self._dirty.discard(digest_id)
+            return True
+
+    def stats(self):
+        with self._cond:
+            return {
+                'collecting': len(self._collecting),
+                'dirty_digests': len(self._dirty),
+                'requests': self.requests,
+                'published': self.published,
+                'requeued': self.requeued
+            }
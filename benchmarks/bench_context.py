@@ -0,0 +1,72 @@
+"""قياس ذاكرة سياق المحادثة (بايت لكل مستخدم) وحجم السياق المضاف لكل طلب إلى Fasl AI
+
+التشغيل: python benchmarks/bench_context.py [عدد المستخدمين] [رسائل لكل مستخدم]
+"""
+import gc
+import json
+import os
+import random
+import sys
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from conversation_context import ConversationContext, USER, ASSISTANT  # noqa: E402
+
+QUESTIONS = [
+    "ما هي مدة الإشعار المطلوبة لإنهاء عقد العمل؟",
+    "هل يحق للمؤجر رفع الإيجار قبل انتهاء العقد",
+    "What documents do I need to register a company?",
+    "كيف أرفع دعوى في المحكمة العمالية وما الرسوم",
+    "متى تسقط دعوى المطالبة بالدين بالتقادم؟"
+]
+ANSWER = "وفقاً لنظام العمل، يجب أن يكون الإشعار كتابياً قبل ستين يوماً على الأقل إذا كان الأجر شهرياً. " * 3
+
+
+def make_messages(count, per_user):
+    """المحادثات كبايتات تفك داخل القياس حتى ينشئ السياق نصوصه كما يحدث مع JSON كل طلب"""
+    rng = random.Random(42)
+    messages = []
+    for turn in range(per_user):
+        for user_id in range(count):
+            question = f"{rng.choice(QUESTIONS)} {turn}".encode()
+            messages.append((100000000 + user_id, question, ANSWER.encode()))
+    return messages
+
+
+def build(messages, max_users):
+    context = ConversationContext(max_users=max_users)
+    for user_id, question, answer in messages:
+        context.add(user_id, USER, question.decode())
+        context.add(user_id, ASSISTANT, answer.decode())
+    return context
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    per_user = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    messages = make_messages(count, per_user)
+
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    context = build(messages, count)
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+
+    sizes = [len(json.dumps(context.snapshot(user_id), ensure_ascii=False).encode('utf-8'))
+             for user_id in range(100000000, 100000000 + count)]
+    stats = context.stats()
+
+    print(f"المستخدمون: {count}  (رسائل لكل مستخدم: {per_user * 2}، المحفوظ: {stats['turns'] / count:.1f})")
+    print(f"الذاكرة المقاسة:  {used / count:8.1f} بايت/مستخدم  ({used / 1024 / 1024:.1f} MB)")
+    print(f"تقدير /health:    {stats['bytes_per_user']:8.1f} بايت/مستخدم")
+    print(f"حجم السياق في الطلب: متوسط {sum(sizes) / len(sizes):.0f} بايت، أقصى {max(sizes)} بايت")
+
+    # تجاوز حد المستخدمين: الأقدم استخداماً يخرج
+    overflow = build(messages, count // 2)
+    print(f"مع حد {count // 2} مستخدم: {overflow.stats()['users']} محفوظ، {overflow.evictions} إخراج")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+"""محاكاة حدود الإرسال بالساعة الوهمية: موجة انضمام مع استفسارات وبث دون أي اتصال فعلي
+
+التشغيل: python benchmarks/bench_rate_limiter.py [عدد المنضمين] [عدد المستفسرين] [رسائل البث]
+
+تتحقق من أن الجدولة لا تتجاوز الحد العام ولا حد كل دردشة، وتطبع زمن الانتظار لكل أولوية.
+"""
+import os
+import sys
+from collections import defaultdict
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from rate_limiter import (OutboundScheduler, SimulatedClock, PRIORITY_APPROVAL,  # noqa: E402
+                          PRIORITY_ACK, PRIORITY_BULK)
+
+MANAGER_CHAT_ID = 999
+PRIORITY_NAMES = {PRIORITY_APPROVAL: 'موافقات المدير', PRIORITY_ACK: 'إشعارات المستخدمين', PRIORITY_BULK: 'البث'}
+
+
+def make_sends(joins, questions, bulk):
+    """موجة خلال ثانيتين: لكل منضم طلب للمدير وإشعار له، ولكل مستفسر إشعار استلام، ثم بث"""
+    sends = []
+    for index in range(joins):
+        at = 2.0 * index / max(1, joins)
+        sends.append((at, MANAGER_CHAT_ID, PRIORITY_APPROVAL))
+        sends.append((at, 100000 + index, PRIORITY_ACK))
+    for index in range(questions):
+        at = 2.0 * index / max(1, questions)
+        # المستفسر يرسل رسالتين متتاليتين فيصله إشعاران
+        sends.append((at, 200000 + index, PRIORITY_ACK))
+        sends.append((at + 0.1, 200000 + index, PRIORITY_ACK))
+    for index in range(bulk):
+        sends.append((0.0, 300000 + index, PRIORITY_BULK))
+    return sends
+
+
+def max_in_window(times, window):
+    """أكبر عدد رسائل داخل أي نافذة زمنية بطول window"""
+    times = sorted(times)
+    best = start = 0
+    for end, moment in enumerate(times):
+        while moment - times[start] >= window - 1e-9:
+            start += 1
+        best = max(best, end - start + 1)
+    return best
+
+
+def percentile(values, ratio):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(ratio * len(values)))]
+
+
+def main():
+    joins = int(sys.argv[1]) if len(sys.argv) > 1 else 30
+    questions = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    bulk = int(sys.argv[3]) if len(sys.argv) > 3 else 1000
+
+    scheduler = OutboundScheduler(clock=SimulatedClock())
+    results = scheduler.simulate(make_sends(joins, questions, bulk))
+
+    sent_times = [result['sent'] for result in results]
+    duration = max(sent_times)
+    by_chat = defaultdict(list)
+    waits = defaultdict(list)
+    for result in results:
+        by_chat[result['chat_id']].append(result['sent'])
+        waits[result['priority']].append(result['sent'] - result['submitted'])
+
+    # الحدود: الحد العام مع دفعته الأولى، ولكل دردشة خاصة معدلها مع دفعتها
+    global_peak = max_in_window(sent_times, 1.0)
+    chat_peak = max(max_in_window(times, 10.0) for times in by_chat.values())
+    global_limit = scheduler.global_rate + scheduler._global.capacity
+    chat_limit = scheduler.private_rate * 10 + scheduler.private_burst
+
+    print(f"الرسائل: {len(results)}  المدة المحاكاة: {duration:.1f}ث  المعدل: {len(results) / duration:.1f} رسالة/ث")
+    print(f"أقصى ذروة في ثانية: {global_peak} (الحد {global_limit:g})  "
+          f"أقصى دردشة في 10ث: {chat_peak} (الحد {chat_limit:g})")
+    for priority in sorted(waits):
+        values = waits[priority]
+        print(f"{PRIORITY_NAMES[priority]:<20} {len(values):6d} رسالة  "
+              f"الانتظار p50 {percentile(values, 0.5):6.2f}ث  p99 {percentile(values, 0.99):6.2f}ث  "
+              f"الأقصى {max(values):6.2f}ث")
+
+    ok = global_peak <= global_limit and chat_peak <= chat_limit
+    print("✅ ضمن حدود Telegram" if ok else "❌ تجاوز حدود Telegram")
+    return 0 if ok else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
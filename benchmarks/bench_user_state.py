@@ -0,0 +1,87 @@
+"""قياس ذاكرة حالة المستخدمين (بايت لكل مستخدم) مقارنة بالقواميس القديمة
+
+التشغيل: python benchmarks/bench_user_state.py [عدد المستخدمين] [نسبة المنتظرين]
+"""
+import gc
+import os
+import random
+import sys
+import tracemalloc
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from state_store import MemoryStateStore  # noqa: E402
+
+NAMES = ["محمد أحمد", "Sara Ali", "عبدالله", "Fatima Al-Harbi", "خالد العتيبي", ""]
+
+
+def make_users(count, pending_ratio):
+    """معرفات Telegram واقعية (حتى 10 أرقام) ونسبة من المنتظرين للموافقة
+
+    المعرفات والأسماء محفوظة كبايتات تفك داخل القياس حتى ينشئ كل بناء كائناته
+    كما يحدث مع JSON كل طلب (وإلا شاركت البنيتان كائنات القائمة ولم تحسب)"""
+    rng = random.Random(42)
+    users = []
+    for index in range(count):
+        user_id = str(rng.randint(100000000, 7999999999)).encode()
+        user_name = f"{rng.choice(NAMES)} {index}".encode()
+        users.append((user_id, user_name, rng.random() < pending_ratio))
+    return users
+
+
+def build_legacy(users):
+    """البنية الأصلية: مفاتيح نصية وقاموس كامل لكل طلب موافقة"""
+    user_warnings = {}
+    pending_approvals = {}
+    for user_id, user_name, pending in users:
+        user_warnings[str(int(user_id))] = 0
+        if pending:
+            pending_approvals[str(int(user_id))] = {
+                'user_name': user_name.decode(),
+                'chat_id': int(user_id),
+                'timestamp': datetime.now().isoformat()
+            }
+    return user_warnings, pending_approvals
+
+
+def build_store(users):
+    store = MemoryStateStore()
+    for user_id, user_name, pending in users:
+        if pending:
+            store.register_new_user(int(user_id), {'user_name': user_name.decode(), 'chat_id': int(user_id),
+                                                   'timestamp': datetime.now().isoformat()})
+        else:
+            store.set_warnings(int(user_id), 0)
+    return store
+
+
+def measure(build, users):
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    result = build(users)
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return result, after - before
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    pending_ratio = float(sys.argv[2]) if len(sys.argv) > 2 else 0.1
+    # أرقام المعرفات والأسماء تنشأ قبل القياس لأنها ليست جزءاً من الحالة
+    users = make_users(count, pending_ratio)
+
+    _, legacy_bytes = measure(build_legacy, users)
+    store, store_bytes = measure(build_store, users)
+    estimate = store.memory_stats()
+
+    print(f"المستخدمون: {count}  (المنتظرون: {store.count_pending()})")
+    print(f"القواميس القديمة:    {legacy_bytes / count:7.1f} بايت/مستخدم  ({legacy_bytes / 1024 / 1024:.1f} MB)")
+    print(f"الجدول المضغوط:      {store_bytes / count:7.1f} بايت/مستخدم  ({store_bytes / 1024 / 1024:.1f} MB)")
+    print(f"تقدير /health:        {estimate['bytes_per_user']:7.1f} بايت/مستخدم")
+    print(f"التوفير: {100 * (1 - store_bytes / legacy_bytes):.0f}%")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,140 @@
+"""قياس سرعة كشف المخالفات (رسالة/ثانية) مقارنة بالدالة القديمة
+
+التشغيل: python benchmarks/bench_violations.py [عدد الرسائل]
+"""
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from violations import ViolationEngine  # noqa: E402
+
+RULES_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'violation_rules.json')
+
+ARABIC_QUESTIONS = [
+    "ما هي عقوبة التشهير في مواقع التواصل الاجتماعي؟",
+    "هل يحق للمؤجر إخلاء المستأجر قبل انتهاء العقد؟",
+    "كم مدة الاعتراض على الحكم الابتدائي في المحكمة العمالية؟",
+    "ما الإجراءات المطلوبة لتوثيق عقد البيع العقاري؟",
+    "صاحب العمل رفض صرف مكافأة نهاية الخدمة، ماذا أفعل؟",
+    "هل يجوز فسخ عقد الزواج بسبب الضرر؟ وما هي المستندات المطلوبة",
+    "عندي ٣ شيكات بدون رصيد بقيمة ١٥٠٠٠ ريال، كيف أرفع دعوى؟",
+    "ما الفرق بين الوكالة العامة والوكالة الخاصة؟",
+]
+ENGLISH_QUESTIONS = [
+    "What is the notice period for terminating an employment contract?",
+    "Can my landlord keep the deposit after I moved out?",
+    "How do I register a trademark for my company?",
+    "Is a verbal agreement legally binding in commercial disputes?",
+    "Our company received a claim from example.company, is it valid?",
+]
+MIXED = [
+    "أريد استشارة بخصوص contract termination وحقوقي في end of service",
+    "تم رفع قضية ضدي بخصوص NDA violation، ماذا أفعل؟",
+]
+LINKS = [
+    "تابعونا على https://example.com/offers",
+    "Join us: t.me/legal_group",
+    "انضم للقناة t.me/+AbCdEf123",
+    "visit www.lawyers-online.net for more",
+    "موقعنا google . com",
+    "تواصل عبر ｔ．ｍｅ/legal",
+    "خصومات على site。org اليوم",
+    "اكتب telegram dot me slash group",
+]
+# نصوص عادية تشبه الروابط بعد وصل المسافات حول النقطة - يجب ألا تكشف
+PROSE = [
+    "The total amount. Net of taxes is what the court awarded.",
+    "I can't. Me and my wife signed the lease together.",
+    "Paragraph 2. Com-pany law applies to the partnership.",
+    "Please see section 3 . org chart attached to the contract.",
+    "انتهى العقد. Net salary was never paid after that.",
+    "What is my salary, e.g. net salary after tax?",
+    "The employer pays the gross, i.e. net income is lower.",
+    "Please see clause a. net amount due to the tenant.",
+]
+
+
+def legacy_detect_violations(text):
+    """الدالة الأصلية قبل محرك القواعد (للمقارنة فقط)"""
+    if not text:
+        return False
+    text_lower = str(text).lower()
+    violations = [
+        'http://', 'https://', 'www.', 't.me/',
+        'telegram.me', '.com', '.org', '.net'
+    ]
+    for violation in violations:
+        if violation in text_lower:
+            return True
+    return False
+
+
+def build_corpus(size, seed=1234):
+    """مجموعة رسائل واقعية: أغلبها أسئلة قانونية ونسبة صغيرة روابط"""
+    rng = random.Random(seed)
+    corpus = []
+    for _ in range(size):
+        roll = rng.random()
+        if roll < 0.55:
+            text = rng.choice(ARABIC_QUESTIONS)
+        elif roll < 0.8:
+            text = rng.choice(ENGLISH_QUESTIONS)
+        elif roll < 0.88:
+            text = rng.choice(MIXED)
+        elif roll < 0.92:
+            text = rng.choice(PROSE)
+        else:
+            text = rng.choice(LINKS)
+        if rng.random() < 0.3:
+            # رسائل أطول: سؤال مع تفاصيل إضافية
+            text = f"{text} {rng.choice(ARABIC_QUESTIONS)}"
+        corpus.append(text)
+    return corpus
+
+
+def measure(func, corpus, rounds=3):
+    best = None
+    hits = 0
+    for _ in range(rounds):
+        started = time.perf_counter()
+        hits = sum(1 for text in corpus if func(text))
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return len(corpus) / best, hits
+
+
+def main():
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    corpus = build_corpus(size)
+    engine = ViolationEngine(RULES_PATH)
+    # إيقاف فحص تعديل الملف أثناء القياس
+    engine.reload_interval = float('inf')
+
+    legacy_rate, legacy_hits = measure(legacy_detect_violations, corpus)
+    engine_rate, engine_hits = measure(engine.detect, corpus)
+
+    print(f"الرسائل: {size}")
+    print(f"{'الدالة':<24}{'رسالة/ثانية':>16}{'مخالفات':>12}")
+    print(f"{'legacy substring scan':<24}{legacy_rate:>16,.0f}{legacy_hits:>12}")
+    print(f"{'ViolationEngine':<24}{engine_rate:>16,.0f}{engine_hits:>12}")
+    print(f"النسبة: {engine_rate / legacy_rate:.2f}x")
+
+    missed = sorted({text for text in corpus if engine.detect(text) and not legacy_detect_violations(text)})
+    false_positives = sorted({text for text in corpus if legacy_detect_violations(text) and not engine.detect(text)})
+    print(f"\nمخالفات مموهة لم تكشفها الدالة القديمة ({len(missed)}):")
+    for text in missed:
+        print(f"  - {text}")
+    print(f"\nإنذارات خاطئة في الدالة القديمة ({len(false_positives)}):")
+    for text in false_positives:
+        print(f"  - {text}")
+    flagged_prose = [text for text in PROSE if engine.detect(text)]
+    print(f"\nنصوص عادية كشفها المحرك خطأ ({len(flagged_prose)}):")
+    for text in flagged_prose:
+        print(f"  - {text}: {engine.detect(text).match}")
+
+
+if __name__ == '__main__':
+    main()
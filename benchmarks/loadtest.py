@@ -0,0 +1,341 @@
+"""اختبار حمل شامل لـ webhook مع خوادم وهمية محلية لـ Telegram و n8n
+
+يعمل دون اتصال بالإنترنت: يشغل التطبيق على منفذ محلي ويرسل تحديثات صناعية
+(انضمام، موافقات، مخالفات، أسئلة) بمعدل محدد ثم يطبع الإنتاجية وزمن الاستجابة
+وعدد الاتصالات الخارجية ونمو الذاكرة.
+
+التشغيل: python benchmarks/loadtest.py --rate 200 --duration 20 --tg-429-rate 0.02
+مقارنة الخادم غير المتزامن: python benchmarks/loadtest.py --server async --n8n-latency 2
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import random
+import resource
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+TOKEN = 'loadtest-token'
+MANAGER_CHAT_ID = 100
+
+
+class _FakeHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def process_request(self, request, client_address):
+        # تسمية خيوط الخوادم الوهمية لاستبعادها من عدد خيوط التطبيق
+        thread = threading.Thread(target=self.process_request_thread, args=(request, client_address),
+                                  name='fake-server', daemon=True)
+        thread.start()
+
+    def handle_error(self, request, client_address):
+        # قطع الاتصالات الدائمة عند الإيقاف ليس خطأ في الاختبار
+        pass
+
+
+def app_thread_count():
+    """عدد خيوط التطبيق فقط (دون الخوادم الوهمية وخيوط عميل الاختبار)"""
+    return sum(1 for thread in threading.enumerate()
+               if thread.name != 'fake-server' and not thread.name.startswith('loadtest-client'))
+
+
+class FakeServer:
+    """خادم HTTP وهمي بزمن استجابة ونسبة أخطاء قابلة للضبط"""
+
+    def __init__(self, name, latency=0.0, error_rate=0.0, flood_rate=0.0, seed=1):
+        self.name = name
+        self.latency = latency
+        self.error_rate = error_rate
+        self.flood_rate = flood_rate
+        self.calls = Counter()
+        self.statuses = Counter()
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._message_ids = itertools.count(1)
+        self.server = _FakeHTTPServer(('127.0.0.1', 0), self._handler())
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def _roll(self):
+        with self._lock:
+            roll = self._random.random()
+        if roll < self.flood_rate:
+            return 429
+        if roll < self.flood_rate + self.error_rate:
+            return 500
+        return 200
+
+    def _handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                if length:
+                    self.rfile.read(length)
+                method = self.path.rsplit('/', 1)[-1]
+                if fake.latency:
+                    time.sleep(fake.latency)
+                status = fake._roll()
+                with fake._lock:
+                    fake.calls[method] += 1
+                    fake.statuses[status] += 1
+                if status == 429:
+                    body = {'ok': False, 'error_code': 429, 'description': 'Too Many Requests',
+                            'parameters': {'retry_after': 1}}
+                elif status == 500:
+                    body = {'ok': False, 'error_code': 500, 'description': 'Internal Server Error'}
+                else:
+                    body = {'ok': True, 'result': {'message_id': next(fake._message_ids)}}
+                data = json.dumps(body).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+        return Handler
+
+    def close(self):
+        self.server.shutdown()
+
+
+class UpdateFactory:
+    """توليد تحديثات صناعية واقعية"""
+
+    QUESTIONS = [
+        "ما هي مدة الاعتراض على الحكم؟",
+        "هل يحق لصاحب العمل فصلي دون إنذار؟",
+        "How do I register a company branch?",
+        "ما الإجراءات المطلوبة لتوثيق عقد الإيجار؟",
+    ]
+    VIOLATIONS = [
+        "تابعونا https://spam.example.com",
+        "join t.me/+promo",
+        "visit www.offers.net",
+    ]
+
+    def __init__(self, approved_users, mix, seed=7):
+        self._random = random.Random(seed)
+        self._update_ids = itertools.count(1)
+        self._new_users = itertools.count(10_000_000)
+        self._callback_ids = itertools.count(1)
+        self.approved = list(approved_users)
+        self.joined = []
+        self.kinds = list(mix)
+        self.weights = [mix[kind] for kind in self.kinds]
+        self._lock = threading.Lock()
+
+    def _message(self, user_id, text):
+        return {
+            'update_id': next(self._update_ids),
+            'message': {
+                'message_id': 1,
+                'from': {'id': user_id, 'first_name': 'Load', 'last_name': 'Test'},
+                'chat': {'id': user_id, 'type': 'private'},
+                'text': text
+            }
+        }
+
+    def next(self):
+        with self._lock:
+            kind = self._random.choices(self.kinds, self.weights)[0]
+            if kind == 'approve' and not self.joined:
+                kind = 'join'
+            if kind == 'join':
+                user_id = next(self._new_users)
+                self.joined.append(user_id)
+                return kind, self._message(user_id, "السلام عليكم")
+            if kind == 'approve':
+                user_id = self.joined.pop(0)
+                action = 'approve' if self._random.random() < 0.9 else 'reject'
+                return kind, {
+                    'update_id': next(self._update_ids),
+                    'callback_query': {
+                        'id': f"cb{next(self._callback_ids)}",
+                        'from': {'id': MANAGER_CHAT_ID},
+                        'data': f"{action}_{user_id}",
+                        'message': {'message_id': 1, 'chat': {'id': MANAGER_CHAT_ID}}
+                    }
+                }
+            user_id = self._random.choice(self.approved)
+            text = self._random.choice(self.VIOLATIONS if kind == 'violation' else self.QUESTIONS)
+            return kind, self._message(user_id, text)
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def serve_async(bot):
+    """تشغيل تطبيق aiohttp في خيط مستقل بحلقة أحداث خاصة - يعيد (المنفذ، دالة الإيقاف)"""
+    from aiohttp import web
+
+    loop = asyncio.new_event_loop()
+    runner = web.AppRunner(bot.create_async_app())
+    loop.run_until_complete(runner.setup())
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    loop.run_until_complete(site.start())
+    port = site._server.sockets[0].getsockname()[1]
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+
+    def stop():
+        asyncio.run_coroutine_threadsafe(runner.cleanup(), loop).result(timeout=30)
+        loop.call_soon_threadsafe(loop.stop)
+    return port, stop
+
+
+def parse_mix(text):
+    mix = {}
+    for item in text.split(','):
+        kind, weight = item.split('=')
+        mix[kind.strip()] = float(weight)
+    return mix
+
+
+def main():
+    parser = argparse.ArgumentParser(description="اختبار حمل webhook")
+    parser.add_argument('--rate', type=float, default=100, help="تحديث في الثانية")
+    parser.add_argument('--duration', type=float, default=10, help="مدة الإرسال بالثواني")
+    parser.add_argument('--mix', default='join=0.1,approve=0.08,violation=0.07,question=0.75')
+    parser.add_argument('--users', type=int, default=2000, help="عدد المستخدمين الموافق عليهم مسبقاً")
+    parser.add_argument('--clients', type=int, default=32, help="عدد اتصالات الإرسال المتزامنة")
+    parser.add_argument('--tg-latency', type=float, default=0.03)
+    parser.add_argument('--tg-error-rate', type=float, default=0.0)
+    parser.add_argument('--tg-429-rate', type=float, default=0.0)
+    parser.add_argument('--n8n-latency', type=float, default=0.2)
+    parser.add_argument('--n8n-error-rate', type=float, default=0.0)
+    parser.add_argument('--drain-timeout', type=float, default=30, help="مهلة انتظار تفريغ الطوابير")
+    parser.add_argument('--tracemalloc', action='store_true', help="قياس نمو الذاكرة بدقة (أبطأ)")
+    parser.add_argument('--server', choices=['flask', 'async'], default='flask', help="نوع الخادم المختبر")
+    args = parser.parse_args()
+
+    telegram_server = FakeServer('telegram', args.tg_latency, args.tg_error_rate, args.tg_429_rate)
+    n8n_server = FakeServer('n8n', args.n8n_latency, args.n8n_error_rate, seed=2)
+
+    workdir = tempfile.mkdtemp(prefix='loadtest-')
+    os.chdir(workdir)
+    os.environ.update({
+        'TELEGRAM_TOKEN': TOKEN,
+        'MANAGER_CHAT_ID': str(MANAGER_CHAT_ID),
+        'TELEGRAM_API_URL': telegram_server.url,
+        'N8N_WEBHOOK_URL': f"{n8n_server.url}/webhook/fasl",
+        'STATE_DB_PATH': os.path.join(workdir, 'state.db'),
+        'OUTBOX_DIR': os.path.join(workdir, 'outbox'),
+        'POLL_OFFSET_PATH': os.path.join(workdir, 'offset.json'),
+    })
+
+    import logging
+    import requests
+    from werkzeug.serving import make_server
+    import main as bot
+
+    logging.getLogger().setLevel(logging.WARNING)
+
+    for user_id in range(1, args.users + 1):
+        bot.state.register_new_user(user_id, {'user_name': 'seed', 'chat_id': user_id})
+        bot.state.resolve_pending(user_id, 0)
+
+    if args.server == 'async':
+        port, stop_server = serve_async(bot)
+    else:
+        server = make_server('127.0.0.1', 0, bot.app, threaded=True)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        port, stop_server = server.server_port, server.shutdown
+    webhook_url = f"http://127.0.0.1:{port}/webhook"
+
+    factory = UpdateFactory(range(1, args.users + 1), parse_mix(args.mix))
+    local = threading.local()
+    latencies = []
+    statuses = Counter()
+    kinds = Counter()
+    lock = threading.Lock()
+    peak_threads = [app_thread_count()]
+
+    def send(scheduled_at):
+        delay = scheduled_at - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        session = getattr(local, 'session', None)
+        if session is None:
+            session = local.session = requests.Session()
+        kind, update = factory.next()
+        started = time.perf_counter()
+        try:
+            response = session.post(webhook_url, json=update, timeout=30)
+            status = response.json().get('status', response.status_code)
+        except Exception as e:
+            status = f"client_error:{type(e).__name__}"
+        elapsed = time.perf_counter() - started
+        with lock:
+            latencies.append(elapsed)
+            statuses[status] += 1
+            kinds[kind] += 1
+            peak_threads[0] = max(peak_threads[0], app_thread_count())
+
+    total = int(args.rate * args.duration)
+    if args.tracemalloc:
+        tracemalloc.start()
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.clients, thread_name_prefix='loadtest-client') as pool:
+        # إرسال بحلقة مفتوحة: كل طلب في موعده المحدد بغض النظر عن بطء ما قبله
+        list(pool.map(send, (started + index / args.rate for index in range(total))))
+    elapsed = time.perf_counter() - started
+
+    drain_started = time.perf_counter()
+    while time.perf_counter() - drain_started < args.drain_timeout:
+        if not bot.dispatcher.depth() and not bot.outbound.depth():
+            break
+        time.sleep(0.1)
+    drain_time = time.perf_counter() - drain_started
+
+    rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    traced = tracemalloc.get_traced_memory() if args.tracemalloc else None
+
+    print(f"\n=== نتائج اختبار الحمل ({total} تحديث خلال {elapsed:.1f} ث) ===")
+    print(f"الإنتاجية المحققة: {total / elapsed:,.1f} تحديث/ث (المطلوب {args.rate:g})")
+    print("زمن استجابة webhook (ms): "
+          f"p50={percentile(latencies, 0.50) * 1000:.1f} "
+          f"p95={percentile(latencies, 0.95) * 1000:.1f} "
+          f"p99={percentile(latencies, 0.99) * 1000:.1f} "
+          f"max={max(latencies) * 1000:.1f}")
+    print(f"أنواع التحديثات: {dict(kinds)}")
+    print(f"حالات الاستجابة: {dict(statuses)}")
+    print(f"اتصالات Telegram: {dict(telegram_server.calls)} رموز: {dict(telegram_server.statuses)}")
+    print(f"اتصالات n8n: {sum(n8n_server.calls.values())} رموز: {dict(n8n_server.statuses)}")
+    print(f"تفريغ الطوابير: {drain_time:.1f} ث (متبقي: dispatch={bot.dispatcher.depth()} "
+          f"outbound={bot.outbound.depth()} outbox={bot.fasl_outbox.depth()})")
+    print(f"أقصى عدد خيوط التطبيق: {peak_threads[0]}")
+    print(f"الذاكرة: maxrss {rss_before / 1024:.1f} → {rss_after / 1024:.1f} MB")
+    if traced:
+        print(f"tracemalloc: الحالي {traced[0] / 1024 / 1024:.1f} MB، الأقصى {traced[1] / 1024 / 1024:.1f} MB")
+
+    stop_server()
+    telegram_server.close()
+    n8n_server.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,268 @@
+import fcntl
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+# نتائج إرسال رسالة بث لمستخدم واحد
+SENT = 'sent'
+BLOCKED = 'blocked'
+FAILED = 'failed'
+RETRY = 'retry'
+
+RUNNING = 'running'
+DONE = 'done'
+CANCELLED = 'cancelled'
+
+
+def classify_response(body):
+    """تصنيف استجابة sendMessage: SENT أو BLOCKED أو FAILED أو RETRY"""
+    if body and body.get('ok'):
+        return SENT
+    code = (body or {}).get('error_code')
+    if code == 403:
+        # المستخدم حظر البوت أو حذف حسابه - لا فائدة من الإعادة
+        return BLOCKED
+    if code == 400:
+        # دردشة غير موجودة أو نص مرفوض
+        return FAILED
+    # 429 بعد استنفاد محاولات العميل أو 5xx أو خطأ شبكة
+    return RETRY
+
+
+class Broadcast:
+    """بث رسالة لجميع المستخدمين المقبولين بأقصى معدل يسمح به Telegram مع نقطة استئناف على القرص
+
+    المستخدمون يقرؤون على دفعات تصاعدية حسب المعرف، وبعد كل دفعة يحفظ آخر معرف مكتمل،
+    فإعادة التشغيل تكمل من بعده (قد تتكرر رسائل دفعة واحدة على الأكثر).
+    قفل الملف يضمن أن عاملاً واحداً فقط ينفذ البث ويكتب نقطة الاستئناف، والعمال الآخرون يقرؤونها."""
+
+    def __init__(self, store, send, checkpoint_path='broadcast.json', batch_size=50, concurrency=8,
+                 max_attempts=3, retry_backoff=2.0, report_interval=60.0, on_progress=None,
+                 clock=time.monotonic):
+        # send(chat_id, text) -> SENT أو BLOCKED أو FAILED أو RETRY
+        # on_progress(stats, finished) - تقارير دورية ونهائية
+        self.store = store
+        self.send = send
+        self.checkpoint_path = checkpoint_path
+        self.batch_size = batch_size
+        self.concurrency = max(1, concurrency)
+        self.max_attempts = max_attempts
+        self.retry_backoff = retry_backoff
+        self.report_interval = report_interval
+        self.on_progress = on_progress
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._cancel = threading.Event()
+        self._thread = None
+        self._job = None
+        # بداية التشغيل الحالي لحساب المعدل (بعد الاستئناف يحسب من جديد)
+        self._run_started = None
+        self._run_sent = 0
+        self._load()
+
+    # --- نقطة الاستئناف ---
+
+    def _load(self):
+        try:
+            with open(self.checkpoint_path, encoding='utf-8') as handle:
+                self._job = json.load(handle)
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as e:
+            logger.error(f"❌ تعذر قراءة نقطة استئناف البث: {e}")
+
+    def _reload(self):
+        """قراءة حالة البث من القرص عندما ينفذه عامل آخر"""
+        if not self.is_running():
+            with self._lock:
+                self._load()
+
+    def _acquire_run_lock(self):
+        """قفل التنفيذ على ملف مشترك - يعيد مقبض الملف أو None إذا كان البث قيد التنفيذ في عامل آخر"""
+        handle = open(f"{self.checkpoint_path}.lock", 'a')
+        try:
+            fcntl.flock(handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return handle
+        except OSError:
+            handle.close()
+            return None
+
+    def _cancel_path(self):
+        # طلب إلغاء من عامل لا ينفذ البث - المنفذ يتحقق منه بعد كل دفعة
+        return f"{self.checkpoint_path}.cancel"
+
+    def _save_locked(self):
+        temp_path = f"{self.checkpoint_path}.tmp"
+        with open(temp_path, 'w', encoding='utf-8') as handle:
+            json.dump(self._job, handle, ensure_ascii=False)
+            handle.flush()
+            os.fsync(handle.fileno())
+        os.replace(temp_path, self.checkpoint_path)
+
+    # --- الواجهة ---
+
+    def is_running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, text):
+        """بدء بث جديد - يعيد False إذا كان هناك بث قيد التنفيذ"""
+        if self.is_running():
+            return False
+        lock_handle = self._acquire_run_lock()
+        if lock_handle is None:
+            return False
+        with self._lock:
+            # نقطة الاستئناف قد تكون تغيرت في عامل آخر منذ آخر قراءة
+            self._load()
+            if self._job and self._job['status'] == RUNNING:
+                lock_handle.close()
+                return False
+            try:
+                os.remove(self._cancel_path())
+            except FileNotFoundError:
+                pass
+            self._job = {
+                'id': uuid.uuid4().hex[:8],
+                'text': text,
+                'status': RUNNING,
+                'cursor': None,
+                'total': self.store.count_approved(),
+                'sent': 0,
+                'blocked': 0,
+                'failed': 0,
+                'started': time.time()
+            }
+            try:
+                self._save_locked()
+            except Exception:
+                lock_handle.close()
+                raise
+        self._spawn(lock_handle)
+        return True
+
+    def resume(self):
+        """استئناف بث لم يكتمل قبل إعادة التشغيل"""
+        if self.is_running():
+            return False
+        lock_handle = self._acquire_run_lock()
+        if lock_handle is None:
+            logger.info("📣 البث قيد التنفيذ في عامل آخر")
+            return False
+        with self._lock:
+            self._load()
+            if self._job is None or self._job['status'] != RUNNING:
+                lock_handle.close()
+                return False
+        logger.info(f"📣 استئناف البث {self._job['id']} بعد المستخدم {self._job['cursor']}")
+        self._spawn(lock_handle)
+        return True
+
+    def cancel(self):
+        """إيقاف البث بعد الدفعة الحالية (أو إلغاء بث متوقف لم يكتمل)"""
+        if self.is_running():
+            self._cancel.set()
+            return True
+        lock_handle = self._acquire_run_lock()
+        if lock_handle is None:
+            # عامل آخر ينفذ البث: طلب الإلغاء عبر ملف يقرؤه بعد الدفعة الحالية
+            with open(self._cancel_path(), 'w'):
+                pass
+            return True
+        try:
+            with self._lock:
+                self._load()
+                if self._job is None or self._job['status'] != RUNNING:
+                    return False
+                self._job['status'] = CANCELLED
+                self._save_locked()
+            return True
+        finally:
+            lock_handle.close()
+
+    def _spawn(self, lock_handle):
+        self._cancel.clear()
+        self._thread = threading.Thread(target=self._run, args=(lock_handle,), name='broadcast', daemon=True)
+        self._thread.start()
+
+    # --- التنفيذ ---
+
+    def _deliver(self, user_id):
+        # في الدردشات الخاصة معرف الدردشة هو معرف المستخدم
+        for attempt in range(self.max_attempts):
+            try:
+                result = self.send(user_id, self._job['text'])
+            except Exception as e:
+                logger.error(f"❌ خطأ في إرسال رسالة البث للمستخدم {user_id}: {e}")
+                result = RETRY
+            if result != RETRY:
+                return result
+            if attempt + 1 < self.max_attempts:
+                time.sleep(self.retry_backoff * (2 ** attempt))
+        return FAILED
+
+    def _run(self, lock_handle):
+        # قفل التنفيذ أخذ في start أو resume قبل حفظ نقطة الاستئناف ويحرر عند الانتهاء
+        executor = ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix='broadcast-send')
+        self._run_started = self._clock()
+        self._run_sent = 0
+        last_report = self._run_started
+        try:
+            while not self._cancel.is_set():
+                batch = self.store.approved_users(after=self._job['cursor'], limit=self.batch_size)
+                if not batch:
+                    break
+                results = list(executor.map(self._deliver, batch))
+                with self._lock:
+                    for result in results:
+                        self._job[result] += 1
+                    self._run_sent += results.count(SENT)
+                    self._job['cursor'] = batch[-1]
+                    self._save_locked()
+                if os.path.exists(self._cancel_path()):
+                    self._cancel.set()
+                if self._clock() - last_report >= self.report_interval:
+                    last_report = self._clock()
+                    self._report(False)
+
+            with self._lock:
+                self._job['status'] = CANCELLED if self._cancel.is_set() else DONE
+                self._job['finished'] = time.time()
+                self._save_locked()
+            try:
+                os.remove(self._cancel_path())
+            except FileNotFoundError:
+                pass
+            logger.info(f"📣 انتهى البث {self._job['id']}: {self._job['status']}")
+            self._report(True)
+        except Exception as e:
+            # تبقى الحالة RUNNING فيستأنف البث عند إعادة التشغيل
+            logger.error(f"❌ توقف البث بسبب خطأ: {e}")
+        finally:
+            executor.shutdown(wait=False)
+            lock_handle.close()
+
+    def _report(self, finished):
+        if self.on_progress is None:
+            return
+        try:
+            self.on_progress(self.stats(), finished)
+        except Exception as e:
+            logger.error(f"❌ خطأ في إرسال تقدم البث: {e}")
+
+    def stats(self):
+        self._reload()
+        with self._lock:
+            if self._job is None:
+                return None
+            job = {key: value for key, value in self._job.items() if key != 'text'}
+        elapsed = self._clock() - self._run_started if self._run_started is not None else 0
+        job['processed'] = job['sent'] + job['blocked'] + job['failed']
+        job['rate'] = round(self._run_sent / elapsed, 1) if elapsed > 0 else 0.0
+        job['running'] = self.is_running()
+        return job
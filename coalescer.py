@@ -0,0 +1,102 @@
+import heapq
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class _Buffer:
+    __slots__ = ('chat_id', 'user_name', 'parts', 'first_at', 'deadline')
+
+    def __init__(self, chat_id, user_name, now):
+        self.chat_id = chat_id
+        self.user_name = user_name
+        self.parts = []
+        self.first_at = now
+        self.deadline = now
+
+
+class MessageCoalescer:
+    """تجميع رسائل المستخدم المتتالية وإرسالها دفعة واحدة بعد فترة هدوء قصيرة"""
+
+    def __init__(self, on_flush, window=2.0, max_wait=10.0, max_parts=20, clock=time.monotonic):
+        # on_flush(user_id, chat_id, parts, user_name)
+        self.on_flush = on_flush
+        self.window = window
+        self.max_wait = max_wait
+        self.max_parts = max_parts
+        self._clock = clock
+        self._buffers = {}
+        self._deadlines = []
+        self._cond = threading.Condition()
+        self._thread = None
+        self.messages = 0
+        self.flushes = 0
+
+    def add(self, user_id, chat_id, text, user_name=""):
+        """إضافة رسالة - كل رسالة جديدة تعيد ضبط فترة الانتظار حتى الحد الأقصى"""
+        flush_now = None
+        with self._cond:
+            now = self._clock()
+            buffer = self._buffers.get(user_id)
+            if buffer is None:
+                buffer = self._buffers[user_id] = _Buffer(chat_id, user_name, now)
+            buffer.parts.append(text)
+            buffer.deadline = min(now + self.window, buffer.first_at + self.max_wait)
+            self.messages += 1
+
+            if len(buffer.parts) >= self.max_parts:
+                flush_now = self._buffers.pop(user_id)
+            else:
+                heapq.heappush(self._deadlines, (buffer.deadline, user_id))
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name='coalescer', daemon=True)
+                    self._thread.start()
+                self._cond.notify()
+
+        if flush_now is not None:
+            self._flush(user_id, flush_now)
+
+    def _due_locked(self, now):
+        due = []
+        while self._deadlines and self._deadlines[0][0] <= now:
+            deadline, user_id = heapq.heappop(self._deadlines)
+            buffer = self._buffers.get(user_id)
+            # تجاهل المواعيد القديمة التي مددتها رسالة أحدث
+            if buffer is not None and buffer.deadline <= now:
+                due.append((user_id, self._buffers.pop(user_id)))
+        return due
+
+    def _run(self):
+        while True:
+            with self._cond:
+                due = self._due_locked(self._clock())
+                if not due:
+                    timeout = self._deadlines[0][0] - self._clock() if self._deadlines else None
+                    self._cond.wait(timeout)
+                    continue
+            for user_id, buffer in due:
+                self._flush(user_id, buffer)
+
+    def _flush(self, user_id, buffer):
+        self.flushes += 1
+        try:
+            self.on_flush(user_id, buffer.chat_id, list(buffer.parts), buffer.user_name)
+        except Exception as e:
+            logger.error(f"❌ خطأ في إرسال الرسائل المجمعة للمستخدم {user_id}: {e}")
+
+    def flush_all(self):
+        """إرسال جميع الرسائل المنتظرة فوراً (عند الإيقاف)"""
+        with self._cond:
+            buffers, self._buffers = self._buffers, {}
+            self._deadlines = []
+        for user_id, buffer in buffers.items():
+            self._flush(user_id, buffer)
+
+    def stats(self):
+        return {
+            'buffered_users': len(self._buffers),
+            'messages': self.messages,
+            'flushes': self.flushes
+        }
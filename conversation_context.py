@@ -0,0 +1,129 @@
+import json
+import sys
+import threading
+import time
+from collections import OrderedDict, deque
+
+# أدوار الرسائل في السياق (نفس تسمية نماذج المحادثة في n8n)
+USER = 'user'
+ASSISTANT = 'assistant'
+
+
+class ConversationContext:
+    """آخر رسائل كل مستخدم وإجاباتها في حلقة محدودة ترسل مع كل طلب إلى Fasl AI
+
+    لكل مستخدم حد لعدد الرسائل ولمجموع الأحرف، وعدد المستخدمين محدود مع إخراج الأقل استخداماً (LRU)."""
+
+    def __init__(self, max_users=10000, max_turns=6, max_chars=2000, max_text=500, max_age=6 * 3600,
+                 clock=time.time):
+        self.max_users = max_users
+        self.max_turns = max_turns
+        self.max_chars = max_chars
+        # الرسالة الطويلة تقص حتى لا تستهلك حصة المستخدم وحدها
+        self.max_text = max_text
+        # الرسائل الأقدم من هذه المدة لا ترسل (محادثة جديدة)
+        self.max_age = max_age
+        self._clock = clock
+        # المستخدم -> [deque((الدور، الوقت، النص))، مجموع الأحرف، حجم الذاكرة التقريبي]
+        self._users = OrderedDict()
+        self._lock = threading.Lock()
+        # عدادات تحدث مع كل إضافة وإخراج حتى لا تمر /health على كل الرسائل
+        self._turns = 0
+        self._bytes = 0
+        self.evictions = 0
+        self.snapshots = 0
+        self.snapshot_bytes = 0
+        self.max_snapshot_bytes = 0
+
+    @staticmethod
+    def _turn_bytes(turn):
+        return sys.getsizeof(turn) + sys.getsizeof(turn[1]) + sys.getsizeof(turn[2])
+
+    def _drop_locked(self, entry):
+        self._turns -= len(entry[0])
+        self._bytes -= entry[2]
+
+    def _pop_turn_locked(self, entry):
+        turn = entry[0].popleft()
+        size = self._turn_bytes(turn)
+        entry[1] -= len(turn[2])
+        entry[2] -= size
+        self._turns -= 1
+        self._bytes -= size
+
+    def add(self, user_id, role, text):
+        """إضافة رسالة إلى سياق المستخدم"""
+        text = str(text or '').strip()[:self.max_text]
+        if not text:
+            return
+        key = int(user_id)
+        with self._lock:
+            entry = self._users.get(key)
+            if entry is None:
+                turns = deque(maxlen=self.max_turns)
+                entry = self._users[key] = [turns, 0, 0]
+                entry[2] = sys.getsizeof(key) + sys.getsizeof(entry) + sys.getsizeof(turns)
+                self._bytes += entry[2]
+                while len(self._users) > self.max_users:
+                    self._drop_locked(self._users.popitem(last=False)[1])
+                    self.evictions += 1
+            else:
+                self._users.move_to_end(key)
+            turns = entry[0]
+            if len(turns) == turns.maxlen:
+                self._pop_turn_locked(entry)
+            turn = (role, int(self._clock()), text)
+            size = self._turn_bytes(turn)
+            turns.append(turn)
+            entry[1] += len(text)
+            entry[2] += size
+            self._turns += 1
+            self._bytes += size
+            while entry[1] > self.max_chars and len(turns) > 1:
+                self._pop_turn_locked(entry)
+
+    def snapshot(self, user_id):
+        """السياق الحالي للمستخدم بصيغة الطلب: [{'role', 'text', 'at'}] من الأقدم للأحدث"""
+        oldest = self._clock() - self.max_age
+        with self._lock:
+            entry = self._users.get(int(user_id))
+            turns = [turn for turn in entry[0] if turn[1] >= oldest] if entry is not None else []
+        context = [{'role': role, 'text': text, 'at': at} for role, at, text in turns]
+        if context:
+            size = len(json.dumps(context, ensure_ascii=False).encode('utf-8'))
+            with self._lock:
+                self.snapshots += 1
+                self.snapshot_bytes += size
+                self.max_snapshot_bytes = max(self.max_snapshot_bytes, size)
+        return context
+
+    def forget(self, user_id):
+        with self._lock:
+            entry = self._users.pop(int(user_id), None)
+            if entry is None:
+                return False
+            self._drop_locked(entry)
+            return True
+
+    def memory_bytes(self):
+        """تقدير الذاكرة المستخدمة (الفهرس والحلقات والنصوص)"""
+        with self._lock:
+            return sys.getsizeof(self._users) + self._bytes
+
+    def stats(self):
+        size = self.memory_bytes()
+        with self._lock:
+            users = len(self._users)
+            turns = self._turns
+            snapshots = self.snapshots
+            snapshot_bytes = self.snapshot_bytes
+        return {
+            'users': users,
+            'turns': turns,
+            'evictions': self.evictions,
+            'approx_memory_kb': round(size / 1024, 1),
+            'bytes_per_user': round(size / users, 1) if users else 0,
+            'payloads': snapshots,
+            'avg_payload_bytes': round(snapshot_bytes / snapshots, 1) if snapshots else 0,
+            'max_payload_bytes': self.max_snapshot_bytes
+        }
@@ -0,0 +1,78 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+class UpdateDeduplicator:
+    """منع معالجة نفس التحديث مرتين عند إعادة إرسال Telegram له"""
+
+    def __init__(self, maxsize=50000, ttl=3600, shared=None, clock=time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        # مخزن مشترك اختياري بين العمال (يوفر claim_update / release_update)
+        self.shared = shared
+        self._clock = clock
+        self._seen = OrderedDict()
+        self._lock = threading.Lock()
+        self.duplicates = 0
+
+    @staticmethod
+    def keys_for(data):
+        """مفاتيح التحديث: update_id ومعرف callback_query إن وجد"""
+        keys = []
+        if data.get('update_id') is not None:
+            keys.append(f"u:{data['update_id']}")
+        callback_id = (data.get('callback_query') or {}).get('id')
+        if callback_id:
+            keys.append(f"cb:{callback_id}")
+        return keys
+
+    def _expire_locked(self, now):
+        while self._seen:
+            key, expires = next(iter(self._seen.items()))
+            if expires > now and len(self._seen) <= self.maxsize:
+                break
+            self._seen.popitem(last=False)
+
+    def claim(self, keys):
+        """تسجيل المفاتيح - يعيد False إذا كان أي منها قد عولج من قبل"""
+        if not keys:
+            return True
+        now = self._clock()
+        with self._lock:
+            self._expire_locked(now)
+            if any(key in self._seen for key in keys):
+                self.duplicates += 1
+                return False
+            for key in keys:
+                self._seen[key] = now + self.ttl
+
+        if self.shared is not None:
+            try:
+                if not self.shared.claim_update(keys, self.ttl):
+                    self.duplicates += 1
+                    return False
+            except Exception as e:
+                # عند تعذر الوصول للمخزن المشترك نكتفي بالذاكرة المحلية
+                logger.error(f"❌ خطأ في التحقق من تكرار التحديث: {e}")
+        return True
+
+    def release(self, keys):
+        """إلغاء التسجيل حتى يعاد معالجة التحديث إذا فشلت معالجته"""
+        with self._lock:
+            for key in keys:
+                self._seen.pop(key, None)
+        if self.shared is not None:
+            try:
+                self.shared.release_update(keys)
+            except Exception as e:
+                logger.error(f"❌ خطأ في إلغاء تسجيل التحديث: {e}")
+
+    def stats(self):
+        return {
+            'tracked': len(self._seen),
+            'duplicates': self.duplicates
+        }
@@ -0,0 +1,221 @@
+import asyncio
+import logging
+import queue
+import threading
+import zlib
+
+logger = logging.getLogger(__name__)
+
+
+class Dispatcher:
+    """طابور تنفيذ خلفي للعمليات الخارجية مع الحفاظ على ترتيب كل دردشة"""
+
+    def __init__(self, workers=4, maxsize=10000, name='dispatch'):
+        self.workers = max(1, int(workers))
+        self.name = name
+        # طابور مستقل لكل عامل: نفس الدردشة تذهب دائماً لنفس العامل فيبقى الترتيب محفوظاً
+        self._queues = [queue.Queue(maxsize=maxsize) for _ in range(self.workers)]
+        self._threads = []
+        self._lock = threading.Lock()
+        self._started = False
+        self.processed = 0
+        self.failed = 0
+        self.dropped = 0
+
+    def start(self):
+        """تشغيل العمال (مرة واحدة فقط)"""
+        with self._lock:
+            if self._started:
+                return
+            for index, jobs in enumerate(self._queues):
+                thread = threading.Thread(
+                    target=self._run,
+                    args=(jobs,),
+                    name=f"{self.name}-{index}",
+                    daemon=True
+                )
+                thread.start()
+                self._threads.append(thread)
+            self._started = True
+        logger.info(f"🚀 بدء نظام الإرسال الخلفي بعدد {self.workers} عامل")
+
+    def _shard(self, key):
+        if key is None:
+            return 0
+        return zlib.crc32(str(key).encode('utf-8')) % self.workers
+
+    def submit(self, key, func, *args, **kwargs):
+        """إضافة مهمة إلى الطابور - المهام بنفس المفتاح تنفذ بالترتيب"""
+        if not self._started:
+            self.start()
+        try:
+            self._queues[self._shard(key)].put_nowait((func, args, kwargs))
+            return True
+        except queue.Full:
+            self.dropped += 1
+            logger.error(f"❌ طابور الإرسال ممتلئ - تم إسقاط مهمة {getattr(func, '__name__', func)}")
+            return False
+
+    def _run(self, jobs):
+        while True:
+            func, args, kwargs = jobs.get()
+            try:
+                if func is None:
+                    return
+                func(*args, **kwargs)
+                self.processed += 1
+            except Exception as e:
+                self.failed += 1
+                logger.error(f"❌ خطأ في تنفيذ مهمة {getattr(func, '__name__', func)}: {e}")
+            finally:
+                jobs.task_done()
+
+    def depth(self):
+        """عدد المهام المنتظرة في جميع الطوابير"""
+        return sum(jobs.qsize() for jobs in self._queues)
+
+    def join(self):
+        """انتظار انتهاء جميع المهام الحالية"""
+        for jobs in self._queues:
+            jobs.join()
+
+    def stop(self):
+        """إيقاف العمال بعد إنهاء المهام المنتظرة"""
+        with self._lock:
+            if not self._started:
+                return
+            for jobs in self._queues:
+                jobs.put((None, (), {}))
+            for thread in self._threads:
+                thread.join()
+            self._threads = []
+            self._started = False
+
+    def stats(self):
+        return {
+            'workers': self.workers,
+            'queue_depth': self.depth(),
+            'processed': self.processed,
+            'failed': self.failed,
+            'dropped': self.dropped,
+            'mode': 'threads'
+        }
+
+
+class KeyedLocks:
+    """أقفال حسب المفتاح بعدد ثابت - نفس المفتاح يأخذ دائماً نفس القفل دون تخزين قفل لكل مفتاح"""
+
+    def __init__(self, stripes=64):
+        self._locks = [threading.Lock() for _ in range(max(1, int(stripes)))]
+
+    def lock_for(self, key):
+        return self._locks[zlib.crc32(str(key).encode('utf-8')) % len(self._locks)]
+
+
+def async_job(sync_func):
+    """ربط دالة async كبديل لمهمة متزامنة - AsyncDispatcher ينفذ البديل بدل الدالة الأصلية"""
+    def decorator(async_func):
+        sync_func.async_job = async_func
+        return async_func
+    return decorator
+
+
+class AsyncDispatcher:
+    """نسخة asyncio من Dispatcher: آلاف المهام المنتظرة بلا خيط لكل منها مع حفظ ترتيب كل دردشة
+
+    submit آمن من أي خيط. المهام المتزامنة التي ليس لها بديل async تنفذ في مجمع خيوط الحلقة."""
+
+    def __init__(self, loop, workers=256, maxsize=10000, name='async-dispatch'):
+        self.loop = loop
+        self.workers = max(1, int(workers))
+        self.name = name
+        self._queues = [asyncio.Queue(maxsize=maxsize) for _ in range(self.workers)]
+        self._tasks = []
+        self._loop_thread = None
+        self.processed = 0
+        self.failed = 0
+        self.dropped = 0
+
+    def start(self):
+        """تشغيل العمال - يستدعى من داخل الحلقة"""
+        if self._tasks:
+            return
+        self._loop_thread = threading.get_ident()
+        self._tasks = [self.loop.create_task(self._run(jobs)) for jobs in self._queues]
+        logger.info(f"🚀 بدء نظام الإرسال غير المتزامن بعدد {self.workers} عامل")
+
+    def _shard(self, key):
+        if key is None:
+            return 0
+        return zlib.crc32(str(key).encode('utf-8')) % self.workers
+
+    def _put(self, jobs, item):
+        try:
+            jobs.put_nowait(item)
+            return True
+        except asyncio.QueueFull:
+            self.dropped += 1
+            logger.error(f"❌ طابور الإرسال ممتلئ - تم إسقاط مهمة {getattr(item[0], '__name__', item[0])}")
+            return False
+
+    def submit(self, key, func, *args, **kwargs):
+        """إضافة مهمة إلى الطابور - المهام بنفس المفتاح تنفذ بالترتيب"""
+        jobs = self._queues[self._shard(key)]
+        item = (getattr(func, 'async_job', func), args, kwargs)
+        if threading.get_ident() == self._loop_thread:
+            return self._put(jobs, item)
+        # من خيط آخر (المجدول، المجمع، الاستطلاع) يجب المرور عبر الحلقة
+        self.loop.call_soon_threadsafe(self._put, jobs, item)
+        return True
+
+    async def _run(self, jobs):
+        while True:
+            func, args, kwargs = await jobs.get()
+            try:
+                if func is None:
+                    return
+                if asyncio.iscoroutinefunction(func):
+                    await func(*args, **kwargs)
+                else:
+                    await self.loop.run_in_executor(None, lambda: func(*args, **kwargs))
+                self.processed += 1
+            except Exception as e:
+                self.failed += 1
+                logger.error(f"❌ خطأ في تنفيذ مهمة {getattr(func, '__name__', func)}: {e}")
+            finally:
+                jobs.task_done()
+
+    def depth(self):
+        """عدد المهام المنتظرة في جميع الطوابير"""
+        return sum(jobs.qsize() for jobs in self._queues)
+
+    async def join(self):
+        """انتظار انتهاء جميع المهام الحالية"""
+        for jobs in self._queues:
+            await jobs.join()
+
+    async def stop(self, timeout=10.0):
+        """إيقاف العمال بعد إنهاء المهام المنتظرة - وإلغاء الباقي بعد المهلة"""
+        async def drain():
+            for jobs in self._queues:
+                await jobs.put((None, (), {}))
+            await asyncio.gather(*self._tasks)
+
+        try:
+            await asyncio.wait_for(drain(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"⚠️ إيقاف الإرسال غير المتزامن قبل إنهاء {self.depth()} مهمة منتظرة")
+            for task in self._tasks:
+                task.cancel()
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def stats(self):
+        return {
+            'workers': self.workers,
+            'queue_depth': self.depth(),
+            'processed': self.processed,
+            'failed': self.failed,
+            'dropped': self.dropped,
+            'mode': 'async'
+        }
@@ -0,0 +1,128 @@
+import sys
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+# قرارات التحكم في التدفق
+ALLOW = 'allow'
+WARN = 'warn'
+COOLDOWN = 'cooldown'
+MUTED = 'muted'
+
+FloodDecision = namedtuple('FloodDecision', ['action', 'cooldown', 'strikes'])
+_ALLOWED = FloodDecision(ALLOW, 0, 0)
+
+
+class _UserFlood:
+    """حالة مستخدم واحد - خمس خانات فقط لتبقى الذاكرة صغيرة مع مئات آلاف المستخدمين"""
+
+    __slots__ = ('tokens', 'updated', 'until', 'strikes', 'overflow')
+
+    def __init__(self, tokens, now):
+        self.tokens = tokens
+        self.updated = now
+        self.until = 0.0
+        self.strikes = 0
+        self.overflow = 0
+
+
+class FloodController:
+    """تحديد معدل رسائل كل مستخدم: دلو رموز، تحذير لطيف، ثم إيقاف مؤقت متصاعد"""
+
+    def __init__(self, rate=0.2, burst=5, cooldowns=(30, 120, 600), soft_warnings=1,
+                 strike_reset=3600, prune_interval=60, prune_batch=100, clock=time.monotonic):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        # مدد الإيقاف حسب عدد المخالفات السابقة (آخر مدة تتكرر)
+        self.cooldowns = tuple(float(seconds) for seconds in cooldowns) or (60.0,)
+        # عدد الرسائل الزائدة المسموح بها مع تحذير قبل الإيقاف
+        self.soft_warnings = soft_warnings
+        # تنسى المخالفات بعد هذه المدة من الهدوء
+        self.strike_reset = strike_reset
+        self.prune_interval = prune_interval
+        self.prune_batch = prune_batch
+        self._clock = clock
+        # مرتبة حسب آخر رسالة (الأقدم نشاطاً أولاً) فيبدأ التنظيف منها دون المرور على الجميع
+        self._users = OrderedDict()
+        self._lock = threading.Lock()
+        self._pruned = clock()
+        self.counts = {ALLOW: 0, WARN: 0, COOLDOWN: 0, MUTED: 0}
+
+    def _prune_step_locked(self, now):
+        # حذف المستخدمين الخاملين (الدلو ممتلئ ولا مخالفات حديثة) من بداية الترتيب على دفعات صغيرة
+        # حتى لا يتوقف أي طلب لفحص مئات آلاف المستخدمين دفعة واحدة
+        if now - self._pruned < self.prune_interval:
+            return
+        full_after = self.burst / self.rate if self.rate > 0 else 0
+        for _ in range(self.prune_batch):
+            if not self._users:
+                break
+            user_id = next(iter(self._users))
+            entry = self._users[user_id]
+            if now - entry.updated < full_after:
+                # كل من بعده أحدث نشاطاً
+                break
+            if now - entry.until >= self.strike_reset:
+                del self._users[user_id]
+            else:
+                # خامل لكن مخالفته حديثة: يبقى ويؤجل فحصه للجولة التالية
+                self._users.move_to_end(user_id)
+        else:
+            # الدفعة لم تكمل الجولة - المتابعة مع الطلب التالي
+            return
+        self._pruned = now
+
+    def check(self, user_id):
+        """تسجيل رسالة والتحقق من السماح بها - يعيد FloodDecision"""
+        user_id = int(user_id)
+        with self._lock:
+            now = self._clock()
+            self._prune_step_locked(now)
+
+            entry = self._users.get(user_id)
+            if entry is None:
+                entry = self._users[user_id] = _UserFlood(self.burst, now)
+            else:
+                self._users.move_to_end(user_id)
+
+            if entry.until > now:
+                self.counts[MUTED] += 1
+                return FloodDecision(MUTED, entry.until - now, entry.strikes)
+
+            if entry.strikes and now - entry.until >= self.strike_reset:
+                entry.strikes = 0
+
+            entry.tokens = min(self.burst, entry.tokens + (now - entry.updated) * self.rate)
+            entry.updated = now
+            if entry.tokens >= 1.0:
+                entry.tokens -= 1.0
+                entry.overflow = 0
+                self.counts[ALLOW] += 1
+                return _ALLOWED
+
+            entry.overflow += 1
+            if entry.overflow <= self.soft_warnings:
+                self.counts[WARN] += 1
+                return FloodDecision(WARN, 0, entry.strikes)
+
+            # تجاوز مستمر: إيقاف مؤقت بمدة تتصاعد مع تكرار المخالفة
+            cooldown = self.cooldowns[min(entry.strikes, len(self.cooldowns) - 1)]
+            entry.strikes += 1
+            entry.overflow = 0
+            entry.until = now + cooldown
+            self.counts[COOLDOWN] += 1
+            return FloodDecision(COOLDOWN, cooldown, entry.strikes)
+
+    def stats(self):
+        with self._lock:
+            tracked = len(self._users)
+            sample = next(iter(self._users.values()), None)
+            counts = dict(self.counts)
+        # تقدير تقريبي (مطابق لقياس tracemalloc ~250 بايت): الكائن + مفتاح int + عددان عشريان
+        # + خانة القاموس + عقدة ترتيب OrderedDict
+        per_user = (sys.getsizeof(sample) + 28 + 2 * 24 + 56 + 48) if sample is not None else 0
+        return {
+            'tracked_users': tracked,
+            'approx_memory_kb': round(tracked * per_user / 1024, 1),
+            'decisions': counts
+        }
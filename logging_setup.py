@@ -0,0 +1,118 @@
+import atexit
+import json
+import logging
+import logging.handlers
+import queue
+import random
+from datetime import datetime, timezone
+
+TEXT_FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+
+
+class JsonFormatter(logging.Formatter):
+    """تنسيق السجل كسطر JSON واحد"""
+
+    def format(self, record):
+        entry = {
+            'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+            'thread': record.threadName
+        }
+        # الحقول الإضافية الممررة عبر extra={'fields': {...}}
+        fields = getattr(record, 'fields', None)
+        if fields:
+            entry.update(fields)
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class SamplingFilter(logging.Filter):
+    """أخذ عينة من السجلات المزعجة (المعلمة بـ extra={'sampled': True}) حسب مستواها"""
+
+    def __init__(self, rates=None, loggers=()):
+        super().__init__()
+        # سجلات مكتبات تعامل كلها كمزعجة (مثل سجل طلبات werkzeug)
+        self.loggers = frozenset(loggers)
+        # مثال: {'INFO': 0.1, 'DEBUG': 0.01} - المستويات غير المذكورة تمر كاملة
+        self.rates = {logging.getLevelName(level) if isinstance(level, int) else level.upper(): rate
+                      for level, rate in (rates or {}).items()}
+        self.dropped = 0
+
+    def filter(self, record):
+        if not getattr(record, 'sampled', False) and record.name not in self.loggers:
+            return True
+        rate = self.rates.get(record.levelname, 1.0)
+        if rate >= 1.0 or random.random() < rate:
+            return True
+        self.dropped += 1
+        return False
+
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """يضع السجل في الطابور دون تنسيقه - التنسيق والكتابة في خيط الخلفية"""
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # السجل يبقى داخل نفس العملية فلا حاجة لتنسيق الرسالة أو تحويلها هنا
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            # عند امتلاء الطابور نتخلى عن السجل بدل إبطاء الطلب
+            self.dropped += 1
+
+
+def setup_logging(level=logging.INFO, log_file='bot.log', fmt='json', max_bytes=10 * 1024 * 1024,
+                  backup_count=5, rotate_when=None, sample_rates=None, sampled_loggers=('werkzeug',),
+                  queue_size=10000):
+    """تهيئة السجلات: طابور غير حاجب على الخيط الطالب، وكتابة وتدوير في خيط خلفي"""
+    formatter = JsonFormatter() if fmt == 'json' else logging.Formatter(TEXT_FORMAT)
+
+    handlers = [logging.StreamHandler()]
+    if log_file:
+        if rotate_when:
+            # تدوير زمني (مثل 'midnight' أو 'H')
+            handlers.append(logging.handlers.TimedRotatingFileHandler(
+                log_file, when=rotate_when, backupCount=backup_count, encoding='utf-8'))
+        else:
+            handlers.append(logging.handlers.RotatingFileHandler(
+                log_file, maxBytes=max_bytes, backupCount=backup_count, encoding='utf-8'))
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    log_queue = queue.Queue(maxsize=queue_size)
+    queue_handler = NonBlockingQueueHandler(log_queue)
+    sampler = SamplingFilter(sample_rates, sampled_loggers)
+    # التصفية قبل الطابور حتى لا تستهلك السجلات المستبعدة مكاناً فيه
+    queue_handler.addFilter(sampler)
+
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    root.setLevel(level)
+
+    listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+
+    listener.queue_handler = queue_handler
+    listener.sampler = sampler
+    return listener
+
+
+def logging_stats(listener):
+    """إحصائيات خط السجلات لـ /health"""
+    return {
+        'queued': listener.queue.qsize(),
+        'dropped_full': listener.queue_handler.dropped,
+        'dropped_sampled': listener.sampler.dropped
+    }
@@ -1,36 +1,182 @@
 import os
+import asyncio
+import hmac
+import html
 import logging
 import requests
-import json
 import re
 from datetime import datetime
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, Response
 import threading
 import time
 
-# تكوين السجلات
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.StreamHandler(),
-        logging.FileHandler('bot.log', encoding='utf-8')
-    ]
+try:
+    from aiohttp import web
+    import aiohttp
+except ImportError:
+    # مطلوب فقط عند SERVER_MODE=async
+    aiohttp = web = None
+
+from dispatcher import Dispatcher, AsyncDispatcher, KeyedLocks, async_job
+from logging_setup import setup_logging, logging_stats
+from metrics import Registry, timed, CONTENT_TYPE as METRICS_CONTENT_TYPE
+from dedup import UpdateDeduplicator
+from coalescer import MessageCoalescer
+from poller import UpdatePoller
+from outbox import CircuitBreaker, OutboxReplayer, open_outbox, DELIVERED, RETRY, REJECTED
+from violations import ViolationEngine
+from answer_cache import AnswerCache
+from conversation_context import ConversationContext, USER as CONTEXT_USER, ASSISTANT as CONTEXT_ASSISTANT
+from media import MediaForwarder, extract_media, QUEUED as MEDIA_QUEUED, DELIVERED as MEDIA_DELIVERED, \
+    TOO_LARGE as MEDIA_TOO_LARGE, DUPLICATE as MEDIA_DUPLICATE, BUSY as MEDIA_BUSY
+from broadcast import Broadcast, classify_response as classify_broadcast_response, RETRY as BROADCAST_RETRY
+from flood_control import FloodController, WARN as FLOOD_WARN, COOLDOWN as FLOOD_COOLDOWN, ALLOW as FLOOD_ALLOW
+from state_store import create_state_store, PendingSweeper, BAN_THRESHOLD
+from approval_digest import (ApprovalDigest, parse_callback as parse_digest_callback,
+                             APPROVED as DIGEST_APPROVED, REJECTED as DIGEST_REJECTED,
+                             RESOLVED as DIGEST_RESOLVED, EXPIRED as DIGEST_EXPIRED)
+from rate_limiter import OutboundScheduler, PRIORITY_APPROVAL, PRIORITY_WARNING, PRIORITY_ACK, PRIORITY_BULK
+from telegram_client import TelegramClient, AsyncTelegramClient, FloodWait
+
+# تكوين السجلات: طابور غير حاجب وكتابة JSON مع تدوير في خيط خلفي
+log_listener = setup_logging(
+    level=os.getenv('LOG_LEVEL', 'INFO').upper(),
+    log_file=os.getenv('LOG_FILE', 'bot.log'),
+    fmt=os.getenv('LOG_FORMAT', 'json'),
+    max_bytes=int(os.getenv('LOG_MAX_BYTES', str(10 * 1024 * 1024))),
+    backup_count=int(os.getenv('LOG_BACKUP_COUNT', '5')),
+    rotate_when=os.getenv('LOG_ROTATE_WHEN') or None,
+    sample_rates={'INFO': float(os.getenv('LOG_INFO_SAMPLE_RATE', '1.0'))}
 )
 logger = logging.getLogger(__name__)
 
+# سجلات تتكرر مع كل رسالة - تخضع لأخذ العينات حسب LOG_INFO_SAMPLE_RATE
+SAMPLED = {'sampled': True}
+
 app = Flask(__name__)
 
 # المتغيرات البيئية
 TELEGRAM_TOKEN = os.getenv('TELEGRAM_TOKEN', '')
 MANAGER_CHAT_ID = os.getenv('MANAGER_CHAT_ID', '')
+# معرفات المديرين المسموح لهم بالأوامر (مفصولة بفواصل) - افتراضياً صاحب دردشة المدير الخاصة
+MANAGER_USER_IDS = {uid.strip() for uid in os.getenv('MANAGER_USER_IDS', MANAGER_CHAT_ID).split(',') if uid.strip()}
 N8N_WEBHOOK_URL = os.getenv('N8N_WEBHOOK_URL', '')
 APP_URL = os.getenv('RAILWAY_STATIC_URL', '') or os.getenv('APP_URL', '')
 PORT = os.getenv('PORT', '5000')
+DISPATCH_WORKERS = int(os.getenv('DISPATCH_WORKERS', '4'))
+TELEGRAM_API_URL = os.getenv('TELEGRAM_API_URL', 'https://api.telegram.org')
+OUTBOUND_GLOBAL_RATE = float(os.getenv('OUTBOUND_GLOBAL_RATE', '30'))
+OUTBOUND_MAX_WAIT = float(os.getenv('OUTBOUND_MAX_WAIT', '60'))
+STATE_BACKEND = os.getenv('STATE_BACKEND', 'sqlite')
+STATE_DB_PATH = os.getenv('STATE_DB_PATH', 'bot_state.db')
+DEDUP_TTL = int(os.getenv('DEDUP_TTL', '3600'))
+DEDUP_MAX_ENTRIES = int(os.getenv('DEDUP_MAX_ENTRIES', '50000'))
+COALESCE_WINDOW = float(os.getenv('COALESCE_WINDOW', '0'))
+COALESCE_MAX_WAIT = float(os.getenv('COALESCE_MAX_WAIT', '10'))
+INGESTION_MODE = os.getenv('INGESTION_MODE', 'webhook')
+POLL_OFFSET_PATH = os.getenv('POLL_OFFSET_PATH', 'telegram_offset.json')
+POLL_WORKERS = int(os.getenv('POLL_WORKERS', '8'))
+OUTBOX_DIR = os.getenv('OUTBOX_DIR', 'outbox')
+OUTBOX_REPLAY_CONCURRENCY = int(os.getenv('OUTBOX_REPLAY_CONCURRENCY', '4'))
+FASL_BREAKER_THRESHOLD = int(os.getenv('FASL_BREAKER_THRESHOLD', '5'))
+FASL_BREAKER_RESET = float(os.getenv('FASL_BREAKER_RESET', '30'))
+FLOOD_RATE = float(os.getenv('FLOOD_RATE', '0'))
+FLOOD_BURST = int(os.getenv('FLOOD_BURST', '5'))
+FLOOD_COOLDOWNS = [float(item) for item in os.getenv('FLOOD_COOLDOWNS', '30,120,600').split(',') if item.strip()]
+PENDING_TTL = float(os.getenv('PENDING_TTL', str(2 * 24 * 3600)))
+PENDING_REMIND_AFTER = float(os.getenv('PENDING_REMIND_AFTER', str(6 * 3600)))
+PENDING_SWEEP_INTERVAL = float(os.getenv('PENDING_SWEEP_INTERVAL', '60'))
+TELEGRAM_WEBHOOK_SECRET = os.getenv('TELEGRAM_WEBHOOK_SECRET', '')
+ANSWER_CACHE_SIZE = int(os.getenv('ANSWER_CACHE_SIZE', '5000'))
+ANSWER_CACHE_TTL = float(os.getenv('ANSWER_CACHE_TTL', str(24 * 3600)))
+CONTEXT_MAX_USERS = int(os.getenv('CONTEXT_MAX_USERS', '10000'))
+CONTEXT_MAX_TURNS = int(os.getenv('CONTEXT_MAX_TURNS', '6'))
+CONTEXT_MAX_CHARS = int(os.getenv('CONTEXT_MAX_CHARS', '2000'))
+CONTEXT_MAX_AGE = float(os.getenv('CONTEXT_MAX_AGE', str(6 * 3600)))
+MEDIA_UPLOAD_URL = os.getenv('MEDIA_UPLOAD_URL', '') or N8N_WEBHOOK_URL
+MEDIA_MAX_BYTES = int(os.getenv('MEDIA_MAX_BYTES', str(20 * 1024 * 1024)))
+MEDIA_CONCURRENCY = int(os.getenv('MEDIA_CONCURRENCY', '2'))
+BROADCAST_CHECKPOINT = os.getenv('BROADCAST_CHECKPOINT', 'broadcast.json')
+BROADCAST_CONCURRENCY = int(os.getenv('BROADCAST_CONCURRENCY', '8'))
+BROADCAST_BATCH = int(os.getenv('BROADCAST_BATCH', '50'))
+BROADCAST_REPORT_INTERVAL = float(os.getenv('BROADCAST_REPORT_INTERVAL', '60'))
+APPROVAL_MODE = os.getenv('APPROVAL_MODE', 'single')
+APPROVAL_DIGEST_WINDOW = float(os.getenv('APPROVAL_DIGEST_WINDOW', '30'))
+APPROVAL_DIGEST_PAGE_SIZE = int(os.getenv('APPROVAL_DIGEST_PAGE_SIZE', '10'))
+SERVER_MODE = os.getenv('SERVER_MODE', 'flask')
+ASYNC_WORKERS = int(os.getenv('ASYNC_WORKERS', '256'))
+VIOLATION_RULES_PATH = os.getenv(
+    'VIOLATION_RULES_PATH',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'violation_rules.json')
+)
+
+# تخزين البيانات (التحذيرات وطلبات الموافقة) - مشترك بين العمال عند استخدام SQLite
+state = create_state_store(STATE_BACKEND, STATE_DB_PATH)
+
+# منع معالجة التحديثات المكررة (update_id و callback_query.id)
+dedup = UpdateDeduplicator(maxsize=DEDUP_MAX_ENTRIES, ttl=DEDUP_TTL, shared=state)
+
+# محرك كشف المخالفات (يعاد تحميل القواعد تلقائياً عند تعديل الملف)
+violation_engine = ViolationEngine(VIOLATION_RULES_PATH)
+
+# تحديد معدل رسائل كل مستخدم قبل إرسالها إلى Fasl AI (معطل افتراضياً - فعّله بـ FLOOD_RATE=0.2 مثلاً)
+flood_control = FloodController(
+    rate=FLOOD_RATE, burst=FLOOD_BURST, cooldowns=FLOOD_COOLDOWNS
+) if FLOOD_RATE > 0 else None
+
+# ذاكرة إجابات Fasl AI للأسئلة المتكررة (معطلة إذا كانت ANSWER_CACHE_SIZE = 0)
+answer_cache = AnswerCache(maxsize=ANSWER_CACHE_SIZE, ttl=ANSWER_CACHE_TTL, shared=state) if ANSWER_CACHE_SIZE > 0 else None
+
+# آخر رسائل كل مستخدم وإجاباتها ترسل مع الطلب حتى لا يبحث n8n عن السجل (معطل إذا كانت CONTEXT_MAX_TURNS = 0)
+conversation_context = ConversationContext(
+    max_users=CONTEXT_MAX_USERS, max_turns=CONTEXT_MAX_TURNS,
+    max_chars=CONTEXT_MAX_CHARS, max_age=CONTEXT_MAX_AGE
+) if CONTEXT_MAX_TURNS > 0 and CONTEXT_MAX_USERS > 0 else None
+
+# قاطع دائرة لـ n8n وصندوق صادر دائم للرسائل التي لم تسلم
+fasl_breaker = CircuitBreaker(failure_threshold=FASL_BREAKER_THRESHOLD, reset_timeout=FASL_BREAKER_RESET)
+fasl_outbox = open_outbox(OUTBOX_DIR)
 
-# تخزين البيانات
-user_warnings = {}
-pending_approvals = {}
+# طابور الإرسال الخلفي - الرد على Telegram فوراً وتنفيذ الاتصالات الخارجية لاحقاً
+dispatcher = Dispatcher(workers=DISPATCH_WORKERS)
+
+# قفل لكل مستخدم مستهدف بقرار المدير - الضغطات المتزامنة على نفس الطلب لا تتداخل
+decision_locks = KeyedLocks()
+
+# جدولة الرسائل الصادرة وفق حدود Telegram (30/ث عام، 1/ث لكل دردشة، 20/د لكل مجموعة)
+# (التنفيذ عبر dispatcher الحالي وقت المنح حتى يعمل مع الطابور غير المتزامن أيضاً)
+outbound = OutboundScheduler(
+    global_rate=OUTBOUND_GLOBAL_RATE,
+    executor=lambda chat_id, func, *args, **kwargs: dispatcher.submit(chat_id, func, *args, **kwargs)
+)
+
+# عميل Telegram مشترك مع اتصالات دائمة
+telegram = TelegramClient(TELEGRAM_TOKEN, base_url=TELEGRAM_API_URL)
+telegram.on_flood = outbound.penalize
+
+# المقاييس المصدرة على /metrics بصيغة Prometheus
+metrics = Registry()
+function_latency = metrics.histogram(
+    'bot_function_duration_seconds', 'Latency of instrumented bot functions', ('function',))
+webhook_latency = metrics.histogram(
+    'bot_webhook_duration_seconds', 'Latency of the /webhook endpoint by outcome', ('status',))
+update_outcomes = metrics.counter(
+    'bot_updates_total', 'Processed Telegram updates by outcome', ('status',))
+outbound_responses = metrics.counter(
+    'bot_outbound_http_responses_total', 'Outbound HTTP responses by service, method and status code',
+    ('service', 'method', 'code'))
+metrics.gauge('bot_dispatch_queue_depth', 'Jobs waiting in the dispatch queues', lambda: dispatcher.depth())
+metrics.gauge('bot_outbound_queue_depth', 'Messages waiting for an outbound rate-limit slot',
+              lambda: outbound.depth())
+metrics.gauge('bot_fasl_outbox_depth', 'Undelivered Fasl AI messages in the outbox', lambda: fasl_outbox.depth())
+telegram.on_response = lambda method, code: outbound_responses.inc('telegram', method, code)
+# انتظار الدور في حدود الإرسال مرحلة مستقلة عن زمن طلب HTTP
+outbound_wait = metrics.histogram(
+    'bot_outbound_wait_seconds', 'Time spent waiting for an outbound rate-limit slot by priority', ('priority',))
+OUTBOUND_PRIORITY_NAMES = {PRIORITY_APPROVAL: 'approval', PRIORITY_WARNING: 'warning',
+                           PRIORITY_ACK: 'ack', PRIORITY_BULK: 'bulk'}
+outbound.on_wait = lambda priority, seconds: outbound_wait.observe(
+    seconds, OUTBOUND_PRIORITY_NAMES.get(priority, str(priority)))
 
 def set_telegram_webhook():
     """تعيين webhook لـ Telegram"""
@@ -40,78 +186,73 @@ def set_telegram_webhook():
             return False
             
         webhook_url = f"{APP_URL}/webhook"
-        url = f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/setWebhook"
-        payload = {
-            'url': webhook_url,
-            'drop_pending_updates': True,
-            'allowed_updates': ['message', 'callback_query']
-        }
-        
-        response = requests.post(url, json=payload, timeout=10)
-        if response.status_code == 200:
+        if telegram.set_webhook(webhook_url) is not None:
             logger.info(f"✅ تم تعيين webhook: {webhook_url}")
             return True
         else:
-            logger.error(f"❌ فشل تعيين webhook: {response.text}")
+            logger.error(f"❌ فشل تعيين webhook: {webhook_url}")
             return False
     except Exception as e:
         logger.error(f"❌ خطأ في تعيين webhook: {e}")
         return False
 
-def send_telegram_message(chat_id, text, parse_mode='HTML', reply_markup=None):
+def send_telegram_message(chat_id, text, parse_mode='HTML', reply_markup=None,
+                          priority=PRIORITY_ACK, throttled=True):
     """إرسال رسالة إلى Telegram"""
     try:
         if not TELEGRAM_TOKEN or not chat_id or not text:
             return False
+
+        # انتظار الدور حسب حدود الإرسال (إلا إذا كانت الرسالة قد جدولت مسبقاً)
+        if throttled and not outbound.acquire(chat_id, priority, timeout=OUTBOUND_MAX_WAIT):
+            logger.error(f"❌ تجاوز مهلة حدود الإرسال للدردشة {chat_id}")
+            return False
             
-        url = f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/sendMessage"
-        payload = {
-            'chat_id': chat_id,
-            'text': str(text)[:4000],
-            'parse_mode': parse_mode
-        }
-        
-        if reply_markup:
-            payload['reply_markup'] = reply_markup
-        
-        response = requests.post(url, json=payload, timeout=10)
-        return response.status_code == 200
-        
+        # الزمن المقاس هو طلب HTTP فقط - انتظار الدور يسجل في bot_outbound_wait_seconds
+        with function_latency.time('send_telegram_message'):
+            return telegram.send_message(chat_id, text, parse_mode, reply_markup, reschedule=True) is not None
+
+    except FloodWait as e:
+        # عقوبة الدردشة في المجدول تؤخر الإعادة بدل انتظار المهلة داخل العامل
+        log_flood_reschedule(e)
+        return queue_message(chat_id, text, parse_mode, reply_markup, priority)
     except Exception as e:
         logger.error(f"❌ خطأ في إرسال الرسالة: {e}")
         return False
 
+def log_flood_reschedule(error):
+    logger.warning(f"⏳ إعادة جدولة {error.method} للدردشة {error.chat_id} بعد 429 ({error.retry_after:g} ثانية)")
+
+def queue_message(chat_id, text, parse_mode='HTML', reply_markup=None, priority=PRIORITY_ACK):
+    """إضافة رسالة إلى طابور الإرسال الخلفي حسب أولويتها"""
+    return outbound.submit(chat_id, priority, send_telegram_message,
+                           chat_id, text, parse_mode, reply_markup, priority, False)
+
 def answer_callback_query(callback_id, text=None):
     """الرد على callback query"""
     try:
-        url = f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/answerCallbackQuery"
-        payload = {
-            'callback_query_id': callback_id
-        }
-        if text:
-            payload['text'] = text
-            
-        response = requests.post(url, json=payload, timeout=5)
-        return response.status_code == 200
+        return telegram.answer_callback_query(callback_id, text) is not None
     except Exception as e:
         logger.error(f"❌ خطأ في answer_callback_query: {e}")
         return False
 
-def edit_message_reply_markup(chat_id, message_id):
+def edit_message_reply_markup(chat_id, message_id, throttled=True):
     """تعديل الرسالة لإزالة الأزرار"""
     try:
-        url = f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/editMessageReplyMarkup"
-        payload = {
-            'chat_id': chat_id,
-            'message_id': message_id,
-            'reply_markup': {'inline_keyboard': []}
-        }
-        response = requests.post(url, json=payload, timeout=5)
-        return response.status_code == 200
+        if throttled and not outbound.acquire(chat_id, PRIORITY_APPROVAL, timeout=OUTBOUND_MAX_WAIT):
+            return False
+        return telegram.edit_message_reply_markup(chat_id, message_id, reschedule=True) is not None
+    except FloodWait as e:
+        log_flood_reschedule(e)
+        return queue_edit_reply_markup(chat_id, message_id)
     except Exception as e:
         logger.error(f"❌ خطأ في تعديل الرسالة: {e}")
         return False
 
+def queue_edit_reply_markup(chat_id, message_id):
+    """إضافة إزالة الأزرار إلى طابور الإرسال الخلفي"""
+    return outbound.submit(chat_id, PRIORITY_APPROVAL, edit_message_reply_markup, chat_id, message_id, False)
+
 def create_approval_buttons(user_id):
     """إنشاء أزرار الموافقة والرفض"""
     return {
@@ -129,16 +270,9 @@ def create_approval_buttons(user_id):
         ]
     }
 
-def send_approval_request(user_id, user_name, chat_id):
-    """إرسال طلب موافقة للمدير"""
-    try:
-        if not MANAGER_CHAT_ID:
-            logger.error("❌ معرف مدير غير موجود")
-            return False
-            
-        buttons = create_approval_buttons(user_id)
-        
-        message_text = f"""
+def approval_request_text(user_id, user_name, chat_id):
+    """نص طلب الموافقة المرسل للمدير"""
+    return f"""
 👤 طلب انضمام جديد
 
 🆔 المعرف: {user_id}
@@ -147,15 +281,19 @@ def send_approval_request(user_id, user_name, chat_id):
 
 يرجى الموافقة أو الرفض:
         """
+
+def send_approval_request(user_id, user_name, chat_id, throttled=True):
+    """إرسال طلب موافقة للمدير"""
+    try:
+        if not MANAGER_CHAT_ID:
+            logger.error("❌ معرف مدير غير موجود")
+            return False
+            
+        buttons = create_approval_buttons(user_id)
+        message_text = approval_request_text(user_id, user_name, chat_id)
         
-        # حفظ بيانات الانتظار للموافقة
-        pending_approvals[str(user_id)] = {
-            'user_name': user_name,
-            'chat_id': chat_id,
-            'timestamp': datetime.now().isoformat()
-        }
-        
-        success = send_telegram_message(MANAGER_CHAT_ID, message_text, reply_markup=buttons)
+        success = send_telegram_message(MANAGER_CHAT_ID, message_text, reply_markup=buttons,
+                                        priority=PRIORITY_APPROVAL, throttled=throttled)
         if success:
             logger.info(f"✅ تم إرسال طلب موافقة للمدير للمستخدم {user_id}")
         return success
@@ -164,80 +302,269 @@ def send_approval_request(user_id, user_name, chat_id):
         logger.error(f"❌ خطأ في إرسال طلب الموافقة: {e}")
         return False
 
-def handle_user_approval(user_id, chat_id, message_id):
-    """معالجة قبول المستخدم"""
+APPROVAL_SENT_MESSAGE = "⏳ تم إرسال طلب الانضمام للمدير، يرجى الانتظار للموافقة..."
+APPROVAL_FAILED_MESSAGE = "⚠️ حدث خطأ في إرسال طلب الانضمام. يرجى إرسال رسالة جديدة لاحقاً لإعادة المحاولة."
+
+def approval_delivered(user_id, chat_id, success):
+    """إبلاغ المستخدم بنتيجة إرسال طلبه - عند الفشل يلغى الطلب حتى لا يبقى منتظراً دون علم المدير"""
+    if success:
+        queue_message(chat_id, APPROVAL_SENT_MESSAGE)
+        return
+    state.cancel_pending(user_id)
+    queue_message(chat_id, APPROVAL_FAILED_MESSAGE)
+
+def deliver_approval_request(user_id, user_name, chat_id):
+    """مهمة خلفية بعد منح دور الإرسال: إرسال طلب الموافقة للمدير ثم إبلاغ المستخدم بالنتيجة"""
+    approval_delivered(user_id, chat_id, send_approval_request(user_id, user_name, chat_id, throttled=False))
+
+def queue_approval_request(user_id, user_name, chat_id):
+    """جدولة طلب الموافقة في حدود إرسال دردشة المدير دون حجز عامل أثناء الانتظار"""
+    if not MANAGER_CHAT_ID:
+        logger.error("❌ معرف مدير غير موجود")
+        approval_delivered(user_id, chat_id, False)
+        return False
+    return outbound.submit(MANAGER_CHAT_ID, PRIORITY_APPROVAL, deliver_approval_request, user_id, user_name, chat_id)
+
+def remind_approval_request(user_id, user_data):
+    """مهمة خلفية: إعادة إرسال طلب موافقة لم يراجعه المدير"""
+    if not MANAGER_CHAT_ID:
+        return False
+    hours = PENDING_REMIND_AFTER / 3600
+    message_text = f"⏰ تذكير: طلب لم تتم مراجعته منذ {hours:g} ساعة\n" + approval_request_text(
+        user_id, user_data.get('user_name', ''), user_data.get('chat_id'))
+    return queue_message(MANAGER_CHAT_ID, message_text, reply_markup=create_approval_buttons(user_id),
+                         priority=PRIORITY_APPROVAL)
+
+def schedule_approval_reminder(user_id, user_data):
+    """تذكير المدير بطلب متأخر: ضمن القائمة التالية في وضع القوائم أو كرسالة مستقلة"""
+    if approval_digest is not None:
+        approval_digest.add(user_id, user_data.get('user_name', ''), user_data.get('chat_id'))
+    else:
+        dispatcher.submit(MANAGER_CHAT_ID, remind_approval_request, user_id, user_data)
+
+def notify_pending_expired(user_id, user_data):
+    """مهمة خلفية: إبلاغ المستخدم والمدير بانتهاء صلاحية طلب الانضمام"""
+    user_chat_id = user_data.get('chat_id')
+    if user_chat_id:
+        queue_message(user_chat_id, "⌛ انتهت صلاحية طلب انضمامك دون مراجعة. أرسل رسالة جديدة لإعادة التقديم.")
+    if approval_digest is not None:
+        # في وضع القوائم يظهر الانتهاء في القائمة نفسها بدل رسالة لكل مستخدم
+        mark_in_digests(user_id, DIGEST_EXPIRED)
+    elif MANAGER_CHAT_ID:
+        queue_message(MANAGER_CHAT_ID, f"⌛ انتهت صلاحية طلب المستخدم {user_id} دون مراجعة",
+                      priority=PRIORITY_APPROVAL)
+
+def join_decision_user_text(approved):
+    """نص إشعار المستخدم بقرار المدير"""
+    if approved:
+        return "🎉 تم قبول طلب انضمامك! يمكنك الآن استخدام البوت.\n\nأرسل رسالتك وسأقوم بالرد عليك."
+    return "❌ تم رفض طلب انضمامك. لا يمكنك استخدام هذا البوت."
+
+def join_decision_messages(user_id_str, user_data, chat_id, approved):
+    """رسائل تأكيد قرار المدير: [(chat_id, النص، الأولوية)]"""
+    if approved:
+        messages = [(chat_id, f"✅ تم قبول المستخدم {user_id_str} بنجاح", PRIORITY_APPROVAL)]
+    else:
+        messages = [(chat_id, f"❌ تم رفض المستخدم {user_id_str}", PRIORITY_APPROVAL)]
+    user_chat_id = user_data.get('chat_id')
+    if user_chat_id:
+        messages.append((user_chat_id, join_decision_user_text(approved), PRIORITY_ACK))
+    return messages
+
+def apply_join_decision(user_id, approved):
+    """تطبيق قرار المدير على الحالة تحت قفل المستخدم - يعيد بيانات الطلب أو None إذا عولج مسبقاً"""
+    with decision_locks.lock_for(user_id):
+        # القرار الأول فقط يُنفذ (ضغط مكرر أو قرار من رسالة أو عامل آخر)
+        user_data = state.resolve_pending(user_id, 0 if approved else BAN_THRESHOLD)
+        if user_data is not None:
+            mark_in_digests(user_id, DIGEST_APPROVED if approved else DIGEST_REJECTED)
+        return user_data
+
+def decide_join_request(user_id, chat_id, message_id, approved):
+    """تنفيذ قرار المدير: تحديث الحالة فوراً ثم جدولة الإشعارات وإزالة الأزرار بالتوازي
+
+    يعيد True عند تنفيذ القرار، False إذا عولج الطلب مسبقاً، وNone عند الخطأ."""
     try:
         user_id_str = str(user_id)
-        
-        # تحديث حالة المستخدم
-        user_warnings[user_id_str] = 0
-        
-        # إرسال رسالة تأكيد للمدير
-        send_telegram_message(
-            chat_id,
-            f"✅ تم قبول المستخدم {user_id_str} بنجاح"
-        )
-        
-        # إرسال رسالة ترحيب للمستخدم
-        user_data = pending_approvals.get(user_id_str, {})
-        user_chat_id = user_data.get('chat_id')
-        if user_chat_id:
-            send_telegram_message(
-                user_chat_id,
-                "🎉 تم قبول طلب انضمامك! يمكنك الآن استخدام البوت.\n\nأرسل رسالتك وسأقوم بالرد عليك."
-            )
-        
-        # تعديل الرسالة الأصلية لإزالة الأزرار
-        edit_message_reply_markup(chat_id, message_id)
-        
-        # إزالة من قائمة الانتظار
-        if user_id_str in pending_approvals:
-            del pending_approvals[user_id_str]
-        
-        logger.info(f"✅ تم قبول المستخدم {user_id_str}")
+
+        user_data = apply_join_decision(user_id, approved)
+
+        # إزالة الأزرار في الحالتين - الرسالة لم تعد تقبل قراراً
+        queue_edit_reply_markup(chat_id, message_id)
+        if user_data is None:
+            logger.info(f"ℹ️ طلب المستخدم {user_id_str} تمت معالجته مسبقاً")
+            return False
+
+        # كل رسالة تجدول مستقلة: إشعار المستخدم لا ينتظر تأكيد المدير
+        for target_chat_id, text, priority in join_decision_messages(user_id_str, user_data, chat_id, approved):
+            queue_message(target_chat_id, text, priority=priority)
+
+        logger.info(f"{'✅ تم قبول' if approved else '❌ تم رفض'} المستخدم {user_id_str}")
         return True
-        
+
     except Exception as e:
-        logger.error(f"❌ خطأ في قبول المستخدم: {e}")
-        return False
+        logger.error(f"❌ خطأ في {'قبول' if approved else 'رفض'} المستخدم: {e}")
+        return None
 
+@timed(function_latency, 'handle_user_approval')
+def handle_user_approval(user_id, chat_id, message_id):
+    """معالجة قبول المستخدم"""
+    return decide_join_request(user_id, chat_id, message_id, True)
+
+@timed(function_latency, 'handle_user_rejection')
 def handle_user_rejection(user_id, chat_id, message_id):
     """معالجة رفض المستخدم"""
+    return decide_join_request(user_id, chat_id, message_id, False)
+
+def publish_approval_digest(digest):
+    """مهمة خلفية بعد منح دور الإرسال: نشر قائمة طلبات الانضمام المجمعة في رسالة واحدة للمدير"""
     try:
-        user_id_str = str(user_id)
-        
-        # تحديث حالة المستخدم (حظر)
-        user_warnings[user_id_str] = 3
-        
-        # إرسال رسالة تأكيد للمدير
-        send_telegram_message(
-            chat_id,
-            f"❌ تم رفض المستخدم {user_id_str}"
-        )
-        
-        # إرسال رسالة رفض للمستخدم
-        user_data = pending_approvals.get(user_id_str, {})
-        user_chat_id = user_data.get('chat_id')
-        if user_chat_id:
-            send_telegram_message(
-                user_chat_id,
-                "❌ تم رفض طلب انضمامك. لا يمكنك استخدام هذا البوت."
-            )
-        
-        # تعديل الرسالة الأصلية لإزالة الأزرار
-        edit_message_reply_markup(chat_id, message_id)
-        
-        # إزالة من قائمة الانتظار
-        if user_id_str in pending_approvals:
-            del pending_approvals[user_id_str]
-        
-        logger.info(f"❌ تم رفض المستخدم {user_id_str}")
+        if not MANAGER_CHAT_ID:
+            logger.error("❌ معرف مدير غير موجود")
+            return False
+
+        digest = digest_to_publish(digest)
+        text, buttons = digest.render()
+        return approval_digest_published(digest, telegram.send_message(MANAGER_CHAT_ID, text, reply_markup=buttons, reschedule=True))
+
+    except FloodWait as e:
+        log_flood_reschedule(e)
+        return outbound.submit(MANAGER_CHAT_ID, PRIORITY_APPROVAL, publish_approval_digest, digest)
+    except Exception as e:
+        logger.error(f"❌ خطأ في إرسال قائمة طلبات الانضمام: {e}")
+        requeue_approval_digest(digest)
+        return False
+
+def digest_to_publish(digest):
+    """النسخة المحفوظة من القائمة قبل نشرها - تتضمن القرارات التي وصلت قبل الإرسال (انتهاء صلاحية مثلاً)"""
+    approval_digest.take_dirty(digest.digest_id)
+    return approval_digest.get(digest.digest_id) or digest
+
+def approval_digest_published(digest, result):
+    """حفظ رقم رسالة القائمة بعد نشرها أو إعادة طلباتها عند الفشل"""
+    if not result:
+        requeue_approval_digest(digest)
+        return False
+    approval_digest.set_message_id(digest.digest_id, result.get('message_id'))
+    logger.info(f"📋 تم إرسال قائمة {len(digest.entries)} طلب انضمام للمدير")
+
+    # قرارات وصلت أثناء الإرسال
+    queue_digest_refresh(digest.digest_id)
+    return True
+
+def requeue_approval_digest(digest):
+    """قائمة لم تصل للمدير: إعادة طلباتها المعلقة إلى القائمة التالية بدل فقدانها"""
+    try:
+        count = approval_digest.requeue(digest)
+        logger.warning(f"⚠️ فشل إرسال قائمة طلبات الانضمام - أعيد {count} طلب إلى القائمة التالية")
+    except Exception as e:
+        logger.error(f"❌ خطأ في إعادة طلبات القائمة {digest.digest_id}: {e}")
+
+def refresh_approval_digest(digest_id):
+    """مهمة خلفية بعد منح دور الإرسال: تعديل رسالة القائمة في مكانها - تعديل واحد يجمع القرارات المتتالية"""
+    try:
+        digest = digest_to_refresh(digest_id)
+        if digest is None:
+            return False
+        text, buttons = digest.render()
+        return telegram.edit_message_text(MANAGER_CHAT_ID, digest.message_id, text, reply_markup=buttons, reschedule=True) is not None
+    except FloodWait as e:
+        log_flood_reschedule(e)
+        return reschedule_digest_refresh(digest_id)
+    except Exception as e:
+        logger.error(f"❌ خطأ في تعديل قائمة طلبات الانضمام: {e}")
+        return False
+
+def digest_to_refresh(digest_id):
+    """القائمة التي تحتاج رسالتها تعديلاً أو None"""
+    if not approval_digest.take_dirty(digest_id):
+        return None
+    digest = approval_digest.get(digest_id)
+    if digest is None:
+        return None
+    if digest.message_id is None:
+        # النشر لم يكتمل بعد - يعدلها النشر عند انتهائه
+        approval_digest.mark_dirty(digest_id)
+        return None
+    return digest
+
+def mark_in_digests(user_id, status):
+    """تحديث حالة المستخدم في القوائم المنشورة وجدولة تعديلها"""
+    if approval_digest is None:
+        return
+    for digest_id in approval_digest.mark(user_id, status):
+        queue_digest_refresh(digest_id)
+
+def reschedule_digest_refresh(digest_id):
+    """إعادة تعديل القائمة بعد 429 - التعديل التالي يعرض أحدث حالة"""
+    approval_digest.mark_dirty(digest_id)
+    return queue_digest_refresh(digest_id)
+
+def queue_digest_refresh(digest_id):
+    """جدولة تعديل رسالة القائمة في حدود إرسال دردشة المدير"""
+    return outbound.submit(MANAGER_CHAT_ID, PRIORITY_APPROVAL, refresh_approval_digest, digest_id)
+
+def decide_digest_users(user_ids, approved):
+    """تنفيذ قرار المدير على مستخدمين من القائمة - يعيد عدد من نفذ عليهم القرار فعلاً"""
+    decided = 0
+    for user_id in user_ids:
+        user_data = apply_join_decision(user_id, approved)
+        if user_data is None:
+            mark_in_digests(user_id, DIGEST_RESOLVED)
+            continue
+        decided += 1
+        # تأكيد المدير هو تعديل القائمة نفسها - الإشعار للمستخدم فقط
+        if user_data.get('chat_id'):
+            queue_message(user_data['chat_id'], join_decision_user_text(approved))
+        logger.info(f"{'✅ تم قبول' if approved else '❌ تم رفض'} المستخدم {user_id} من القائمة")
+    return decided
+
+def process_digest_action(callback_id, action, digest_id, arg):
+    """مهمة خلفية: تنفيذ إجراء من قائمة طلبات الانضمام والرد على callback query مرة واحدة"""
+    try:
+        answer_callback_query(callback_id, apply_digest_action(action, digest_id, arg))
         return True
-        
     except Exception as e:
-        logger.error(f"❌ خطأ في رفض المستخدم: {e}")
+        logger.error(f"❌ خطأ في تنفيذ إجراء القائمة: {e}")
         return False
 
+def apply_digest_action(action, digest_id, arg):
+    """تنفيذ إجراء القائمة على المخزن - يعيد نص الرد على callback query (None لتغيير الصفحة)"""
+    digest = approval_digest.get(digest_id) if approval_digest is not None else None
+
+    if action == 'page':
+        if digest is not None and approval_digest.set_page(digest_id, arg):
+            queue_digest_refresh(digest_id)
+        return None
+
+    if action in ('approve', 'reject'):
+        user_ids = [arg]
+    elif action in ('approve_page', 'reject_page') and digest is not None:
+        user_ids = digest.pending_on_page(arg)
+    else:
+        return "⚠️ انتهت صلاحية هذه القائمة"
+
+    approved = action.startswith('approve')
+    decided = decide_digest_users(user_ids, approved)
+    if decided:
+        return f"{'✅ تم قبول' if approved else '❌ تم رفض'} {decided}"
+    return "ℹ️ تمت معالجة الطلب مسبقاً"
+
+def callback_result_text(result, target_user_id, done_text):
+    """نص الرد على callback query حسب نتيجة القرار"""
+    if result:
+        return done_text
+    if result is False:
+        return f"ℹ️ تمت معالجة طلب المستخدم {target_user_id} مسبقاً"
+    return "⚠️ حدث خطأ، يرجى المحاولة مرة أخرى"
+
+def process_callback_action(callback_id, handler, target_user_id, chat_id, message_id, done_text):
+    """مهمة خلفية: تنفيذ القبول أو الرفض محلياً ثم الرد على callback query مرة واحدة"""
+    # الرد يزيل حالة التحميل لدى المدير - الإشعارات تكتمل في الخلفية
+    result = handler(target_user_id, chat_id, message_id)
+    answer_callback_query(callback_id, callback_result_text(result, target_user_id, done_text))
+
+@timed(function_latency, 'handle_callback_query')
 def handle_callback_query(callback_query):
     """معالجة ضغط المستخدم على الأزرار"""
     try:
@@ -248,76 +575,68 @@ def handle_callback_query(callback_query):
         message_id = message.get('message_id')
         chat_id = message.get('chat', {}).get('id')
 
-        logger.info(f"🔄 معالجة callback: {data} من المستخدم {user_id}")
+        data = data or ''
+        logger.info("🔄 معالجة callback: %s من المستخدم %s", data, user_id)
 
-        # الرد على callback query (مهم لإزالة حالة التحميل)
-        answer_callback_query(callback_id, "جارِ المعالجة...")
+        # أزرار قائمة طلبات الانضمام (وضع القوائم)
+        digest_action = parse_digest_callback(data)
+        if digest_action is not None:
+            dispatcher.submit(chat_id, process_digest_action, callback_id, *digest_action)
+            return {'status': 'digest_action'}, 200
 
-        # معالجة الإجراءات المختلفة
+        # معالجة الإجراءات في الخلفية حسب المستخدم المستهدف: طلبات مختلفة لا ينتظر أحدها الآخر
         if data.startswith('approve_'):
             user_to_approve = data.replace('approve_', '')
-            success = handle_user_approval(user_to_approve, chat_id, message_id)
-            if success:
-                answer_callback_query(callback_id, "✅ تم القبول")
-            return jsonify({'status': 'user_approved'}), 200
+            dispatcher.submit(user_to_approve, process_callback_action, callback_id,
+                              handle_user_approval, user_to_approve, chat_id, message_id, "✅ تم القبول")
+            return {'status': 'user_approved'}, 200
             
         elif data.startswith('reject_'):
             user_to_reject = data.replace('reject_', '')
-            success = handle_user_rejection(user_to_reject, chat_id, message_id)
-            if success:
-                answer_callback_query(callback_id, "❌ تم الرفض")
-            return jsonify({'status': 'user_rejected'}), 200
+            dispatcher.submit(user_to_reject, process_callback_action, callback_id,
+                              handle_user_rejection, user_to_reject, chat_id, message_id, "❌ تم الرفض")
+            return {'status': 'user_rejected'}, 200
         
-        answer_callback_query(callback_id, "⚠️ إجراء غير معروف")
-        return jsonify({'status': 'unknown_action'}), 200
+        dispatcher.submit(chat_id, answer_callback_query, callback_id, "⚠️ إجراء غير معروف")
+        return {'status': 'unknown_action'}, 200
         
     except Exception as e:
         logger.error(f"❌ خطأ في معالجة callback: {e}")
-        return jsonify({'status': 'error'}), 500
+        return {'status': 'error'}, 500
 
+@timed(function_latency, 'detect_violations')
 def detect_violations(text):
-    """الكشف عن المخالفات الأساسية"""
+    """الكشف عن المخالفات - يعيد أشد مخالفة أو None"""
     if not text:
-        return False
-        
-    text_lower = str(text).lower()
-    violations = [
-        'http://', 'https://', 'www.', 't.me/', 
-        'telegram.me', '.com', '.org', '.net'
-    ]
-    
-    for violation in violations:
-        if violation in text_lower:
-            return True
-    return False
+        return None
+    return violation_engine.detect(text)
 
-def handle_violation(user_id, chat_id, text):
+def handle_violation(user_id, chat_id, text, severity=1,
+                     warning_text="يمنع مشاركة روابط أو محتوى غير لائق."):
     """معالجة المخالفات"""
     try:
         user_id_str = str(user_id)
         
-        if user_id_str not in user_warnings:
-            user_warnings[user_id_str] = 0
-            
-        user_warnings[user_id_str] += 1
-        warnings = user_warnings[user_id_str]
+        warnings = state.incr_warnings(user_id, severity)
         
-        if warnings >= 3:
+        if warnings >= BAN_THRESHOLD:
             # حظر المستخدم
-            send_telegram_message(chat_id, "❌ تم حظرك من البوت due to repeated violations.")
+            queue_message(chat_id, "❌ تم حظرك من البوت due to repeated violations.", priority=PRIORITY_WARNING)
             
             # إشعار المدير
             if MANAGER_CHAT_ID:
-                send_telegram_message(
+                queue_message(
                     MANAGER_CHAT_ID,
-                    f"🚨 تم حظر المستخدم {user_id_str} بسبب المخالفات المتكررة"
+                    f"🚨 تم حظر المستخدم {user_id_str} بسبب المخالفات المتكررة",
+                    priority=PRIORITY_WARNING
                 )
             return True
         else:
             # إرسال تحذير
-            send_telegram_message(
+            queue_message(
                 chat_id,
-                f"⚠️ تحذير ({warnings}/3): يمنع مشاركة روابط أو محتوى غير لائق."
+                f"⚠️ تحذير ({warnings}/{BAN_THRESHOLD}): {warning_text}",
+                priority=PRIORITY_WARNING
             )
             return False
             
@@ -325,49 +644,295 @@ def handle_violation(user_id, chat_id, text):
         logger.error(f"❌ خطأ في معالجة المخالفة: {e}")
         return False
 
-def send_to_fasl_ai(user_id, chat_id, text, user_name=""):
-    """إرسال الرسالة إلى Fasl AI"""
+def handle_flood(user_id, chat_id, decision):
+    """الرد على تجاوز معدل الرسائل - يعيد None إذا كانت الرسالة تكمل طريقها (تحذير فقط)
+
+    الإيقاف المتكرر يحتسب مخالفة في نظام التحذيرات."""
+    if decision.action == FLOOD_WARN:
+        # التحذير الأول لا يفقد الرسالة - الإيقاف يبدأ فقط إذا استمر الإرسال
+        queue_message(chat_id, "⚠️ ترسل رسائل كثيرة بسرعة. يرجى التمهل قليلاً قبل إرسال استفسار جديد.",
+                      priority=PRIORITY_WARNING)
+        return None
+
+    if decision.action == FLOOD_COOLDOWN:
+        logger.warning(f"🌊 إيقاف مؤقت للمستخدم {user_id} لمدة {decision.cooldown:.0f} ث (المرة {decision.strikes})")
+        # بعد استنفاد كل مراحل الإيقاف يعامل التكرار كمخالفة تقود إلى الحظر
+        if decision.strikes >= len(flood_control.cooldowns):
+            handle_violation(user_id, chat_id, None, 1, "الإرسال المتكرر بكثافة يؤدي إلى الحظر.")
+        else:
+            queue_message(
+                chat_id,
+                f"⏸️ تم إيقاف استقبال رسائلك مؤقتاً لمدة {decision.cooldown / 60:g} دقيقة بسبب الإرسال المتكرر.",
+                priority=PRIORITY_WARNING
+            )
+        return {'status': 'flood_cooldown'}, 200
+
+    # رسائل أثناء الإيقاف تتجاهل بصمت دون أي اتصال خارجي
+    return {'status': 'flood_muted'}, 200
+
+def clean_message_text(text):
+    """تنظيف البيانات الأساسي"""
+    return re.sub(r'[^\w\s\u0600-\u06FF@\.\-_\?\!]', '', str(text)) if text else ""
+
+@timed(function_latency, 'send_to_fasl_ai')
+def send_to_fasl_ai(user_id, chat_id, text, user_name="", parts=None):
+    """إرسال الرسالة إلى Fasl AI (parts: أجزاء الرسائل المجمعة بالترتيب)"""
     try:
         if not N8N_WEBHOOK_URL:
             logger.error("❌ عنوان webhook لـ n8n غير موجود")
             return False
         
-        # تنظيف البيانات الأساسي
-        clean_text = re.sub(r'[^\w\s\u0600-\u06FF@\.\-_\?\!]', '', str(text)) if text else ""
-        
-        if not clean_text:
+        payload = build_fasl_payload(user_id, chat_id, text, user_name, parts)
+        if payload is None:
             return False
-        
-        payload = {
-            'user_id': str(user_id),
-            'chat_id': str(chat_id),
-            'text': clean_text,
-            'timestamp': datetime.now().isoformat(),
-            'user_info': {
-                'id': str(user_id),
-                'first_name': str(user_name).split(' ')[0] if user_name else '',
-                'last_name': ' '.join(str(user_name).split(' ')[1:]) if user_name and ' ' in user_name else ''
-            }
-        }
-        
-        headers = {
-            'Content-Type': 'application/json',
-            'X-Telegram-Token': os.getenv('TELEGRAM_WEBHOOK_SECRET', 'default-secret')
-        }
-        
-        response = requests.post(N8N_WEBHOOK_URL, json=payload, headers=headers, timeout=15)
-        
-        if response.status_code == 200:
-            logger.info(f"✅ تم إرسال الرسالة إلى Fasl AI للمستخدم {user_id}")
-            return True
-        else:
-            logger.error(f"❌ فشل إرسال الرسالة إلى Fasl AI: {response.status_code}")
+
+        # الحفاظ على ترتيب رسائل المستخدم: إذا كان له رسائل منتظرة تضاف بعدها
+        # وعند فتح الدائرة لا ننتظر مهلة n8n بل نحفظ الرسالة مباشرة
+        if fasl_outbox.has_pending(user_id) or not fasl_breaker.allow():
+            return remember_question(user_id, payload, queue_for_fasl_ai(user_id, payload))
+
+        result = RETRY
+        try:
+            result = post_to_fasl_ai(payload)
+        finally:
+            record_fasl_result(result)
+        if result == DELIVERED:
+            logger.info("✅ تم إرسال الرسالة إلى Fasl AI للمستخدم %s", user_id, extra=SAMPLED)
+            return remember_question(user_id, payload, True)
+        if result == REJECTED:
             return False
+        return remember_question(user_id, payload, queue_for_fasl_ai(user_id, payload))
             
     except Exception as e:
         logger.error(f"❌ خطأ في إرسال الرسالة إلى Fasl AI: {e}")
         return False
 
+def build_fasl_payload(user_id, chat_id, text, user_name="", parts=None):
+    """تجهيز بيانات الطلب إلى Fasl AI - None إذا كان النص فارغاً بعد التنظيف"""
+    clean_text = clean_message_text(text)
+
+    if not clean_text:
+        return None
+
+    payload = {
+        'user_id': str(user_id),
+        'chat_id': str(chat_id),
+        'text': clean_text,
+        'timestamp': datetime.now().isoformat(),
+        'user_info': {
+            'id': str(user_id),
+            'first_name': str(user_name).split(' ')[0] if user_name else '',
+            'last_name': ' '.join(str(user_name).split(' ')[1:]) if user_name and ' ' in user_name else ''
+        }
+    }
+    if parts:
+        payload['parts'] = [clean_message_text(part) for part in parts]
+    if APP_URL:
+        payload['reply_url'] = f"{APP_URL}/reply"
+    # السياق السابق للسؤال فقط - ويضاف السؤال نفسه للطلبات التالية بعد قبوله (remember_question)
+    if conversation_context is not None:
+        payload['context'] = conversation_context.snapshot(user_id)
+    # n8n يرسل الإجابة إلى /reply مع question_key ليخزنها البوت ويعيد استخدامها
+    # (إلا إذا كان للمستخدم سياق: الإجابة قد تعتمد على بياناته فلا تشارك مع غيره)
+    if answer_cache is not None and not payload.get('context'):
+        payload['question_key'] = answer_cache.key_for(text)
+    return payload
+
+def fasl_headers():
+    return {
+        'Content-Type': 'application/json',
+        'X-Telegram-Token': TELEGRAM_WEBHOOK_SECRET or 'default-secret'
+    }
+
+def remember_exchange(user_id, role, text):
+    """إضافة رسالة أو إجابة إلى سياق المستخدم"""
+    if conversation_context is not None and user_id:
+        conversation_context.add(user_id, role, text)
+
+def remember_question(user_id, payload, accepted):
+    """إضافة السؤال إلى السياق فقط إذا وصل إلى n8n أو حفظ في الصندوق الصادر - يعيد accepted"""
+    if accepted:
+        remember_exchange(user_id, CONTEXT_USER, payload['text'])
+    return accepted
+
+def answer_from_cache(user_id, chat_id, text):
+    """الرد مباشرة من ذاكرة الإجابات إن وجد سؤال مطابق - يعيد True عند الإصابة"""
+    if answer_cache is None:
+        return False
+    answer = answer_cache.get(text)
+    if answer is None:
+        return False
+    logger.info("💡 رد من ذاكرة الإجابات للدردشة %s", chat_id, extra=SAMPLED)
+    queue_message(chat_id, answer)
+    # السؤال لم يصل إلى n8n لكنه جزء من المحادثة
+    remember_exchange(user_id, CONTEXT_USER, clean_message_text(text))
+    remember_exchange(user_id, CONTEXT_ASSISTANT, answer)
+    return True
+
+def reply_authorized(token):
+    """التحقق من رمز n8n في ترويسة X-Telegram-Token (نفس الرمز الذي يرسله البوت إليه)"""
+    if not TELEGRAM_WEBHOOK_SECRET:
+        return False
+    return hmac.compare_digest((token or '').encode(), TELEGRAM_WEBHOOK_SECRET.encode())
+
+def handle_fasl_reply(data):
+    """استلام إجابة Fasl AI من n8n: إرسالها للمستخدم وتخزينها في ذاكرة الإجابات"""
+    if not isinstance(data, dict):
+        return {'status': 'no_data'}, 400
+
+    chat_id = data.get('chat_id')
+    answer = str(data.get('answer') or '').strip()
+    if not chat_id or not answer:
+        return {'status': 'missing_fields'}, 400
+    # في الدردشة الخاصة معرف الدردشة هو معرف المستخدم
+    try:
+        remember_exchange(int(data.get('user_id') or chat_id), CONTEXT_ASSISTANT, answer)
+    except (TypeError, ValueError):
+        pass
+
+    # النص العادي يُهرب، و n8n يرسل parse_mode = 'HTML' إذا كانت الإجابة منسقة مسبقاً
+    if data.get('parse_mode') != 'HTML':
+        answer = html.escape(answer)
+    queue_message(chat_id, answer)
+
+    # التخزين فقط عندما يؤكد n8n أن الإجابة عامة لا تعتمد على بيانات المستخدم
+    cached = False
+    if answer_cache is not None and data.get('cacheable') is True and data.get('question_key'):
+        cached = answer_cache.put(data['question_key'], answer)
+    return {'status': 'delivered', 'cached': cached}, 200
+
+def fasl_result(status_code):
+    """تصنيف استجابة n8n إلى DELIVERED أو RETRY أو REJECTED"""
+    outbound_responses.inc('n8n', 'webhook', status_code)
+    if status_code == 200:
+        return DELIVERED
+    logger.error(f"❌ فشل إرسال الرسالة إلى Fasl AI: {status_code}")
+    # أخطاء 4xx (عدا المهلة وتجاوز الحد) لن تنجح بإعادة المحاولة
+    if 400 <= status_code < 500 and status_code not in (408, 429):
+        return REJECTED
+    return RETRY
+
+def post_to_fasl_ai(payload):
+    """إرسال طلب واحد إلى n8n - يعيد DELIVERED أو RETRY أو REJECTED"""
+    try:
+        response = requests.post(N8N_WEBHOOK_URL, json=payload, headers=fasl_headers(), timeout=15)
+    except requests.RequestException as e:
+        outbound_responses.inc('n8n', 'webhook', 'error')
+        logger.error(f"❌ خطأ في الاتصال بـ Fasl AI: {e}")
+        return RETRY
+    return fasl_result(response.status_code)
+
+# الرسالة المحفوظة أبلغ المستخدم باستلامها ثم رفضها n8n عند إعادة الإرسال
+FASL_REJECTED_MESSAGE = "⚠️ عذراً، تعذر معالجة استفسارك السابق. يرجى إعادة إرساله."
+
+def record_fasl_result(result):
+    """تسجيل نتيجة الطلب في قاطع الدائرة (الرفض يعني أن n8n يعمل)"""
+    if result == RETRY:
+        fasl_breaker.record_failure()
+    else:
+        fasl_breaker.record_success()
+
+def notify_fasl_rejected(payload):
+    """إبلاغ المستخدم بأن رسالته المحفوظة في الصندوق الصادر رفضها n8n"""
+    chat_id = payload.get('chat_id')
+    if chat_id:
+        queue_message(chat_id, FASL_REJECTED_MESSAGE)
+
+def queue_for_fasl_ai(user_id, payload):
+    """حفظ الرسالة في الصندوق الصادر لإعادة إرسالها عند عودة n8n"""
+    try:
+        fasl_outbox.append(user_id, payload)
+        fasl_replayer.notify()
+        logger.warning(f"📬 تم حفظ رسالة المستخدم {user_id} في الصندوق الصادر (الدائرة: {fasl_breaker.state})")
+        return True
+    except Exception as e:
+        logger.error(f"❌ خطأ في حفظ الرسالة في الصندوق الصادر: {e}")
+        return False
+
+fasl_replayer = OutboxReplayer(fasl_outbox, fasl_breaker, post_to_fasl_ai,
+                               concurrency=OUTBOX_REPLAY_CONCURRENCY, on_rejected=notify_fasl_rejected)
+fasl_replayer.start()
+
+# تمرير ملفات المستخدمين إلى n8n ببث مباشر وبتوازي محدود (معطل إذا لم يحدد عنوان n8n)
+# البث من Telegram إلى n8n يتم في مجمع خيوطه الخاص في الوضعين، فلا يحجز حلقة الأحداث ولا عمال الإرسال
+media_forwarder = MediaForwarder(
+    telegram, MEDIA_UPLOAD_URL, headers=lambda: fasl_headers(), max_bytes=MEDIA_MAX_BYTES, concurrency=MEDIA_CONCURRENCY
+) if MEDIA_UPLOAD_URL else None
+if media_forwarder is not None:
+    media_forwarder.on_response = lambda code: outbound_responses.inc('n8n', 'media', code)
+
+# رسائل المستخدم حسب نتيجة رفع الملف
+MEDIA_MESSAGES = {
+    MEDIA_DELIVERED: "✅ تم استلام ملفك وسيتم الرد قريباً.",
+    MEDIA_TOO_LARGE: f"⚠️ حجم الملف يتجاوز الحد المسموح ({MEDIA_MAX_BYTES // (1024 * 1024)} ميغابايت).",
+    MEDIA_DUPLICATE: "ℹ️ تم استلام هذا الملف من قبل.",
+    MEDIA_BUSY: "⏳ يوجد ضغط على استلام الملفات حالياً، يرجى المحاولة بعد قليل."
+}
+MEDIA_FAILED_MESSAGE = "⚠️ عذراً، تعذر استلام الملف. يرجى المحاولة لاحقاً."
+
+def handle_media_message(user_id, chat_id, media, caption, user_name):
+    """استلام ملف من المستخدم وجدولة تمريره إلى Fasl AI"""
+    if media_forwarder is None:
+        queue_message(chat_id, "⚠️ يرجى إرسال نص صالح.")
+        return {'status': 'media_disabled'}, 200
+
+    first_name, _, last_name = str(user_name).partition(' ')
+    fields = {
+        'user_id': str(user_id),
+        'chat_id': str(chat_id),
+        'text': clean_message_text(caption),
+        'timestamp': datetime.now().isoformat(),
+        'media_type': media['kind'],
+        'file_name': media['file_name'],
+        'mime_type': media['mime_type'],
+        'first_name': first_name,
+        'last_name': last_name
+    }
+    status = media_forwarder.submit(
+        user_id, media, fields,
+        on_done=lambda result: queue_message(chat_id, MEDIA_MESSAGES.get(result, MEDIA_FAILED_MESSAGE))
+    )
+    # عند القبول يبلغ المستخدم بعد انتهاء الرفع فقط
+    if status != MEDIA_QUEUED:
+        queue_message(chat_id, MEDIA_MESSAGES.get(status, MEDIA_FAILED_MESSAGE))
+    return {'status': f"media_{status}"}, 200
+
+# إنهاء طلبات الموافقة المهملة وتذكير المدير بها (المستخدم يستطيع التقديم من جديد بعد الانتهاء)
+pending_sweeper = PendingSweeper(
+    state, ttl=PENDING_TTL, remind_after=PENDING_REMIND_AFTER, interval=PENDING_SWEEP_INTERVAL,
+    on_remind=schedule_approval_reminder,
+    on_expire=lambda user_id, user_data: dispatcher.submit(user_id, notify_pending_expired, user_id, user_data)
+)
+pending_sweeper.start()
+
+# وضع القوائم: تجميع طلبات الانضمام خلال نافذة زمنية في رسالة واحدة مقسمة إلى صفحات
+approval_digest = ApprovalDigest(
+    on_publish=lambda digest: outbound.submit(MANAGER_CHAT_ID, PRIORITY_APPROVAL, publish_approval_digest, digest),
+    store=state, window=APPROVAL_DIGEST_WINDOW, page_size=APPROVAL_DIGEST_PAGE_SIZE
+) if APPROVAL_MODE == 'digest' else None
+
+def deliver_question(user_id, chat_id, text, user_name="", parts=None):
+    """مهمة خلفية: إرسال الاستفسار إلى Fasl AI ثم إبلاغ المستخدم"""
+    if send_to_fasl_ai(user_id, chat_id, text, user_name, parts):
+        queue_message(chat_id, "✅ تم استلام استفسارك وسيتم الرد قريباً.")
+    else:
+        queue_message(chat_id, "⚠️ عذراً، حدث خطأ في معالجة طلبك. يرجى المحاولة لاحقاً.")
+
+def flush_coalesced_messages(user_id, chat_id, parts, user_name):
+    """إرسال رسائل المستخدم المجمعة كاستفسار واحد"""
+    if len(parts) > 1:
+        logger.info(f"📦 تجميع {len(parts)} رسائل للمستخدم {user_id}")
+        # الرسالة الواحدة فحصت قبل التجميع
+        if answer_from_cache(user_id, chat_id, '\n'.join(parts)):
+            return
+    dispatcher.submit(chat_id, deliver_question, user_id, chat_id, '\n'.join(parts), user_name,
+                      parts if len(parts) > 1 else None)
+
+# تجميع الرسائل المتتالية (معطل إذا كانت COALESCE_WINDOW = 0)
+coalescer = MessageCoalescer(
+    flush_coalesced_messages, window=COALESCE_WINDOW, max_wait=COALESCE_MAX_WAIT
+) if COALESCE_WINDOW > 0 else None
+
 def keep_alive():
     """الحفاظ على نشاط التطبيق"""
     def run():
@@ -385,27 +950,42 @@ def keep_alive():
     thread.start()
     logger.info("🚀 بدء نظام keep-alive")
 
-@app.route('/webhook', methods=['POST'])
-def webhook():
-    """معالجة webhook من Telegram"""
+def process_update(data):
+    """معالجة تحديث واحد من Telegram (webhook أو long polling) - يعيد (الحالة، رمز HTTP)"""
+    result, code = route_update(data)
+    update_outcomes.inc(result.get('status'))
+    return result, code
+
+def route_update(data):
+    """توجيه التحديث حسب نوعه وحالة المستخدم"""
+    update_keys = []
     try:
-        data = request.get_json()
-        
         if not data:
             logger.warning("⚠️ طلب webhook بدون بيانات")
-            return jsonify({'status': 'no_data'}), 400
+            return {'status': 'no_data'}, 400
+
+        # تجاهل التحديثات المعاد إرسالها قبل أي اتصال خارجي
+        update_keys = UpdateDeduplicator.keys_for(data)
+        if not dedup.claim(update_keys):
+            logger.info("🔁 تحديث مكرر تم تجاهله: %s", update_keys)
+            return {'status': 'duplicate'}, 200
         
-        logger.info(f"📥 بيانات مستلمة: {json.dumps(data, ensure_ascii=False)[:200]}...")
+        # لا نحول التحديث كاملاً إلى JSON لمجرد تسجيله - التنسيق يتم لاحقاً في خيط السجلات
+        logger.info("📥 تحديث مستلم %s: %s", data.get('update_id'),
+                    next((key for key in data if key != 'update_id'), None), extra=SAMPLED)
         
         # معالجة callback queries (ضغط على الأزرار)
         if 'callback_query' in data:
-            return handle_callback_query(data['callback_query'])
+            response = handle_callback_query(data['callback_query'])
+            if response[1] >= 500:
+                dedup.release(update_keys)
+            return response
         
         # معالجة الرسائل العادية
         message = data.get('message', {})
         if not message:
             logger.info("⚠️ لا توجد رسالة في البيانات")
-            return jsonify({'status': 'no_message'}), 200
+            return {'status': 'no_message'}, 200
         
         user_info = message.get('from', {})
         user_id = user_info.get('id')
@@ -415,62 +995,242 @@ def webhook():
 
         if not user_id or not chat_id:
             logger.warning("⚠️ معرف مستخدم أو دردشة مفقود")
-            return jsonify({'status': 'missing_ids'}), 400
+            return {'status': 'missing_ids'}, 400
+
+        logger.info("👤 مستخدم %s في دردشة %s: %.50s...", user_id, chat_id, text, extra=SAMPLED)
 
-        logger.info(f"👤 مستخدم {user_id} في دردشة {chat_id}: {text[:50]}...")
+        # أوامر المدير من دردشته (لا تمر بفحوص المستخدمين)
+        if text.startswith('/') and MANAGER_CHAT_ID and str(chat_id) == str(MANAGER_CHAT_ID):
+            response = handle_manager_command(chat_id, user_id, text)
+            if response is not None:
+                return response
 
         # التحقق من حظر المستخدم
-        if str(user_id) in user_warnings and user_warnings[str(user_id)] >= 3:
-            logger.info(f"⛔ مستخدم محظور {user_id} حاول إرسال رسالة")
-            send_telegram_message(chat_id, "❌ أنت محظور من استخدام هذا البوت.")
-            return jsonify({'status': 'banned'}), 200
+        warnings = state.get_warnings(user_id)
+        if warnings is not None and warnings >= BAN_THRESHOLD:
+            logger.info("⛔ مستخدم محظور %s حاول إرسال رسالة", user_id)
+            queue_message(chat_id, "❌ أنت محظور من استخدام هذا البوت.", priority=PRIORITY_WARNING)
+            return {'status': 'banned'}, 200
 
         # التحقق من المستخدم الجديد
-        if str(user_id) not in user_warnings:
-            user_warnings[str(user_id)] = 0
-            # إرسال طلب موافقة للمدير
-            approval_sent = send_approval_request(user_id, user_name, chat_id)
-            if approval_sent:
-                send_telegram_message(chat_id, "⏳ تم إرسال طلب الانضمام للمدير، يرجى الانتظار للموافقة...")
-                return jsonify({'status': 'approval_sent'}), 200
-            else:
-                send_telegram_message(chat_id, "⚠️ حدث خطأ في إرسال طلب الانضمام. يرجى المحاولة لاحقاً.")
-                return jsonify({'status': 'approval_failed'}), 200
+        if warnings is None:
+            record = {
+                'user_name': user_name,
+                'chat_id': chat_id,
+                'timestamp': datetime.now().isoformat()
+            }
+            # التسجيل ذري: عامل واحد فقط يرسل طلب الموافقة
+            if state.register_new_user(user_id, record):
+                if approval_digest is not None:
+                    approval_digest.add(user_id, user_name, chat_id)
+                    queue_message(chat_id, APPROVAL_SENT_MESSAGE)
+                else:
+                    queue_approval_request(user_id, user_name, chat_id)
+                return {'status': 'approval_queued'}, 200
 
         # التحقق من انتظار الموافقة
-        if str(user_id) in pending_approvals:
-            send_telegram_message(chat_id, "⏳ طلبك لا يزال قيد المراجعة. يرجى الانتظار...")
-            return jsonify({'status': 'pending_approval'}), 200
+        if state.is_pending(user_id):
+            queue_message(chat_id, "⏳ طلبك لا يزال قيد المراجعة. يرجى الانتظار...")
+            return {'status': 'pending_approval'}, 200
+
+        # تحديد معدل الرسائل قبل أي فحص أو اتصال خارجي
+        if flood_control is not None:
+            decision = flood_control.check(user_id)
+            if decision.action != FLOOD_ALLOW:
+                response = handle_flood(user_id, chat_id, decision)
+                if response is not None:
+                    return response
+
+        # الملفات (مستندات وصور وصوتيات): التعليق يفحص كأي نص ثم يمرر الملف
+        media = extract_media(message)
+        if media is not None:
+            caption = message.get('caption', '').strip()
+            violation = detect_violations(caption) if caption else None
+            if violation:
+                logger.warning("🚨 مخالفة في تعليق ملف للمستخدم %s: %s", user_id, violation.rule)
+                handle_violation(user_id, chat_id, caption, violation.severity)
+                return {'status': 'violation_detected'}, 200
+            return handle_media_message(user_id, chat_id, media, caption, user_name)
 
         # تجاهل الرسائل الفارغة
         if not text:
-            send_telegram_message(chat_id, "⚠️ يرجى إرسال نص صالح.")
-            return jsonify({'status': 'empty_message'}), 200
+            queue_message(chat_id, "⚠️ يرجى إرسال نص صالح.")
+            return {'status': 'empty_message'}, 200
 
         # الكشف عن المخالفات
-        if detect_violations(text):
-            logger.warning(f"🚨 مخالفة обнаружена للمستخدم {user_id}")
-            handle_violation(user_id, chat_id, text)
-            return jsonify({'status': 'violation_detected'}), 200
+        violation = detect_violations(text)
+        if violation:
+            logger.warning("🚨 مخالفة обнаружена للمستخدم %s: %s", user_id, violation.rule)
+            handle_violation(user_id, chat_id, text, violation.severity)
+            return {'status': 'violation_detected'}, 200
 
-        # إرسال إلى Fasl AI
-        ai_success = send_to_fasl_ai(user_id, chat_id, text, user_name)
-        
-        if ai_success:
-            send_telegram_message(chat_id, "✅ تم استلام استفسارك وسيتم الرد قريباً.")
-        else:
-            send_telegram_message(chat_id, "⚠️ عذراً، حدث خطأ في معالجة طلبك. يرجى المحاولة لاحقاً.")
+        # الرد من ذاكرة الإجابات دون تشغيل Fasl AI
+        if answer_from_cache(user_id, chat_id, text):
+            return {'status': 'cached_answer'}, 200
+
+        # تجميع الرسائل المتتالية قبل الإرسال إن كان مفعلاً
+        if coalescer is not None:
+            coalescer.add(user_id, chat_id, text, user_name)
+            return {'status': 'buffered'}, 200
 
-        return jsonify({'status': 'processed'}), 200
+        # إرسال إلى Fasl AI في الخلفية
+        dispatcher.submit(chat_id, deliver_question, user_id, chat_id, text, user_name)
+
+        return {'status': 'processed'}, 200
         
     except Exception as e:
         logger.error(f"❌ خطأ غير متوقع في webhook: {e}")
-        return jsonify({'status': 'error'}), 500
+        # السماح لـ Telegram بإعادة المحاولة
+        dedup.release(update_keys)
+        return {'status': 'error'}, 500
 
-@app.route('/health', methods=['GET'])
-def health_check():
-    """فحص صحة التطبيق"""
-    status = {
+def command_cache_forget(chat_id, argument):
+    """/cache_forget <السؤال>: حذف إجابة سؤال (أو كل الأسئلة التي تحتوي النص)"""
+    if not argument:
+        queue_message(chat_id, "⚠️ الاستخدام: /cache_forget نص السؤال", priority=PRIORITY_APPROVAL)
+        return
+    count = answer_cache.invalidate(argument)
+    queue_message(chat_id, f"🗑️ تم حذف {count} إجابة من الذاكرة", priority=PRIORITY_APPROVAL)
+
+def command_cache_clear(chat_id, argument):
+    """/cache_clear: حذف جميع الإجابات المخزنة"""
+    count = answer_cache.clear()
+    queue_message(chat_id, f"🗑️ تم حذف {count} إجابة من الذاكرة", priority=PRIORITY_APPROVAL)
+
+def command_cache_stats(chat_id, argument):
+    """/cache_stats: إحصائيات ذاكرة الإجابات"""
+    stats = answer_cache.stats()
+    queue_message(chat_id, (
+        f"💡 ذاكرة الإجابات: {stats['entries']} إجابة\n"
+        f"الإصابات: {stats['hits']} - الإخفاقات: {stats['misses']} (نسبة {stats['hit_rate']:.0%})"
+    ), priority=PRIORITY_APPROVAL)
+
+def send_broadcast_message(chat_id, text):
+    """إرسال رسالة بث واحدة بأدنى أولوية - الرسائل التفاعلية تسبقها دائماً في حدود الإرسال"""
+    # تنفذ في خيوط البث الخاصة (لا في عمال dispatcher) فانتظار الدور هنا هو ما يضبط سرعة البث
+    if not outbound.acquire(chat_id, PRIORITY_BULK, timeout=OUTBOUND_MAX_WAIT):
+        return BROADCAST_RETRY
+    # request بدل call لمعرفة رمز الخطأ (403 = المستخدم حظر البوت)
+    body = telegram.request('sendMessage', {'chat_id': chat_id, 'text': text, 'parse_mode': 'HTML'})
+    return classify_broadcast_response(body)
+
+def broadcast_status_text(stats, finished=False):
+    """نص تقرير تقدم البث للمدير"""
+    if stats is None:
+        return "ℹ️ لا يوجد بث"
+    total = max(stats['total'], stats['processed'])
+    percent = stats['processed'] / total if total else 1
+    if finished:
+        title = "🏁 انتهى البث" if stats['status'] == 'done' else "⛔ تم إيقاف البث"
+    else:
+        title = "📣 البث قيد التنفيذ" if stats['running'] else f"📣 آخر بث ({stats['status']})"
+    return (
+        f"{title} {stats['id']}\n"
+        f"التقدم: {stats['processed']}/{total} ({percent:.0%})\n"
+        f"✅ أرسلت: {stats['sent']} - 🚫 حظروا البوت: {stats['blocked']} - ❌ فشل: {stats['failed']}\n"
+        f"⚡ المعدل: {stats['rate']} رسالة/ث"
+    )
+
+def report_broadcast_progress(stats, finished):
+    """إرسال تقدم البث إلى دردشة المدير"""
+    if MANAGER_CHAT_ID:
+        queue_message(MANAGER_CHAT_ID, broadcast_status_text(stats, finished), priority=PRIORITY_APPROVAL)
+
+def command_broadcast(chat_id, argument):
+    """/broadcast <النص>: إرسال رسالة لجميع المستخدمين المقبولين"""
+    if not argument:
+        queue_message(chat_id, "⚠️ الاستخدام: /broadcast نص الرسالة", priority=PRIORITY_APPROVAL)
+        return
+    if not broadcaster.start(html.escape(argument)):
+        queue_message(chat_id, "⚠️ يوجد بث قيد التنفيذ - استخدم /broadcast_status أو /broadcast_cancel",
+                      priority=PRIORITY_APPROVAL)
+        return
+    logger.info("📣 بدء بث جديد من المدير")
+    queue_message(chat_id, f"📣 بدأ البث إلى {broadcaster.stats()['total']} مستخدم", priority=PRIORITY_APPROVAL)
+
+def command_broadcast_status(chat_id, argument):
+    """/broadcast_status: تقدم البث الحالي أو الأخير"""
+    queue_message(chat_id, broadcast_status_text(broadcaster.stats()), priority=PRIORITY_APPROVAL)
+
+def command_broadcast_cancel(chat_id, argument):
+    """/broadcast_cancel: إيقاف البث بعد الدفعة الحالية"""
+    text = "⛔ جارِ إيقاف البث..." if broadcaster.cancel() else "ℹ️ لا يوجد بث قيد التنفيذ"
+    queue_message(chat_id, text, priority=PRIORITY_APPROVAL)
+
+# أوامر المدير: الاسم -> (الدالة، هل تحتاج ذاكرة الإجابات)
+MANAGER_COMMANDS = {
+    '/cache_forget': (command_cache_forget, True),
+    '/cache_clear': (command_cache_clear, True),
+    '/cache_stats': (command_cache_stats, True),
+    '/broadcast': (command_broadcast, False),
+    '/broadcast_status': (command_broadcast_status, False),
+    '/broadcast_cancel': (command_broadcast_cancel, False)
+}
+
+# بث رسائل المدير لجميع المستخدمين - يستأنف تلقائياً بعد إعادة التشغيل
+broadcaster = Broadcast(
+    state, send_broadcast_message, checkpoint_path=BROADCAST_CHECKPOINT, batch_size=BROADCAST_BATCH,
+    concurrency=BROADCAST_CONCURRENCY, report_interval=BROADCAST_REPORT_INTERVAL,
+    on_progress=report_broadcast_progress
+)
+broadcaster.resume()
+
+def handle_manager_command(chat_id, user_id, text):
+    """تنفيذ أمر من المدير - يعيد None إذا لم يكن أمراً معروفاً"""
+    command, *rest = text.split(None, 1)
+    argument = rest[0] if rest else ''
+    # /command@bot_name في المجموعات
+    entry = MANAGER_COMMANDS.get(command.split('@')[0].lower())
+    if entry is None:
+        return None
+    # دردشة المدير قد تكون مجموعة: الأوامر تقبل من المديرين المحددين فقط
+    if str(user_id) not in MANAGER_USER_IDS:
+        logger.warning("⛔ أمر مدير مرفوض من المستخدم %s: %s", user_id, command)
+        return {'status': 'manager_forbidden'}, 200
+    handler, needs_cache = entry
+    if needs_cache and answer_cache is None:
+        queue_message(chat_id, "ℹ️ ذاكرة الإجابات معطلة", priority=PRIORITY_APPROVAL)
+    else:
+        handler(chat_id, argument.strip())
+    logger.info(f"🛠️ أمر المدير: {command}")
+    return {'status': 'manager_command'}, 200
+
+def start_polling():
+    """تشغيل الاستقبال عبر getUpdates بدل webhook (لا يحتاج عنواناً عاماً)"""
+    global poller
+    if telegram.delete_webhook() is None:
+        logger.warning("⚠️ تعذر حذف webhook - قد يرفض Telegram طلبات getUpdates")
+    poller = UpdatePoller(telegram, process_update, offset_path=POLL_OFFSET_PATH, workers=POLL_WORKERS)
+    poller.start()
+    return poller
+
+poller = None
+
+@app.route('/webhook', methods=['POST'])
+def webhook():
+    """معالجة webhook من Telegram"""
+    started = time.perf_counter()
+    result, code = process_update(request.get_json(silent=True))
+    response = jsonify(result), code
+    webhook_latency.observe(time.perf_counter() - started, result.get('status'))
+    return response
+
+@app.route('/reply', methods=['POST'])
+def fasl_reply():
+    """استلام إجابات Fasl AI من n8n وإرسالها للمستخدم"""
+    if not reply_authorized(request.headers.get('X-Telegram-Token')):
+        return jsonify({'status': 'forbidden'}), 403
+    result, code = handle_fasl_reply(request.get_json(silent=True))
+    return jsonify(result), code
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    """تصدير المقاييس بصيغة Prometheus"""
+    return Response(metrics.render(), content_type=METRICS_CONTENT_TYPE)
+
+def health_status():
+    """بيانات فحص الصحة (مشتركة بين Flask والخادم غير المتزامن)"""
+    return {
         'status': 'healthy',
         'timestamp': datetime.now().isoformat(),
         'services': {
@@ -479,11 +1239,37 @@ def health_check():
             'manager_chat': bool(MANAGER_CHAT_ID)
         },
         'statistics': {
-            'total_users': len(user_warnings),
-            'pending_approvals': len(pending_approvals)
-        }
+            'total_users': state.count_users(),
+            'pending_approvals': state.count_pending(),
+            'memory': state.memory_stats()
+        },
+        'pending_sweeper': pending_sweeper.stats(),
+        'approval_digest': approval_digest.stats() if approval_digest else None,
+        'dispatch': dispatcher.stats(),
+        'outbound': outbound.stats(),
+        'dedup': dedup.stats(),
+        'coalescer': coalescer.stats() if coalescer else None,
+        'answer_cache': answer_cache.stats() if answer_cache else None,
+        'conversation_context': conversation_context.stats() if conversation_context else None,
+        'media': media_forwarder.stats() if media_forwarder else None,
+        'broadcast': broadcaster.stats(),
+        'flood_control': flood_control.stats() if flood_control else None,
+        'ingestion': {
+            'mode': INGESTION_MODE,
+            'polling': poller.stats() if poller else None
+        },
+        'fasl_ai': {
+            'circuit': fasl_breaker.stats(),
+            'outbox': fasl_outbox.stats()
+        },
+        'telegram_api': telegram.stats(),
+        'logging': logging_stats(log_listener)
     }
-    return jsonify(status), 200
+
+@app.route('/health', methods=['GET'])
+def health_check():
+    """فحص صحة التطبيق"""
+    return jsonify(health_status()), 200
 
 @app.route('/set_webhook', methods=['GET'])
 def set_webhook_route():
@@ -494,15 +1280,18 @@ def set_webhook_route():
     else:
         return jsonify({'status': 'error', 'message': 'Failed to set webhook'}), 500
 
-@app.route('/')
-def home():
-    """الصفحة الرئيسية"""
-    return jsonify({
+def home_status():
+    return {
         'message': 'Legal Telegram Bot is running!',
         'status': 'active',
         'timestamp': datetime.now().isoformat(),
         'version': '2.0.0'
-    })
+    }
+
+@app.route('/')
+def home():
+    """الصفحة الرئيسية"""
+    return jsonify(home_status())
 
 @app.errorhandler(404)
 def not_found(error):
@@ -513,6 +1302,274 @@ def internal_error(error):
     logger.error(f"❌ خطأ داخلي في الخادم: {error}")
     return jsonify({'status': 'error', 'message': 'Internal server error'}), 500
 
+# --- وضع الخادم غير المتزامن (SERVER_MODE=async) ---
+# نفس المسارات عبر aiohttp: التحديث يعالج داخل حلقة الأحداث والاتصالات الخارجية
+# تتم بعميل HTTP غير متزامن، فآلاف التحديثات المعلقة لا تحتاج آلاف الخيوط
+
+async_telegram = None
+fasl_http = None
+
+async def run_blocking(func, *args):
+    """تنفيذ عملية حاجبة قصيرة (مخزن الحالة، fsync) خارج حلقة الأحداث"""
+    return await asyncio.get_running_loop().run_in_executor(None, lambda: func(*args))
+
+@async_job(send_telegram_message)
+async def send_telegram_message_async(chat_id, text, parse_mode='HTML', reply_markup=None,
+                                      priority=PRIORITY_ACK, throttled=True):
+    """إرسال رسالة إلى Telegram (غير متزامن)"""
+    try:
+        if not TELEGRAM_TOKEN or not chat_id or not text:
+            return False
+
+        if throttled and not await outbound.acquire_async(chat_id, priority, timeout=OUTBOUND_MAX_WAIT):
+            logger.error(f"❌ تجاوز مهلة حدود الإرسال للدردشة {chat_id}")
+            return False
+
+        with function_latency.time('send_telegram_message'):
+            return await async_telegram.send_message(chat_id, text, parse_mode, reply_markup, reschedule=True) is not None
+
+    except FloodWait as e:
+        log_flood_reschedule(e)
+        return queue_message(chat_id, text, parse_mode, reply_markup, priority)
+    except Exception as e:
+        logger.error(f"❌ خطأ في إرسال الرسالة: {e}")
+        return False
+
+@async_job(answer_callback_query)
+async def answer_callback_query_async(callback_id, text=None):
+    """الرد على callback query (غير متزامن)"""
+    try:
+        return await async_telegram.answer_callback_query(callback_id, text) is not None
+    except Exception as e:
+        logger.error(f"❌ خطأ في answer_callback_query: {e}")
+        return False
+
+@async_job(edit_message_reply_markup)
+async def edit_message_reply_markup_async(chat_id, message_id, throttled=True):
+    """تعديل الرسالة لإزالة الأزرار (غير متزامن)"""
+    try:
+        if throttled and not await outbound.acquire_async(chat_id, PRIORITY_APPROVAL, timeout=OUTBOUND_MAX_WAIT):
+            return False
+        return await async_telegram.edit_message_reply_markup(chat_id, message_id, reschedule=True) is not None
+    except FloodWait as e:
+        log_flood_reschedule(e)
+        return queue_edit_reply_markup(chat_id, message_id)
+    except Exception as e:
+        logger.error(f"❌ خطأ في تعديل الرسالة: {e}")
+        return False
+
+@async_job(deliver_approval_request)
+async def deliver_approval_request_async(user_id, user_name, chat_id):
+    """مهمة خلفية بعد منح دور الإرسال: إرسال طلب الموافقة للمدير ثم إبلاغ المستخدم بالنتيجة (غير متزامن)"""
+    success = await send_telegram_message_async(
+        MANAGER_CHAT_ID, approval_request_text(user_id, user_name, chat_id),
+        reply_markup=create_approval_buttons(user_id), priority=PRIORITY_APPROVAL, throttled=False
+    )
+    if success:
+        logger.info(f"✅ تم إرسال طلب موافقة للمدير للمستخدم {user_id}")
+    await run_blocking(approval_delivered, user_id, chat_id, success)
+
+@async_job(process_callback_action)
+async def process_callback_action_async(callback_id, handler, target_user_id, chat_id, message_id, done_text):
+    """مهمة خلفية: تنفيذ القبول أو الرفض محلياً ثم الرد على callback query مرة واحدة (غير متزامن)"""
+    # القرار يكتب في مخزن الحالة فينفذ خارج الحلقة (الإشعارات تجدول كمهام async مستقلة)
+    result = await run_blocking(handler, target_user_id, chat_id, message_id)
+    await answer_callback_query_async(callback_id, callback_result_text(result, target_user_id, done_text))
+
+@async_job(publish_approval_digest)
+async def publish_approval_digest_async(digest):
+    """مهمة خلفية بعد منح دور الإرسال: نشر قائمة طلبات الانضمام للمدير (غير متزامن)"""
+    try:
+        if not MANAGER_CHAT_ID:
+            logger.error("❌ معرف مدير غير موجود")
+            return False
+        digest = await run_blocking(digest_to_publish, digest)
+        text, buttons = digest.render()
+        result = await async_telegram.send_message(MANAGER_CHAT_ID, text, reply_markup=buttons, reschedule=True)
+        return await run_blocking(approval_digest_published, digest, result)
+    except FloodWait as e:
+        log_flood_reschedule(e)
+        return outbound.submit(MANAGER_CHAT_ID, PRIORITY_APPROVAL, publish_approval_digest, digest)
+    except Exception as e:
+        logger.error(f"❌ خطأ في إرسال قائمة طلبات الانضمام: {e}")
+        await run_blocking(requeue_approval_digest, digest)
+        return False
+
+@async_job(refresh_approval_digest)
+async def refresh_approval_digest_async(digest_id):
+    """مهمة خلفية بعد منح دور الإرسال: تعديل رسالة القائمة في مكانها (غير متزامن)"""
+    try:
+        digest = await run_blocking(digest_to_refresh, digest_id)
+        if digest is None:
+            return False
+        text, buttons = digest.render()
+        return await async_telegram.edit_message_text(
+            MANAGER_CHAT_ID, digest.message_id, text, reply_markup=buttons, reschedule=True
+        ) is not None
+    except FloodWait as e:
+        log_flood_reschedule(e)
+        return reschedule_digest_refresh(digest_id)
+    except Exception as e:
+        logger.error(f"❌ خطأ في تعديل قائمة طلبات الانضمام: {e}")
+        return False
+
+@async_job(process_digest_action)
+async def process_digest_action_async(callback_id, action, digest_id, arg):
+    """مهمة خلفية: تنفيذ إجراء من قائمة طلبات الانضمام والرد على callback query (غير متزامن)"""
+    try:
+        text = await run_blocking(apply_digest_action, action, digest_id, arg)
+        await answer_callback_query_async(callback_id, text)
+        return True
+    except Exception as e:
+        logger.error(f"❌ خطأ في تنفيذ إجراء القائمة: {e}")
+        return False
+
+async def post_to_fasl_ai_async(payload):
+    """إرسال طلب واحد إلى n8n (غير متزامن) - يعيد DELIVERED أو RETRY أو REJECTED"""
+    try:
+        async with fasl_http.post(N8N_WEBHOOK_URL, json=payload, headers=fasl_headers(),
+                                  timeout=aiohttp.ClientTimeout(total=15)) as response:
+            return fasl_result(response.status)
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        outbound_responses.inc('n8n', 'webhook', 'error')
+        logger.error(f"❌ خطأ في الاتصال بـ Fasl AI: {e or type(e).__name__}")
+        return RETRY
+
+@timed(function_latency, 'send_to_fasl_ai')
+async def send_to_fasl_ai_async(user_id, chat_id, text, user_name="", parts=None):
+    """إرسال الرسالة إلى Fasl AI (غير متزامن) بنفس منطق القاطع والصندوق الصادر"""
+    try:
+        if not N8N_WEBHOOK_URL:
+            logger.error("❌ عنوان webhook لـ n8n غير موجود")
+            return False
+
+        payload = build_fasl_payload(user_id, chat_id, text, user_name, parts)
+        if payload is None:
+            return False
+
+        if fasl_outbox.has_pending(user_id) or not fasl_breaker.allow():
+            return remember_question(user_id, payload, await run_blocking(queue_for_fasl_ai, user_id, payload))
+
+        result = RETRY
+        try:
+            result = await post_to_fasl_ai_async(payload)
+        finally:
+            record_fasl_result(result)
+        if result == DELIVERED:
+            logger.info("✅ تم إرسال الرسالة إلى Fasl AI للمستخدم %s", user_id, extra=SAMPLED)
+            return remember_question(user_id, payload, True)
+        if result == REJECTED:
+            return False
+        return remember_question(user_id, payload, await run_blocking(queue_for_fasl_ai, user_id, payload))
+
+    except Exception as e:
+        logger.error(f"❌ خطأ في إرسال الرسالة إلى Fasl AI: {e}")
+        return False
+
+@async_job(deliver_question)
+async def deliver_question_async(user_id, chat_id, text, user_name="", parts=None):
+    """مهمة خلفية: إرسال الاستفسار إلى Fasl AI ثم إبلاغ المستخدم (غير متزامن)"""
+    if await send_to_fasl_ai_async(user_id, chat_id, text, user_name, parts):
+        await send_telegram_message_async(chat_id, "✅ تم استلام استفسارك وسيتم الرد قريباً.")
+    else:
+        await send_telegram_message_async(chat_id, "⚠️ عذراً، حدث خطأ في معالجة طلبك. يرجى المحاولة لاحقاً.")
+
+async def set_telegram_webhook_async():
+    """تعيين webhook لـ Telegram (غير متزامن)"""
+    if not TELEGRAM_TOKEN or not APP_URL:
+        logger.warning("⚠️ لا يمكن تعيين webhook - رمز أو عنوان مفقود")
+        return False
+    webhook_url = f"{APP_URL}/webhook"
+    if await async_telegram.set_webhook(webhook_url) is not None:
+        logger.info(f"✅ تم تعيين webhook: {webhook_url}")
+        return True
+    logger.error(f"❌ فشل تعيين webhook: {webhook_url}")
+    return False
+
+async def webhook_async(request):
+    """معالجة webhook من Telegram (غير متزامن)"""
+    started = time.perf_counter()
+    try:
+        data = await request.json()
+    except ValueError:
+        data = None
+    # المعالجة تقرأ وتكتب مخزن الحالة (SQLite) فتنفذ خارج حلقة الأحداث
+    result, code = await run_blocking(process_update, data)
+    webhook_latency.observe(time.perf_counter() - started, result.get('status'))
+    return web.json_response(result, status=code)
+
+async def fasl_reply_async(request):
+    """استلام إجابات Fasl AI من n8n (غير متزامن)"""
+    if not reply_authorized(request.headers.get('X-Telegram-Token')):
+        return web.json_response({'status': 'forbidden'}, status=403)
+    try:
+        data = await request.json()
+    except ValueError:
+        data = None
+    result, code = await run_blocking(handle_fasl_reply, data)
+    return web.json_response(result, status=code)
+
+async def health_check_async(request):
+    return web.json_response(await run_blocking(health_status))
+
+async def set_webhook_async(request):
+    if await set_telegram_webhook_async():
+        return web.json_response({'status': 'success', 'message': 'Webhook set successfully'})
+    return web.json_response({'status': 'error', 'message': 'Failed to set webhook'}, status=500)
+
+async def home_async(request):
+    return web.json_response(home_status())
+
+async def metrics_async(request):
+    return web.Response(body=metrics.render().encode('utf-8'), headers={'Content-Type': METRICS_CONTENT_TYPE})
+
+async def start_async_runtime(aio_app):
+    """إنشاء العملاء غير المتزامنين واستبدال طابور الإرسال بنسخة asyncio"""
+    global dispatcher, async_telegram, fasl_http
+    async_telegram = AsyncTelegramClient(TELEGRAM_TOKEN, base_url=TELEGRAM_API_URL)
+    async_telegram.on_flood = outbound.penalize
+    async_telegram.on_response = telegram.on_response
+    fasl_http = aiohttp.ClientSession()
+    dispatcher = AsyncDispatcher(asyncio.get_running_loop(), workers=ASYNC_WORKERS)
+    dispatcher.start()
+
+async def stop_async_runtime(aio_app):
+    """إنهاء المهام المنتظرة ثم إغلاق الاتصالات"""
+    # الرسائل المجمعة ترسل إلى الطابور قبل إيقافه حتى لا تضيع عند إعادة التشغيل
+    if coalescer is not None:
+        await run_blocking(coalescer.flush_all)
+    await dispatcher.stop()
+    await async_telegram.close()
+    await fasl_http.close()
+
+def create_async_app():
+    """تطبيق aiohttp بنفس مسارات Flask"""
+    if web is None:
+        raise RuntimeError("SERVER_MODE=async يتطلب تثبيت aiohttp")
+
+    @web.middleware
+    async def json_errors(request, handler):
+        try:
+            return await handler(request)
+        except web.HTTPNotFound:
+            return web.json_response({'status': 'error', 'message': 'Endpoint not found'}, status=404)
+        except web.HTTPException:
+            raise
+        except Exception as e:
+            logger.error(f"❌ خطأ داخلي في الخادم: {e}")
+            return web.json_response({'status': 'error', 'message': 'Internal server error'}, status=500)
+
+    aio_app = web.Application(middlewares=[json_errors])
+    aio_app.router.add_post('/webhook', webhook_async)
+    aio_app.router.add_post('/reply', fasl_reply_async)
+    aio_app.router.add_get('/health', health_check_async)
+    aio_app.router.add_get('/set_webhook', set_webhook_async)
+    aio_app.router.add_get('/metrics', metrics_async)
+    aio_app.router.add_get('/', home_async)
+    aio_app.on_startup.append(start_async_runtime)
+    aio_app.on_cleanup.append(stop_async_runtime)
+    return aio_app
+
 if __name__ == '__main__':
     # التحقق من المتغيرات البيئية الأساسية
     if not TELEGRAM_TOKEN:
@@ -523,14 +1580,26 @@ if __name__ == '__main__':
     if not MANAGER_CHAT_ID:
         logger.warning("⚠️ MANAGER_CHAT_ID غير موجود - إشعارات المدير لن تعمل")
 
-    # تعيين webhook تلقائياً
-    set_telegram_webhook()
-    
-    # بدء نظام keep-alive
-    keep_alive()
+    if INGESTION_MODE == 'polling':
+        # الاستطلاع الطويل لا يحتاج webhook ولا keep-alive
+        start_polling()
+    else:
+        # تعيين webhook تلقائياً
+        set_telegram_webhook()
+        
+        # بدء نظام keep-alive
+        keep_alive()
     
     # تشغيل التطبيق
-    logger.info(f"🚀 بدء تشغيل البوت على المنفذ {PORT}")
-    logger.info(f"📊 إحصائيات أولية: {len(user_warnings)} مستخدم، {len(pending_approvals)} في انتظار الموافقة")
+    logger.info(f"🚀 بدء تشغيل البوت على المنفذ {PORT} (الخادم: {SERVER_MODE})")
+    logger.info(f"📊 إحصائيات أولية: {state.count_users()} مستخدم، {state.count_pending()} في انتظار الموافقة")
     
-    app.run(host='0.0.0.0', port=int(PORT), debug=False)
+    if SERVER_MODE == 'async':
+        aio_app = create_async_app()
+        web.run_app(aio_app, host='0.0.0.0', port=int(PORT), print=None)
+    else:
+        app.run(host='0.0.0.0', port=int(PORT), debug=False)
+        # بعد إيقاف الخادم: إرسال الرسائل المجمعة ثم إنهاء المهام المنتظرة
+        if coalescer is not None:
+            coalescer.flush_all()
+        dispatcher.stop()
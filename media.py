@@ -0,0 +1,207 @@
+import hashlib
+import logging
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+# نتائج رفع ملف
+QUEUED = 'queued'
+DELIVERED = 'delivered'
+TOO_LARGE = 'too_large'
+DUPLICATE = 'duplicate'
+BUSY = 'busy'
+FAILED = 'failed'
+
+# أنواع الوسائط المدعومة في رسالة Telegram
+MEDIA_KINDS = ('document', 'photo', 'voice', 'audio', 'video')
+
+
+def extract_media(message):
+    """بيانات الملف المرفق بالرسالة أو None - للصور نأخذ أكبر حجم"""
+    for kind in MEDIA_KINDS:
+        item = message.get(kind)
+        if not item:
+            continue
+        if kind == 'photo':
+            item = max(item, key=lambda size: size.get('file_size') or 0)
+        return {
+            'kind': kind,
+            'file_id': item.get('file_id'),
+            'file_unique_id': item.get('file_unique_id') or item.get('file_id'),
+            'file_size': item.get('file_size') or 0,
+            'file_name': item.get('file_name') or f"{kind}.{'jpg' if kind == 'photo' else 'bin'}",
+            'mime_type': item.get('mime_type') or ('image/jpeg' if kind == 'photo' else 'application/octet-stream')
+        }
+    return None
+
+
+class _Abort(Exception):
+    """إيقاف الرفع أثناء البث (تجاوز الحجم) - n8n يستلم طلباً ناقصاً فيتجاهله"""
+
+    def __init__(self, status):
+        super().__init__(status)
+        self.status = status
+
+
+class MediaForwarder:
+    """تمرير ملفات المستخدمين من Telegram إلى n8n كبث مباشر دون تحميل الملف كاملاً في الذاكرة
+
+    يعمل في مجمع خيوط خاص محدود العدد حتى لا تحجز الملفات الكبيرة عمال الرسائل النصية."""
+
+    def __init__(self, telegram, upload_url, headers=None, max_bytes=20 * 1024 * 1024, concurrency=2,
+                 max_queue=20, chunk_size=64 * 1024, dedup_size=10000, timeout=120):
+        self.telegram = telegram
+        self.upload_url = upload_url
+        # دالة تعيد ترويسات إضافية لطلب الرفع (رمز n8n)
+        self.headers = headers or (lambda: {})
+        self.max_bytes = max_bytes
+        self.max_queue = max_queue
+        self.chunk_size = chunk_size
+        self.dedup_size = dedup_size
+        self.timeout = timeout
+        # دالة اختيارية تستدعى مع كل استجابة من n8n: on_response(status_code أو 'error')
+        self.on_response = None
+
+        self.session = requests.Session()
+        self.session.mount('https://', HTTPAdapter(pool_maxsize=concurrency))
+        self.session.mount('http://', HTTPAdapter(pool_maxsize=concurrency))
+        self._executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='media-upload')
+        self._lock = threading.Lock()
+        # (user_id، file_unique_id) للملفات المرسلة أو قيد الإرسال - يفحص قبل بدء التحميل
+        # (file_unique_id ثابت لنفس الملف في Telegram فلا حاجة لانتظار نهاية البث لحساب المحتوى)
+        self._seen = OrderedDict()
+        self._queued = 0
+        self.counts = {DELIVERED: 0, TOO_LARGE: 0, DUPLICATE: 0, BUSY: 0, FAILED: 0}
+        self.bytes_uploaded = 0
+
+    # --- منع التكرار ---
+
+    def _remember_locked(self, key):
+        self._seen[key] = True
+        self._seen.move_to_end(key)
+        while len(self._seen) > self.dedup_size:
+            self._seen.popitem(last=False)
+
+    def _count(self, status):
+        with self._lock:
+            self.counts[status] += 1
+        return status
+
+    # --- الواجهة ---
+
+    def submit(self, user_id, media, fields, on_done):
+        """جدولة رفع ملف - يعيد QUEUED أو سبب الرفض الفوري؛ on_done(status) تستدعى بعد الرفع"""
+        if media['file_size'] > self.max_bytes:
+            return self._count(TOO_LARGE)
+        key = (user_id, media['file_unique_id'])
+        with self._lock:
+            if key in self._seen:
+                self.counts[DUPLICATE] += 1
+                return DUPLICATE
+            if self._queued >= self.max_queue:
+                self.counts[BUSY] += 1
+                return BUSY
+            self._remember_locked(key)
+            self._queued += 1
+        self._executor.submit(self._upload_job, user_id, key, media, fields, on_done)
+        return QUEUED
+
+    def _upload_job(self, user_id, key, media, fields, on_done):
+        state = {'size': 0}
+        try:
+            status = self._upload(user_id, media, fields, state)
+        except Exception as e:
+            logger.error(f"❌ خطأ في رفع ملف المستخدم {user_id}: {e}")
+            status = FAILED
+        with self._lock:
+            self._queued -= 1
+            self.counts[status] += 1
+            if status != DELIVERED:
+                # السماح بإعادة إرسال الملف بعد الفشل
+                self._seen.pop(key, None)
+        try:
+            on_done(status)
+        except Exception as e:
+            logger.error(f"❌ خطأ في إبلاغ نتيجة رفع الملف: {e}")
+
+    def _upload(self, user_id, media, fields, state):
+        file_info = self.telegram.call('getFile', {'file_id': media['file_id']})
+        if not file_info or not file_info.get('file_path'):
+            return FAILED
+        if (file_info.get('file_size') or 0) > self.max_bytes:
+            return TOO_LARGE
+
+        download = self.telegram.session.get(
+            f"{self.telegram.base_url}/file/bot{self.telegram.token}/{file_info['file_path']}",
+            stream=True, timeout=(10, self.timeout)
+        )
+        try:
+            if download.status_code != 200:
+                logger.error(f"❌ فشل تحميل الملف من Telegram: {download.status_code}")
+                return FAILED
+
+            boundary = uuid.uuid4().hex
+            headers = dict(self.headers())
+            headers['Content-Type'] = f"multipart/form-data; boundary={boundary}"
+            started = time.monotonic()
+            try:
+                response = self.session.post(
+                    self.upload_url, data=self._multipart(boundary, fields, media, download, state),
+                    headers=headers, timeout=(10, self.timeout)
+                )
+            except _Abort as e:
+                return e.status
+            except requests.RequestException as e:
+                if self.on_response:
+                    self.on_response('error')
+                logger.error(f"❌ خطأ في رفع الملف إلى n8n: {e}")
+                return FAILED
+        finally:
+            download.close()
+
+        if self.on_response:
+            self.on_response(response.status_code)
+        if response.status_code != 200:
+            logger.error(f"❌ رفض n8n الملف: {response.status_code}")
+            return FAILED
+        with self._lock:
+            self.bytes_uploaded += state['size']
+        logger.info(f"📎 تم رفع ملف {media['kind']} للمستخدم {user_id}: "
+                    f"{state['size'] / 1024:.0f}KB في {time.monotonic() - started:.1f}ث")
+        return DELIVERED
+
+    def _multipart(self, boundary, fields, media, download, state):
+        """جسم multipart يبث أجزاء الملف فور وصولها من Telegram مع حساب sha256 لتتحقق منه n8n"""
+        for name, value in fields.items():
+            yield (f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n'
+                   f'{"" if value is None else value}\r\n').encode('utf-8')
+        file_name = media['file_name'].replace('"', '').replace('\r', '').replace('\n', '')
+        yield (f'--{boundary}\r\nContent-Disposition: form-data; name="file"; filename="{file_name}"\r\n'
+               f'Content-Type: {media["mime_type"]}\r\n\r\n').encode('utf-8')
+
+        digest = hashlib.sha256()
+        for chunk in download.iter_content(self.chunk_size):
+            state['size'] += len(chunk)
+            if state['size'] > self.max_bytes:
+                raise _Abort(TOO_LARGE)
+            digest.update(chunk)
+            yield chunk
+
+        sha256 = digest.hexdigest()
+        yield (f'\r\n--{boundary}\r\nContent-Disposition: form-data; name="sha256"\r\n\r\n{sha256}\r\n'
+               f'--{boundary}--\r\n').encode('utf-8')
+
+    def stats(self):
+        with self._lock:
+            return {
+                'queued': self._queued,
+                'bytes_uploaded': self.bytes_uploaded,
+                **self.counts
+            }
@@ -0,0 +1,391 @@
+import fcntl
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+# نتائج محاولة التسليم
+DELIVERED = 'delivered'
+RETRY = 'retry'
+REJECTED = 'rejected'
+
+
+class CircuitBreaker:
+    """قاطع دائرة: يرفض الطلبات فوراً بعد تكرار الفشل ثم يجرب طلباً واحداً بعد مهلة"""
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0, clock=time.monotonic):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._trial_running = False
+
+    @property
+    def state(self):
+        with self._lock:
+            if self._state == self.OPEN and self._clock() - self._opened_at >= self.reset_timeout:
+                return self.HALF_OPEN
+            return self._state
+
+    def allow(self):
+        """هل يسمح بمحاولة الآن؟ في الحالة نصف المفتوحة يسمح بمحاولة تجريبية واحدة"""
+        with self._lock:
+            if self._state == self.CLOSED:
+                return True
+            if self._state == self.OPEN:
+                if self._clock() - self._opened_at < self.reset_timeout:
+                    return False
+                self._state = self.HALF_OPEN
+                self._trial_running = False
+            if self._trial_running:
+                return False
+            self._trial_running = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            if self._state != self.CLOSED:
+                logger.info("✅ عودة الاتصال - إغلاق قاطع الدائرة")
+            self._state = self.CLOSED
+            self._failures = 0
+            self._trial_running = False
+
+    def cancel_trial(self):
+        """إلغاء محاولة تجريبية سمح بها allow دون إرسال طلب"""
+        with self._lock:
+            self._trial_running = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            self._trial_running = False
+            if self._state == self.HALF_OPEN or self._failures >= self.failure_threshold:
+                if self._state != self.OPEN:
+                    logger.warning(f"🔌 فتح قاطع الدائرة بعد {self._failures} محاولات فاشلة")
+                self._state = self.OPEN
+                self._opened_at = self._clock()
+
+    def retry_in(self):
+        """الوقت المتبقي قبل السماح بمحاولة تجريبية"""
+        with self._lock:
+            if self._state != self.OPEN:
+                return 0.0
+            return max(0.0, self.reset_timeout - (self._clock() - self._opened_at))
+
+    def stats(self):
+        return {'state': self.state, 'failures': self._failures}
+
+
+class Outbox:
+    """صندوق صادر دائم على القرص: سجل إلحاقي مقسم إلى ملفات مع تجميع fsync
+
+    كل سطر إما رسالة {"id", "key", "payload"} أو تأكيد تسليم {"ack": id}.
+    تحذف الملفات الأقدم فقط عندما تُسلم جميع رسائلها، فلا تفقد التأكيدات."""
+
+    def __init__(self, directory='outbox', segment_bytes=1024 * 1024, fsync_interval=0.05):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.fsync_interval = fsync_interval
+        os.makedirs(directory, exist_ok=True)
+
+        self._lock = threading.Condition()
+        # رسائل غير مسلمة لكل مفتاح (مستخدم) بالترتيب
+        self._pending = OrderedDict()
+        self._inflight = set()
+        # لكل ملف: عدد الرسائل غير المسلمة فيه
+        self._segment_open = OrderedDict()
+        self._record_segment = {}
+        self._next_id = 1
+        self._segment_seq = 0
+        self._handle = None
+        self._written = 0
+        self._synced = 0
+        self.dead_letters = 0
+
+        self._load()
+        self._open_segment()
+        self._sync_thread = threading.Thread(target=self._sync_loop, name='outbox-fsync', daemon=True)
+        self._sync_thread.start()
+
+    # --- الملفات ---
+
+    def _segment_path(self, seq):
+        return os.path.join(self.directory, f"segment-{seq:08d}.log")
+
+    def _segments(self):
+        names = sorted(name for name in os.listdir(self.directory)
+                       if name.startswith('segment-') and name.endswith('.log'))
+        return [int(name[8:-4]) for name in names]
+
+    def _load(self):
+        """إعادة بناء قائمة الرسائل غير المسلمة من الملفات بعد إعادة التشغيل"""
+        records = OrderedDict()
+        acked = set()
+        for seq in self._segments():
+            self._segment_seq = max(self._segment_seq, seq)
+            self._segment_open[seq] = 0
+            with open(self._segment_path(seq), encoding='utf-8') as handle:
+                for line in handle:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # سطر غير مكتمل بسبب توقف مفاجئ أثناء الكتابة
+                        continue
+                    if 'ack' in entry:
+                        acked.add(entry['ack'])
+                    else:
+                        records[entry['id']] = (seq, entry)
+                        self._next_id = max(self._next_id, entry['id'] + 1)
+
+        for record_id, (seq, entry) in records.items():
+            if record_id in acked:
+                continue
+            self._pending.setdefault(entry['key'], deque()).append(entry)
+            self._record_segment[record_id] = seq
+            self._segment_open[seq] += 1
+
+        if self._pending:
+            logger.info(f"📬 تم تحميل {self.depth()} رسالة غير مسلمة من الصندوق الصادر")
+        self._collect_segments()
+
+    def _open_segment(self):
+        if self._handle is not None:
+            self._handle.flush()
+            os.fsync(self._handle.fileno())
+            self._handle.close()
+        self._segment_seq += 1
+        self._segment_open[self._segment_seq] = 0
+        self._handle = open(self._segment_path(self._segment_seq), 'a', encoding='utf-8')
+
+    def _collect_segments(self):
+        # حذف الملفات الأقدم المسلمة بالكامل (بالترتيب فقط)
+        for seq in list(self._segment_open):
+            if seq == self._segment_seq or self._segment_open[seq] > 0:
+                break
+            del self._segment_open[seq]
+            try:
+                os.remove(self._segment_path(seq))
+            except OSError:
+                pass
+
+    def _write_locked(self, entry):
+        self._handle.write(json.dumps(entry, ensure_ascii=False) + '\n')
+        self._handle.flush()
+        self._written += 1
+        if self._handle.tell() >= self.segment_bytes:
+            self._open_segment()
+            self._synced = self._written
+        return self._written
+
+    def _sync_loop(self):
+        while True:
+            with self._lock:
+                while self._synced >= self._written:
+                    self._lock.wait()
+            # انتظار قصير لتجميع أكبر عدد من الكتابات في fsync واحد
+            time.sleep(self.fsync_interval)
+            with self._lock:
+                target = self._written
+                handle = self._handle
+                try:
+                    os.fsync(handle.fileno())
+                except (OSError, ValueError) as e:
+                    logger.error(f"❌ خطأ في fsync للصندوق الصادر: {e}")
+                self._synced = max(self._synced, target)
+                self._lock.notify_all()
+
+    def _wait_synced(self, position):
+        self._lock.notify_all()
+        while self._synced < position:
+            self._lock.wait()
+
+    # --- الواجهة ---
+
+    def append(self, key, payload):
+        """حفظ رسالة بشكل دائم - يعود بعد وصولها للقرص (fsync مجمع)"""
+        key = str(key)
+        with self._lock:
+            entry = {'id': self._next_id, 'key': key, 'payload': payload}
+            self._next_id += 1
+            seq = self._segment_seq
+            position = self._write_locked(entry)
+            self._pending.setdefault(key, deque()).append(entry)
+            self._record_segment[entry['id']] = seq
+            self._segment_open[seq] += 1
+            self._wait_synced(position)
+        return entry['id']
+
+    def ack(self, entry):
+        """تأكيد تسليم رسالة"""
+        with self._lock:
+            self._write_locked({'ack': entry['id']})
+            queue = self._pending.get(entry['key'])
+            if queue and queue[0]['id'] == entry['id']:
+                queue.popleft()
+                if not queue:
+                    del self._pending[entry['key']]
+            seq = self._record_segment.pop(entry['id'], None)
+            if seq is not None:
+                self._segment_open[seq] -= 1
+                self._collect_segments()
+            self._inflight.discard(entry['key'])
+            self._lock.notify_all()
+
+    def dead_letter(self, entry, reason):
+        """نقل رسالة رفضها الخادم إلى ملف الرسائل المرفوضة للمراجعة ثم تأكيدها"""
+        record = dict(entry, reason=reason, at=time.time())
+        with self._lock:
+            with open(os.path.join(self.directory, 'dead-letter.log'), 'a', encoding='utf-8') as handle:
+                handle.write(json.dumps(record, ensure_ascii=False) + '\n')
+                handle.flush()
+                os.fsync(handle.fileno())
+            self.dead_letters += 1
+        self.ack(entry)
+
+    def has_pending(self, key):
+        return str(key) in self._pending
+
+    def heads(self, limit):
+        """أول رسالة لكل مستخدم غير قيد التسليم (للحفاظ على ترتيب كل مستخدم)"""
+        with self._lock:
+            result = []
+            for key, queue in self._pending.items():
+                if key in self._inflight:
+                    continue
+                self._inflight.add(key)
+                result.append(queue[0])
+                if len(result) >= limit:
+                    break
+            return result
+
+    def release(self, entry):
+        """إعادة رسالة للانتظار بعد فشل التسليم"""
+        with self._lock:
+            self._inflight.discard(entry['key'])
+            self._lock.notify_all()
+
+    def depth(self):
+        return sum(len(queue) for queue in self._pending.values())
+
+    def stats(self):
+        with self._lock:
+            return {
+                'depth': self.depth(),
+                'users': len(self._pending),
+                'segments': len(self._segment_open),
+                'dead_letters': self.dead_letters
+            }
+
+
+class OutboxReplayer:
+    """إعادة إرسال رسائل الصندوق الصادر عند إغلاق الدائرة بتوازي محدود"""
+
+    def __init__(self, outbox, breaker, deliver, concurrency=4, idle_interval=1.0, on_rejected=None):
+        # deliver(payload) -> DELIVERED أو RETRY أو REJECTED
+        # on_rejected(payload) - تستدعى بعد نقل رسالة مرفوضة إلى ملف الرسائل المرفوضة
+        self.outbox = outbox
+        self.breaker = breaker
+        self.deliver = deliver
+        self.on_rejected = on_rejected
+        self.concurrency = max(1, concurrency)
+        self.idle_interval = idle_interval
+        self._executor = ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix='outbox-replay')
+        self._wakeup = threading.Event()
+        self._thread = None
+        self.replayed = 0
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='outbox-replayer', daemon=True)
+            self._thread.start()
+
+    def notify(self):
+        self._wakeup.set()
+
+    def _run(self):
+        while True:
+            if not self.outbox.depth():
+                self._wakeup.wait(self.idle_interval)
+                self._wakeup.clear()
+                continue
+
+            if not self.breaker.allow():
+                self._wakeup.wait(max(self.breaker.retry_in(), 0.1))
+                self._wakeup.clear()
+                continue
+
+            # في الحالة نصف المفتوحة نجرب رسالة واحدة فقط
+            limit = self.concurrency if self.breaker.state == CircuitBreaker.CLOSED else 1
+            batch = self.outbox.heads(limit)
+            if not batch:
+                # كل الرسائل قيد التسليم - لا نتيجة تغير حالة الدائرة
+                self.breaker.cancel_trial()
+                self._wakeup.wait(self.idle_interval)
+                self._wakeup.clear()
+                continue
+
+            failed = True
+            try:
+                results = list(self._executor.map(self._deliver_one, batch))
+                failed = any(result == RETRY for result in results)
+            except Exception as e:
+                logger.error(f"❌ خطأ في إعادة إرسال الصندوق الصادر: {e}")
+            finally:
+                # تسجيل النتيجة دائماً حتى لا تبقى المحاولة التجريبية معلقة
+                if failed:
+                    self.breaker.record_failure()
+                else:
+                    self.breaker.record_success()
+
+    def _deliver_one(self, entry):
+        try:
+            result = self.deliver(entry['payload'])
+        except Exception as e:
+            logger.error(f"❌ خطأ في إعادة إرسال رسالة الصندوق الصادر: {e}")
+            result = RETRY
+
+        if result == RETRY:
+            self.outbox.release(entry)
+        elif result == REJECTED:
+            logger.error(f"❌ رفض الخادم رسالة الصندوق الصادر {entry['id']} - نقلت إلى ملف الرسائل المرفوضة")
+            self.outbox.dead_letter(entry, REJECTED)
+            self.replayed += 1
+            if self.on_rejected is not None:
+                try:
+                    self.on_rejected(entry['payload'])
+                except Exception as e:
+                    logger.error(f"❌ خطأ في إبلاغ رفض رسالة الصندوق الصادر: {e}")
+        else:
+            self.outbox.ack(entry)
+            self.replayed += 1
+        return result
+
+
+def open_outbox(base_directory='outbox', max_slots=64, **kwargs):
+    """فتح صندوق صادر خاص بهذه العملية - كل عامل يحجز مجلداً بقفل ملف حتى لا تتشارك العمال نفس الملفات"""
+    os.makedirs(base_directory, exist_ok=True)
+    for slot in range(max_slots):
+        lock_path = os.path.join(base_directory, f"slot-{slot}.lock")
+        handle = open(lock_path, 'a')
+        try:
+            fcntl.flock(handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            handle.close()
+            continue
+        outbox = Outbox(os.path.join(base_directory, f"slot-{slot}"), **kwargs)
+        # الإبقاء على القفل طوال عمر العملية
+        outbox.lock_handle = handle
+        return outbox
+    raise RuntimeError(f"لا يوجد مجلد متاح للصندوق الصادر في {base_directory}")
@@ -0,0 +1,152 @@
+import json
+import logging
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+
+def update_chat_key(update):
+    """مفتاح الدردشة للتحديث - تحديثات نفس الدردشة تعالج بالترتيب"""
+    message = update.get('message') or (update.get('callback_query') or {}).get('message') or {}
+    chat_id = (message.get('chat') or {}).get('id')
+    if chat_id is not None:
+        return chat_id
+    return f"update:{update.get('update_id')}"
+
+
+class UpdatePoller:
+    """استقبال التحديثات عبر getUpdates بدفعات بدل webhook"""
+
+    def __init__(self, client, handler, offset_path='telegram_offset.json', limit=100,
+                 timeout=50, workers=8, allowed_updates=None, max_attempts=5):
+        # handler(update) نفس دالة المعالجة المستخدمة في webhook - تعيد (الحالة، رمز HTTP)
+        self.client = client
+        self.handler = handler
+        self.offset_path = offset_path
+        self.limit = limit
+        self.timeout = timeout
+        self.allowed_updates = allowed_updates
+        # عدد محاولات التحديث الفاشل قبل تجاوزه حتى لا يوقف تحديث معطوب الاستقبال كله
+        self.max_attempts = max_attempts
+        self._attempts = {}
+        self._executor = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix='poll-worker')
+        self._stop = threading.Event()
+        self._thread = None
+        self.offset = self._load_offset()
+        self.batches = 0
+        self.updates = 0
+        self.retried = 0
+        self.skipped = 0
+
+    def _load_offset(self):
+        try:
+            with open(self.offset_path, encoding='utf-8') as handle:
+                return json.load(handle).get('offset')
+        except (OSError, ValueError):
+            return None
+
+    def _save_offset(self):
+        # كتابة ذرية حتى لا يتلف الملف عند التوقف المفاجئ
+        temp_path = f"{self.offset_path}.tmp"
+        with open(temp_path, 'w', encoding='utf-8') as handle:
+            json.dump({'offset': self.offset}, handle)
+            handle.flush()
+            os.fsync(handle.fileno())
+        os.replace(temp_path, self.offset_path)
+
+    def _handle(self, update):
+        """معالجة تحديث واحد - يعيد False إذا فشل (استثناء أو رمز 5xx) ويجب إعادة استلامه"""
+        try:
+            result = self.handler(update)
+        except Exception as e:
+            logger.error(f"❌ خطأ في معالجة التحديث {update.get('update_id')}: {e}")
+            return False
+        if isinstance(result, tuple) and len(result) == 2 and result[1] >= 500:
+            logger.warning(f"⚠️ فشلت معالجة التحديث {update.get('update_id')} - سيعاد استلامه")
+            return False
+        return True
+
+    def _process_chat(self, updates):
+        """تحديثات دردشة واحدة بالترتيب - يتوقف عند أول فشل ويعيد رقمه (None إذا نجحت كلها)"""
+        for update in updates:
+            if self._handle(update):
+                continue
+            update_id = update['update_id']
+            attempts = self._attempts.get(update_id, 0) + 1
+            if attempts < self.max_attempts:
+                self._attempts[update_id] = attempts
+                # التحديثات التالية لنفس الدردشة تنتظر حتى لا يختل ترتيبها
+                return update_id
+            self._attempts.pop(update_id, None)
+            self.skipped += 1
+            logger.error(f"❌ تجاوز التحديث {update_id} بعد {attempts} محاولات فاشلة")
+        return None
+
+    def process_batch(self, updates):
+        """معالجة دفعة: الدردشات المختلفة بالتوازي وتحديثات كل دردشة بالترتيب
+
+        يعيد True إذا عولجت كلها، وإلا تبقى الإزاحة عند أول تحديث فاشل فيعاد استلامه مع ما بعده
+        (ما نجح منها يتجاهله dedup)."""
+        if not updates:
+            return True
+        by_chat = OrderedDict()
+        for update in sorted(updates, key=lambda item: item.get('update_id', 0)):
+            by_chat.setdefault(update_chat_key(update), []).append(update)
+        failed = [update_id for update_id in self._executor.map(self._process_chat, by_chat.values())
+                  if update_id is not None]
+
+        # حفظ الإزاحة بعد انتهاء الدفعة فقط (التكرار عند إعادة التشغيل يمنعه dedup)
+        if failed:
+            self.offset = min(failed)
+            self.retried += 1
+        else:
+            self.offset = max(update['update_id'] for update in updates) + 1
+            self._attempts.clear()
+        self._save_offset()
+        self.batches += 1
+        self.updates += len(updates)
+        return not failed
+
+    def poll_once(self):
+        """استطلاع ومعالجة دفعة - يعيد عدد التحديثات أو None عند فشل getUpdates أو معالجة تحديث"""
+        updates = self.client.get_updates(self.offset, self.limit, self.timeout, self.allowed_updates)
+        if updates is None:
+            return None
+        if not self.process_batch(updates):
+            return None
+        return len(updates)
+
+    def run(self):
+        logger.info(f"🚀 بدء استقبال التحديثات عبر getUpdates (الإزاحة: {self.offset})")
+        failures = 0
+        while not self._stop.is_set():
+            try:
+                count = self.poll_once()
+            except Exception as e:
+                logger.error(f"❌ خطأ في getUpdates: {e}")
+                count = None
+            if count is None:
+                failures += 1
+                self._stop.wait(min(30, 2 ** min(failures, 5)))
+            else:
+                failures = 0
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self.run, name='update-poller', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def stats(self):
+        return {
+            'offset': self.offset,
+            'batches': self.batches,
+            'updates': self.updates,
+            'retried_batches': self.retried,
+            'skipped_updates': self.skipped
+        }
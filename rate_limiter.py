@@ -0,0 +1,328 @@
+import asyncio
+import bisect
+import itertools
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# أولويات الإرسال (الأصغر أولاً): طلبات الموافقة للمدير ثم التحذيرات ثم الإشعارات ثم البث الجماعي
+PRIORITY_APPROVAL = 0
+PRIORITY_WARNING = 1
+PRIORITY_ACK = 2
+PRIORITY_BULK = 3
+
+
+class TokenBucket:
+    """دلو رموز بسيط: معدل تعبئة في الثانية وسعة قصوى للدفعات"""
+
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated')
+
+    def __init__(self, rate, capacity, now):
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self.tokens = float(capacity)
+        self.updated = now
+
+    def refill(self, now):
+        if now > self.updated:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    def wait_time(self, now):
+        """الوقت المتبقي حتى يتوفر رمز واحد (0 إذا كان متوفراً)"""
+        self.refill(now)
+        # هامش صغير لتفادي أخطاء التقريب العشري
+        if self.tokens >= 1 - 1e-9:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+    def is_idle(self, now):
+        self.refill(now)
+        return self.tokens >= self.capacity
+
+
+class SimulatedClock:
+    """ساعة وهمية حتمية لاختبار الجدولة دون انتظار فعلي"""
+
+    def __init__(self, start=0.0):
+        self.now = float(start)
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += max(0.0, seconds)
+
+    def advance_to(self, moment):
+        self.now = max(self.now, moment)
+
+
+class _Ticket:
+    __slots__ = ('priority', 'seq', 'chat_id', 'func', 'args', 'kwargs', 'event', 'granted', 'submitted')
+
+    def __init__(self, priority, seq, chat_id, func=None, args=(), kwargs=None, submitted=0.0):
+        self.priority = priority
+        self.seq = seq
+        self.chat_id = chat_id
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs or {}
+        self.event = None
+        self.granted = None
+        self.submitted = submitted
+
+    def __lt__(self, other):
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+
+class _AsyncGrant:
+    """بديل threading.Event لتذاكر asyncio: خيط الجدولة يكمل الـ future داخل حلقته"""
+
+    __slots__ = ('loop', 'future')
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.future = loop.create_future()
+
+    def _resolve(self):
+        if not self.future.done():
+            self.future.set_result(True)
+
+    def set(self):
+        self.loop.call_soon_threadsafe(self._resolve)
+
+
+class OutboundScheduler:
+    """جدولة الرسائل الصادرة وفق حدود Telegram: عام، لكل دردشة خاصة، ولكل مجموعة"""
+
+    def __init__(self, global_rate=30.0, private_rate=1.0, group_rate=20.0 / 60,
+                 global_burst=30, private_burst=3, group_burst=5,
+                 clock=time.monotonic, executor=None):
+        self.global_rate = global_rate
+        self.private_rate = private_rate
+        self.group_rate = group_rate
+        self.private_burst = private_burst
+        self.group_burst = group_burst
+        self._clock = clock
+        # دالة تنفيذ المهام الممنوحة: executor(chat_id, func, *args, **kwargs)
+        self._executor = executor or (lambda chat_id, func, *args, **kwargs: func(*args, **kwargs))
+
+        self._global = TokenBucket(global_rate, global_burst, clock())
+        self._chats = {}
+        self._waiting = []
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._thread = None
+        self._grants = 0
+        self.sent = 0
+        self.timeouts = 0
+        # دالة اختيارية تستدعى عند منح كل دور: on_wait(priority, seconds) - زمن الانتظار في الطابور
+        self.on_wait = None
+
+    @staticmethod
+    def is_group(chat_id):
+        # معرفات المجموعات والقنوات في Telegram سالبة
+        try:
+            return int(chat_id) < 0
+        except (TypeError, ValueError):
+            return str(chat_id).startswith('@')
+
+    def _chat_bucket(self, chat_id, now):
+        key = str(chat_id)
+        bucket = self._chats.get(key)
+        if bucket is None:
+            if self.is_group(chat_id):
+                bucket = TokenBucket(self.group_rate, self.group_burst, now)
+            else:
+                bucket = TokenBucket(self.private_rate, self.private_burst, now)
+            self._chats[key] = bucket
+        return bucket
+
+    def _prune_locked(self, now):
+        # حذف دلاء الدردشات الخاملة (الممتلئة) للحفاظ على الذاكرة
+        waiting_chats = {str(ticket.chat_id) for ticket in self._waiting}
+        for key in [key for key, bucket in self._chats.items()
+                    if key not in waiting_chats and bucket.is_idle(now)]:
+            del self._chats[key]
+
+    def _grant_ready_locked(self, now):
+        """منح الرموز للطلبات المؤهلة حسب الأولوية - يعيد (الممنوحة، مهلة الانتظار التالية)"""
+        granted = []
+        next_delay = None
+        for ticket in self._waiting:
+            global_wait = self._global.wait_time(now)
+            if global_wait > 0:
+                next_delay = global_wait if next_delay is None else min(next_delay, global_wait)
+                break
+            bucket = self._chat_bucket(ticket.chat_id, now)
+            chat_wait = bucket.wait_time(now)
+            if chat_wait > 0:
+                # دردشة مشغولة لا تعطل بقية الدردشات
+                next_delay = chat_wait if next_delay is None else min(next_delay, chat_wait)
+                continue
+            self._global.take()
+            bucket.take()
+            ticket.granted = now
+            granted.append(ticket)
+
+        if granted:
+            granted_ids = {id(ticket) for ticket in granted}
+            self._waiting = [ticket for ticket in self._waiting if id(ticket) not in granted_ids]
+            self._grants += len(granted)
+            self.sent += len(granted)
+            if self._grants >= 1000:
+                self._grants = 0
+                self._prune_locked(now)
+        return granted, next_delay
+
+    def _ensure_thread(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='outbound-scheduler', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                granted, delay = self._grant_ready_locked(self._clock())
+                if not granted:
+                    self._cond.wait(delay if delay is not None else None)
+                    continue
+                self._cond.notify_all()
+            for ticket in granted:
+                self._record_wait(ticket.priority, ticket.granted - ticket.submitted)
+                if ticket.event is not None:
+                    ticket.event.set()
+                else:
+                    try:
+                        self._executor(ticket.chat_id, ticket.func, *ticket.args, **ticket.kwargs)
+                    except Exception as e:
+                        logger.error(f"❌ خطأ في تنفيذ رسالة مجدولة: {e}")
+
+    def _record_wait(self, priority, seconds):
+        if self.on_wait is None:
+            return
+        try:
+            self.on_wait(priority, seconds)
+        except Exception as e:
+            logger.error(f"❌ خطأ في تسجيل زمن انتظار الإرسال: {e}")
+
+    def submit(self, chat_id, priority, func, *args, **kwargs):
+        """جدولة إرسال دون انتظار - تنفذ الدالة عند توفر الرموز"""
+        with self._cond:
+            ticket = _Ticket(priority, next(self._seq), chat_id, func, args, kwargs, self._clock())
+            bisect.insort(self._waiting, ticket)
+            self._ensure_thread()
+            self._cond.notify_all()
+        return True
+
+    def _enqueue_waiter(self, chat_id, priority, event):
+        """منح فوري إن أمكن وإلا إضافة تذكرة تنتظر event - يعيد None عند المنح الفوري"""
+        with self._cond:
+            ticket = _Ticket(priority, next(self._seq), chat_id, submitted=self._clock())
+            # مسار سريع: لا يوجد طابور والرموز متوفرة
+            if not self._waiting and self._global.wait_time(ticket.submitted) == 0:
+                bucket = self._chat_bucket(chat_id, ticket.submitted)
+                if bucket.wait_time(ticket.submitted) == 0:
+                    self._global.take()
+                    bucket.take()
+                    self.sent += 1
+                    return None
+            ticket.event = event
+            bisect.insort(self._waiting, ticket)
+            self._ensure_thread()
+            self._cond.notify_all()
+            return ticket
+
+    def _cancel_waiter(self, ticket):
+        with self._cond:
+            if ticket.granted is not None:
+                return True
+            self._waiting.remove(ticket)
+            self.timeouts += 1
+        logger.warning(f"⏳ انتهت مهلة انتظار الإرسال إلى الدردشة {ticket.chat_id}")
+        return False
+
+    def acquire(self, chat_id, priority=PRIORITY_ACK, timeout=None):
+        """انتظار دور الإرسال (للاستدعاءات المتزامنة) - يعيد False عند انتهاء المهلة"""
+        ticket = self._enqueue_waiter(chat_id, priority, threading.Event())
+        if ticket is None:
+            self._record_wait(priority, 0.0)
+            return True
+        if ticket.event.wait(timeout):
+            return True
+        return self._cancel_waiter(ticket)
+
+    async def acquire_async(self, chat_id, priority=PRIORITY_ACK, timeout=None):
+        """انتظار دور الإرسال داخل حلقة asyncio دون حجز خيط"""
+        event = _AsyncGrant(asyncio.get_running_loop())
+        ticket = self._enqueue_waiter(chat_id, priority, event)
+        if ticket is None:
+            self._record_wait(priority, 0.0)
+            return True
+        try:
+            return await asyncio.wait_for(asyncio.shield(event.future), timeout)
+        except asyncio.TimeoutError:
+            return self._cancel_waiter(ticket)
+
+    def penalize(self, chat_id, seconds):
+        """إيقاف الإرسال لدردشة (أو للجميع إذا لم تحدد) بعد استجابة 429"""
+        with self._cond:
+            now = self._clock()
+            bucket = self._global if chat_id is None else self._chat_bucket(chat_id, now)
+            bucket.refill(now)
+            # بعد انقضاء المهلة يتوفر رمز واحد فقط
+            bucket.tokens = min(bucket.tokens, 1.0 - float(seconds) * bucket.rate)
+            self._cond.notify_all()
+
+    def simulate(self, sends):
+        """محاكاة حتمية بالساعة الوهمية: sends قائمة (وقت الإرسال، chat_id، الأولوية)
+        تعيد قائمة بالوقت الفعلي لكل رسالة بنفس الترتيب"""
+        if not isinstance(self._clock, SimulatedClock):
+            raise ValueError("simulate يتطلب SimulatedClock")
+        clock = self._clock
+        arrivals = sorted(range(len(sends)), key=lambda index: sends[index][0])
+        results = [None] * len(sends)
+        position = 0
+        with self._cond:
+            while position < len(arrivals) or self._waiting:
+                while position < len(arrivals) and sends[arrivals[position]][0] <= clock.now:
+                    index = arrivals[position]
+                    _, chat_id, priority = sends[index]
+                    ticket = _Ticket(priority, next(self._seq), chat_id, args=(index,), submitted=clock.now)
+                    bisect.insort(self._waiting, ticket)
+                    position += 1
+                granted, delay = self._grant_ready_locked(clock.now)
+                for ticket in granted:
+                    index = ticket.args[0]
+                    results[index] = {
+                        'chat_id': ticket.chat_id,
+                        'priority': ticket.priority,
+                        'submitted': ticket.submitted,
+                        'sent': ticket.granted
+                    }
+                candidates = []
+                if position < len(arrivals):
+                    candidates.append(sends[arrivals[position]][0])
+                if self._waiting and delay is not None:
+                    candidates.append(clock.now + delay)
+                if not candidates:
+                    break
+                clock.advance_to(min(candidates))
+        return results
+
+    def depth(self):
+        return len(self._waiting)
+
+    def stats(self):
+        with self._cond:
+            return {
+                'waiting': len(self._waiting),
+                'tracked_chats': len(self._chats),
+                'sent': self.sent,
+                'timeouts': self.timeouts
+            }
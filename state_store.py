@@ -0,0 +1,806 @@
+import heapq
+import json
+import logging
+import queue
+import sqlite3
+import sys
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+# عدد التحذيرات الذي يعني الحظر
+BAN_THRESHOLD = 3
+# عدد سجلات حذف ذاكرة الإجابات المحتفظ بها في المخزن المشترك
+CACHE_INVALIDATION_KEEP = 1000
+
+
+class StateStore:
+    """الواجهة المشتركة لتخزين حالة المستخدمين (التحذيرات وطلبات الموافقة)"""
+
+    def get_warnings(self, user_id):
+        """عدد تحذيرات المستخدم أو None إذا كان مستخدماً جديداً"""
+        raise NotImplementedError
+
+    def set_warnings(self, user_id, value):
+        raise NotImplementedError
+
+    def incr_warnings(self, user_id, amount=1):
+        """زيادة التحذيرات وإرجاع العدد الجديد"""
+        raise NotImplementedError
+
+    def register_new_user(self, user_id, record):
+        """تسجيل مستخدم جديد مع طلب موافقة - يعيد True فقط للعامل الذي سجله أولاً"""
+        raise NotImplementedError
+
+    def get_pending(self, user_id):
+        raise NotImplementedError
+
+    def is_pending(self, user_id):
+        return self.get_pending(user_id) is not None
+
+    def resolve_pending(self, user_id, warnings):
+        """إزالة طلب الموافقة وتعيين التحذيرات بشكل ذري - يعيد بيانات الطلب للمنفذ الأول فقط"""
+        raise NotImplementedError
+
+    def cancel_pending(self, user_id):
+        """إلغاء طلب موافقة لم يصل إلى المدير وحذف المستخدم ليعيد التقديم برسالته التالية"""
+        raise NotImplementedError
+
+    def sweep_pending(self, ttl, remind_after=0, now=None):
+        """معالجة الطلبات القديمة - يعيد (طلبات للتذكير، طلبات منتهية) كقوائم (user_id، البيانات)
+
+        الطلب المنتهي يحذف مع المستخدم حتى يستطيع التقديم من جديد برسالته التالية"""
+        return [], []
+
+    def approved_users(self, after=None, limit=100):
+        """معرفات المستخدمين المقبولين (غير المحظورين وغير المنتظرين) تصاعدياً بعد after - للبث"""
+        raise NotImplementedError
+
+    def count_approved(self):
+        raise NotImplementedError
+
+    def count_users(self):
+        raise NotImplementedError
+
+    def count_pending(self):
+        raise NotImplementedError
+
+    def memory_stats(self):
+        """تقدير الذاكرة المستخدمة لـ /health"""
+        return {}
+
+    def create_digest(self, entries, page_size, keep=20):
+        """حفظ قائمة طلبات انضمام جديدة [(user_id، الاسم، الدردشة)] - يعيد رقمها
+
+        تحذف القوائم الأقدم من آخر keep قائمة."""
+        raise NotImplementedError
+
+    def load_digest(self, digest_id):
+        """بيانات القائمة: {'digest_id', 'page', 'page_size', 'message_id', 'entries': [(user_id، الاسم، الدردشة، الحالة)]}"""
+        raise NotImplementedError
+
+    def update_digest(self, digest_id, page=None, message_id=None):
+        """تعديل صفحة القائمة أو رقم رسالتها - يعيد True إذا تغيرت"""
+        raise NotImplementedError
+
+    def mark_digest_entries(self, user_id, status):
+        """تعيين حالة طلب المستخدم المعلق في كل القوائم - يعيد أرقام القوائم التي تغيرت"""
+        raise NotImplementedError
+
+    def delete_digest(self, digest_id):
+        raise NotImplementedError
+
+    def claim_update(self, keys, ttl):
+        """تسجيل مفاتيح تحديث معالج - يعيد False إذا سجلها عامل آخر من قبل"""
+        return True
+
+    def release_update(self, keys):
+        pass
+
+    def add_cache_invalidation(self, fragment):
+        """تسجيل حذف من ذاكرة الإجابات حتى يطبقه كل العمال ('' تعني مسح الكل) - يعيد رقم التسجيل"""
+        return None
+
+    def cache_invalidations(self, after):
+        """عمليات الحذف المسجلة بعد الرقم المعطى: [(الرقم، النص)]"""
+        return []
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.flush()
+
+
+class _PendingApproval:
+    """طلب موافقة معلق - خانات ثابتة بدل قاموس ونص تاريخ لكل مستخدم"""
+
+    __slots__ = ('user_name', 'chat_id', 'created', 'reminded')
+
+    def __init__(self, user_name, chat_id, created):
+        self.user_name = user_name
+        self.chat_id = chat_id
+        self.created = created
+        self.reminded = False
+
+    def as_dict(self):
+        return {
+            'user_name': self.user_name,
+            'chat_id': self.chat_id,
+            'timestamp': datetime.fromtimestamp(self.created).isoformat()
+        }
+
+
+class MemoryStateStore(StateStore):
+    """تخزين في الذاكرة (عامل واحد فقط - يفقد عند إعادة التشغيل)
+
+    جدول مضغوط بمفاتيح int: التحذيرات أعداد صغيرة مشتركة في بايثون فلا تكلف سوى
+    المفتاح وخانة القاموس، وطلبات الموافقة كائنات __slots__ بنفس كائن المفتاح."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._warnings = {}
+        # مرتبة حسب وقت الإنشاء (ترتيب الإدراج) فيتوقف التنظيف عند أول طلب حديث
+        self._pending = {}
+        # قوائم طلبات الانضمام: الرقم -> {'page', 'page_size', 'message_id', 'entries': [[user_id، الاسم، الدردشة، الحالة]]}
+        self._digests = OrderedDict()
+        self._digest_seq = 0
+
+    def get_warnings(self, user_id):
+        return self._warnings.get(int(user_id))
+
+    def set_warnings(self, user_id, value):
+        with self._lock:
+            self._warnings[int(user_id)] = int(value)
+
+    def incr_warnings(self, user_id, amount=1):
+        with self._lock:
+            value = self._warnings.get(int(user_id), 0) + amount
+            self._warnings[int(user_id)] = value
+            return value
+
+    def register_new_user(self, user_id, record):
+        user_id = int(user_id)
+        with self._lock:
+            if user_id in self._warnings:
+                return False
+            self._warnings[user_id] = 0
+            self._pending[user_id] = _PendingApproval(record.get('user_name', ''), record.get('chat_id'), time.time())
+            return True
+
+    def get_pending(self, user_id):
+        entry = self._pending.get(int(user_id))
+        return entry.as_dict() if entry is not None else None
+
+    def is_pending(self, user_id):
+        return int(user_id) in self._pending
+
+    def resolve_pending(self, user_id, warnings):
+        with self._lock:
+            entry = self._pending.pop(int(user_id), None)
+            if entry is None:
+                return None
+            self._warnings[int(user_id)] = int(warnings)
+            return entry.as_dict()
+
+    def cancel_pending(self, user_id):
+        user_id = int(user_id)
+        with self._lock:
+            if self._pending.pop(user_id, None) is None:
+                return False
+            if not self._warnings.get(user_id):
+                self._warnings.pop(user_id, None)
+            return True
+
+    def sweep_pending(self, ttl, remind_after=0, now=None):
+        now = time.time() if now is None else now
+        reminders, expired = [], []
+        with self._lock:
+            for user_id, entry in self._pending.items():
+                age = now - entry.created
+                if ttl and age >= ttl:
+                    expired.append(user_id)
+                elif remind_after and age >= remind_after:
+                    if not entry.reminded:
+                        entry.reminded = True
+                        reminders.append((user_id, entry.as_dict()))
+                else:
+                    break
+            expired = [(user_id, self._pending.pop(user_id).as_dict()) for user_id in expired]
+            for user_id, _ in expired:
+                if not self._warnings.get(user_id):
+                    self._warnings.pop(user_id, None)
+        return reminders, expired
+
+    def create_digest(self, entries, page_size, keep=20):
+        with self._lock:
+            self._digest_seq += 1
+            self._digests[self._digest_seq] = {
+                'page': 0,
+                'page_size': page_size,
+                'message_id': None,
+                'entries': [[int(user_id), user_name, chat_id, None] for user_id, user_name, chat_id in entries]
+            }
+            while len(self._digests) > keep:
+                self._digests.popitem(last=False)
+            return self._digest_seq
+
+    def load_digest(self, digest_id):
+        with self._lock:
+            record = self._digests.get(digest_id)
+            if record is None:
+                return None
+            return {
+                'digest_id': digest_id,
+                'page': record['page'],
+                'page_size': record['page_size'],
+                'message_id': record['message_id'],
+                'entries': [tuple(entry) for entry in record['entries']]
+            }
+
+    def update_digest(self, digest_id, page=None, message_id=None):
+        with self._lock:
+            record = self._digests.get(digest_id)
+            if record is None:
+                return False
+            changed = False
+            for key, value in (('page', page), ('message_id', message_id)):
+                if value is not None and record[key] != value:
+                    record[key] = value
+                    changed = True
+            return changed
+
+    def mark_digest_entries(self, user_id, status):
+        user_id = int(user_id)
+        changed = []
+        with self._lock:
+            for digest_id, record in self._digests.items():
+                for entry in record['entries']:
+                    if entry[0] == user_id and entry[3] is None:
+                        entry[3] = status
+                        changed.append(digest_id)
+        return changed
+
+    def delete_digest(self, digest_id):
+        with self._lock:
+            self._digests.pop(digest_id, None)
+
+    def approved_users(self, after=None, limit=100):
+        with self._lock:
+            items = list(self._warnings.items())
+        # نسخة المفاتيح فقط تحت القفل - الترشيح خارجه حتى لا تتعطل الكتابة
+        return heapq.nsmallest(limit, (
+            user_id for user_id, warnings in items
+            if warnings < BAN_THRESHOLD and user_id not in self._pending and (after is None or user_id > after)
+        ))
+
+    def count_approved(self):
+        with self._lock:
+            return sum(1 for user_id, warnings in self._warnings.items()
+                       if warnings < BAN_THRESHOLD and user_id not in self._pending)
+
+    def count_users(self):
+        return len(self._warnings)
+
+    def count_pending(self):
+        return len(self._pending)
+
+    def memory_stats(self):
+        with self._lock:
+            users = len(self._warnings)
+            pending = len(self._pending)
+            tables = sys.getsizeof(self._warnings) + sys.getsizeof(self._pending)
+            sample = next(iter(self._pending.values()), None)
+            key = next(iter(self._warnings), 0)
+        # مفتاح int لكل مستخدم (القيم أعداد صغيرة مشتركة) + لكل طلب: الكائن والاسم والدردشة والوقت
+        per_pending = (sys.getsizeof(sample) + sys.getsizeof(sample.user_name) + sys.getsizeof(sample.chat_id)
+                       + sys.getsizeof(sample.created)) if sample is not None else 0
+        total = tables + users * sys.getsizeof(key) + pending * per_pending
+        return {
+            'users': users,
+            'pending': pending,
+            'approx_memory_kb': round(total / 1024, 1),
+            'bytes_per_user': round(total / users, 1) if users else 0
+        }
+
+
+class SQLiteStateStore(StateStore):
+    """تخزين SQLite بوضع WAL - مشترك بين عدة عمال ويبقى بعد إعادة التشغيل"""
+
+    def __init__(self, path='bot_state.db', cache_size=10000, cache_ttl=2.0,
+                 flush_interval=0.5, flush_batch=500, pool_size=16):
+        self.path = path
+        self.cache_size = cache_size
+        self.cache_ttl = cache_ttl
+        self.flush_interval = flush_interval
+        self.flush_batch = flush_batch
+
+        # مجمع اتصالات بدل اتصال لكل خيط: خادم Flask ينشئ خيطاً لكل طلب
+        # وفتح اتصال WAL جديد في كل طلب يضاعف زمن الاستجابة تحت الحمل
+        self._pool = queue.LifoQueue(maxsize=pool_size)
+        self._lock = threading.Lock()
+        # تسلسل الكتابة داخل العملية: منافسة الخيوط على BEGIN IMMEDIATE
+        # تدخل في انتظار busy_timeout التصاعدي وترفع زمن الاستجابة كثيراً
+        self._write_lock = threading.Lock()
+        # ذاكرة قراءة صغيرة: user_id -> (warnings, وقت الانتهاء)
+        self._cache = OrderedDict()
+        # زيادات التحذيرات المؤجلة (كتابة مجمعة)
+        self._deltas = {}
+        # زيادات قيد الكتابة حالياً (حتى لا تختفي من القراءة أثناء الحفظ)
+        self._inflight = {}
+        # حفظ واحد في كل مرة: الاستدعاء أثناء حفظ جار ينتظره ثم يكتب ما تبقى
+        self._flush_lock = threading.Lock()
+        self._flush_event = threading.Event()
+        self._closed = False
+        self._claims = 0
+
+        self._init_schema()
+        self._flusher = threading.Thread(target=self._flush_loop, name='state-flusher', daemon=True)
+        self._flusher.start()
+
+    def _connect(self):
+        # الاتصال يستخدمه خيط واحد في كل مرة عبر المجمع
+        conn = sqlite3.connect(self.path, timeout=10, isolation_level=None, check_same_thread=False)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute('PRAGMA busy_timeout=10000')
+        return conn
+
+    @contextmanager
+    def _connection(self):
+        try:
+            conn = self._pool.get_nowait()
+        except queue.Empty:
+            conn = self._connect()
+        try:
+            yield conn
+        finally:
+            try:
+                self._pool.put_nowait(conn)
+            except queue.Full:
+                conn.close()
+
+    def _read(self, sql, params=()):
+        with self._connection() as conn:
+            return conn.execute(sql, params).fetchone()
+
+    @contextmanager
+    def _transaction(self):
+        with self._write_lock, self._connection() as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                yield conn
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+            conn.execute('COMMIT')
+
+    def _init_schema(self):
+        with self._connection() as conn:
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS users ('
+                'user_id INTEGER PRIMARY KEY, warnings INTEGER NOT NULL DEFAULT 0, updated REAL)'
+            )
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS pending_approvals ('
+                'user_id INTEGER PRIMARY KEY, data TEXT NOT NULL, created REAL)'
+            )
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS processed_updates ('
+                'key TEXT PRIMARY KEY, expires REAL NOT NULL)'
+            )
+            # ترقية القواعد القديمة: علامة التذكير لطلبات الموافقة المتأخرة
+            columns = [row[1] for row in conn.execute('PRAGMA table_info(pending_approvals)')]
+            if 'reminded' not in columns:
+                conn.execute('ALTER TABLE pending_approvals ADD COLUMN reminded INTEGER NOT NULL DEFAULT 0')
+            conn.execute('CREATE INDEX IF NOT EXISTS pending_created ON pending_approvals (created)')
+            # قوائم طلبات الانضمام مشتركة بين العمال حتى يخدم أي عامل أزرارها
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS digests ('
+                'digest_id INTEGER PRIMARY KEY AUTOINCREMENT, page INTEGER NOT NULL DEFAULT 0, '
+                'page_size INTEGER NOT NULL, message_id INTEGER, created REAL)'
+            )
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS digest_entries ('
+                'digest_id INTEGER NOT NULL, position INTEGER NOT NULL, user_id INTEGER NOT NULL, '
+                'user_name TEXT, chat_id INTEGER, status TEXT, PRIMARY KEY (digest_id, position))'
+            )
+            conn.execute('CREATE INDEX IF NOT EXISTS digest_entries_user ON digest_entries (user_id)')
+            # سجل حذف إجابات الذاكرة المؤقتة حتى تصل /cache_forget و /cache_clear لكل العمال
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS cache_invalidations ('
+                'seq INTEGER PRIMARY KEY AUTOINCREMENT, fragment TEXT NOT NULL, created REAL)'
+            )
+
+    # --- الذاكرة المؤقتة ---
+
+    def _cache_get(self, user_id):
+        with self._lock:
+            entry = self._cache.get(user_id)
+            if entry is None:
+                return False, None
+            if entry[1] < time.monotonic():
+                del self._cache[user_id]
+                return False, None
+            self._cache.move_to_end(user_id)
+            return True, entry[0]
+
+    def _cache_put(self, user_id, value):
+        with self._lock:
+            self._cache[user_id] = (value, time.monotonic() + self.cache_ttl)
+            self._cache.move_to_end(user_id)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def _cache_drop(self, user_id):
+        with self._lock:
+            self._cache.pop(user_id, None)
+
+    # --- التحذيرات ---
+
+    def _stored_warnings(self, user_id):
+        found, value = self._cache_get(user_id)
+        if not found:
+            row = self._read('SELECT warnings FROM users WHERE user_id = ?', (user_id,))
+            value = row[0] if row else None
+            self._cache_put(user_id, value)
+        return value
+
+    def get_warnings(self, user_id):
+        user_id = int(user_id)
+        value = self._stored_warnings(user_id)
+        with self._lock:
+            delta = self._deltas.get(user_id, 0) + self._inflight.get(user_id, 0)
+        if value is None:
+            return delta if delta else None
+        return value + delta
+
+    def set_warnings(self, user_id, value):
+        user_id = int(user_id)
+        with self._lock:
+            self._deltas.pop(user_id, None)
+        with self._transaction() as conn:
+            conn.execute(
+                'INSERT INTO users (user_id, warnings, updated) VALUES (?, ?, ?) '
+                'ON CONFLICT(user_id) DO UPDATE SET warnings = excluded.warnings, updated = excluded.updated',
+                (user_id, int(value), time.time())
+            )
+        self._cache_put(user_id, int(value))
+
+    def incr_warnings(self, user_id, amount=1):
+        user_id = int(user_id)
+        current = self._stored_warnings(user_id) or 0
+        with self._lock:
+            delta = self._deltas.get(user_id, 0) + amount
+            self._deltas[user_id] = delta
+            batch_full = len(self._deltas) >= self.flush_batch
+            value = current + delta + self._inflight.get(user_id, 0)
+        # الحظر يكتب فوراً حتى تراه بقية العمال دون انتظار
+        if batch_full or value >= BAN_THRESHOLD:
+            self.flush()
+        return value
+
+    def _flush_loop(self):
+        while not self._closed:
+            self._flush_event.wait(self.flush_interval)
+            self._flush_event.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"❌ خطأ في حفظ التحذيرات: {e}")
+
+    def flush(self):
+        """كتابة الزيادات المؤجلة في معاملة واحدة"""
+        # الحظر الفوري لا يتخطى الحفظ الجاري بل ينتظره حتى تكتب زيادته هو أيضاً
+        with self._flush_lock:
+            with self._lock:
+                if not self._deltas:
+                    return
+                deltas, self._deltas = self._deltas, {}
+                self._inflight = deltas
+            now = time.time()
+            try:
+                with self._transaction() as conn:
+                    conn.executemany(
+                        'INSERT INTO users (user_id, warnings, updated) VALUES (?, ?, ?) '
+                        'ON CONFLICT(user_id) DO UPDATE SET warnings = warnings + excluded.warnings, '
+                        'updated = excluded.updated',
+                        [(user_id, delta, now) for user_id, delta in deltas.items()]
+                    )
+            except Exception:
+                # إعادة الزيادات للمحاولة لاحقاً
+                with self._lock:
+                    for user_id, delta in deltas.items():
+                        self._deltas[user_id] = self._deltas.get(user_id, 0) + delta
+                    self._inflight = {}
+                raise
+            with self._lock:
+                for user_id in deltas:
+                    self._cache.pop(user_id, None)
+                self._inflight = {}
+
+    # --- طلبات الموافقة ---
+
+    def register_new_user(self, user_id, record):
+        user_id = int(user_id)
+        now = time.time()
+        with self._transaction() as conn:
+            inserted = conn.execute(
+                'INSERT OR IGNORE INTO users (user_id, warnings, updated) VALUES (?, 0, ?)',
+                (user_id, now)
+            ).rowcount == 1
+            if inserted:
+                conn.execute(
+                    'INSERT OR REPLACE INTO pending_approvals (user_id, data, created) VALUES (?, ?, ?)',
+                    (user_id, json.dumps(record, ensure_ascii=False), now)
+                )
+        self._cache_drop(user_id)
+        return inserted
+
+    def get_pending(self, user_id):
+        row = self._read('SELECT data FROM pending_approvals WHERE user_id = ?', (int(user_id),))
+        return json.loads(row[0]) if row else None
+
+    def resolve_pending(self, user_id, warnings):
+        user_id = int(user_id)
+        with self._transaction() as conn:
+            row = conn.execute(
+                'SELECT data FROM pending_approvals WHERE user_id = ?', (user_id,)
+            ).fetchone()
+            if row is not None:
+                conn.execute('DELETE FROM pending_approvals WHERE user_id = ?', (user_id,))
+                conn.execute(
+                    'INSERT INTO users (user_id, warnings, updated) VALUES (?, ?, ?) '
+                    'ON CONFLICT(user_id) DO UPDATE SET warnings = excluded.warnings, updated = excluded.updated',
+                    (user_id, int(warnings), time.time())
+                )
+        if row is None:
+            return None
+        with self._lock:
+            self._deltas.pop(user_id, None)
+        self._cache_put(user_id, int(warnings))
+        return json.loads(row[0])
+
+    def cancel_pending(self, user_id):
+        user_id = int(user_id)
+        with self._transaction() as conn:
+            removed = conn.execute('DELETE FROM pending_approvals WHERE user_id = ?', (user_id,)).rowcount == 1
+            if removed:
+                conn.execute('DELETE FROM users WHERE user_id = ? AND warnings = 0', (user_id,))
+        self._cache_drop(user_id)
+        return removed
+
+    def sweep_pending(self, ttl, remind_after=0, now=None):
+        now = time.time() if now is None else now
+        reminders, expired = [], []
+        # داخل معاملة واحدة حتى لا يعالج عاملان نفس الطلب
+        with self._transaction() as conn:
+            if ttl:
+                rows = conn.execute(
+                    'SELECT user_id, data FROM pending_approvals WHERE created <= ?', (now - ttl,)
+                ).fetchall()
+                ids = [(user_id,) for user_id, _ in rows]
+                conn.executemany('DELETE FROM pending_approvals WHERE user_id = ?', ids)
+                conn.executemany('DELETE FROM users WHERE user_id = ? AND warnings = 0', ids)
+                expired = [(user_id, json.loads(data)) for user_id, data in rows]
+            if remind_after:
+                rows = conn.execute(
+                    'SELECT user_id, data FROM pending_approvals WHERE reminded = 0 AND created <= ?',
+                    (now - remind_after,)
+                ).fetchall()
+                conn.executemany('UPDATE pending_approvals SET reminded = 1 WHERE user_id = ?',
+                                 [(user_id,) for user_id, _ in rows])
+                reminders = [(user_id, json.loads(data)) for user_id, data in rows]
+        for user_id, _ in expired:
+            self._cache_drop(user_id)
+        return reminders, expired
+
+    # --- قوائم طلبات الانضمام ---
+
+    def create_digest(self, entries, page_size, keep=20):
+        with self._transaction() as conn:
+            digest_id = conn.execute(
+                'INSERT INTO digests (page_size, created) VALUES (?, ?)', (page_size, time.time())
+            ).lastrowid
+            conn.executemany(
+                'INSERT INTO digest_entries (digest_id, position, user_id, user_name, chat_id) VALUES (?, ?, ?, ?, ?)',
+                [(digest_id, position, int(user_id), user_name, chat_id)
+                 for position, (user_id, user_name, chat_id) in enumerate(entries)]
+            )
+            conn.execute('DELETE FROM digest_entries WHERE digest_id <= ?', (digest_id - keep,))
+            conn.execute('DELETE FROM digests WHERE digest_id <= ?', (digest_id - keep,))
+        return digest_id
+
+    def load_digest(self, digest_id):
+        with self._connection() as conn:
+            row = conn.execute(
+                'SELECT page, page_size, message_id FROM digests WHERE digest_id = ?', (digest_id,)
+            ).fetchone()
+            if row is None:
+                return None
+            entries = conn.execute(
+                'SELECT user_id, user_name, chat_id, status FROM digest_entries '
+                'WHERE digest_id = ? ORDER BY position', (digest_id,)
+            ).fetchall()
+        return {'digest_id': digest_id, 'page': row[0], 'page_size': row[1], 'message_id': row[2],
+                'entries': entries}
+
+    def update_digest(self, digest_id, page=None, message_id=None):
+        changed = False
+        with self._transaction() as conn:
+            for column, value in (('page', page), ('message_id', message_id)):
+                if value is not None:
+                    changed |= conn.execute(
+                        f'UPDATE digests SET {column} = ? WHERE digest_id = ? AND {column} IS NOT ?',
+                        (value, digest_id, value)
+                    ).rowcount == 1
+        return changed
+
+    def mark_digest_entries(self, user_id, status):
+        with self._transaction() as conn:
+            rows = conn.execute(
+                'UPDATE digest_entries SET status = ? WHERE user_id = ? AND status IS NULL RETURNING digest_id',
+                (status, int(user_id))
+            ).fetchall()
+        return [row[0] for row in rows]
+
+    def delete_digest(self, digest_id):
+        with self._transaction() as conn:
+            conn.execute('DELETE FROM digest_entries WHERE digest_id = ?', (digest_id,))
+            conn.execute('DELETE FROM digests WHERE digest_id = ?', (digest_id,))
+
+    # --- منع التكرار ---
+
+    def claim_update(self, keys, ttl):
+        now = time.time()
+        with self._transaction() as conn:
+            fresh = all(
+                conn.execute(
+                    'INSERT INTO processed_updates (key, expires) VALUES (?, ?) '
+                    'ON CONFLICT(key) DO UPDATE SET expires = excluded.expires '
+                    'WHERE processed_updates.expires < ?',
+                    (key, now + ttl, now)
+                ).rowcount == 1
+                for key in keys
+            )
+            # تنظيف دوري للمفاتيح المنتهية
+            self._claims += 1
+            if self._claims % 1000 == 0:
+                conn.execute('DELETE FROM processed_updates WHERE expires < ?', (now,))
+        return fresh
+
+    def release_update(self, keys):
+        with self._transaction() as conn:
+            conn.executemany('DELETE FROM processed_updates WHERE key = ?', [(key,) for key in keys])
+
+    # --- ذاكرة الإجابات ---
+
+    def add_cache_invalidation(self, fragment):
+        with self._transaction() as conn:
+            seq = conn.execute(
+                'INSERT INTO cache_invalidations (fragment, created) VALUES (?, ?)', (fragment or '', time.time())
+            ).lastrowid
+            # يكفي الاحتفاظ بآخر السجلات لأن العمال يقرؤونها عند كل بحث
+            conn.execute('DELETE FROM cache_invalidations WHERE seq <= ?', (seq - CACHE_INVALIDATION_KEEP,))
+        return seq
+
+    def cache_invalidations(self, after):
+        with self._connection() as conn:
+            return conn.execute(
+                'SELECT seq, fragment FROM cache_invalidations WHERE seq > ? ORDER BY seq', (after or 0,)
+            ).fetchall()
+
+    def approved_users(self, after=None, limit=100):
+        self.flush()
+        with self._connection() as conn:
+            rows = conn.execute(
+                'SELECT user_id FROM users WHERE user_id > ? AND warnings < ? '
+                'AND user_id NOT IN (SELECT user_id FROM pending_approvals) ORDER BY user_id LIMIT ?',
+                (after if after is not None else -1, BAN_THRESHOLD, limit)
+            ).fetchall()
+        return [row[0] for row in rows]
+
+    def count_approved(self):
+        self.flush()
+        return self._read(
+            'SELECT COUNT(*) FROM users WHERE warnings < ? '
+            'AND user_id NOT IN (SELECT user_id FROM pending_approvals)', (BAN_THRESHOLD,)
+        )[0]
+
+    def count_users(self):
+        return self._read('SELECT COUNT(*) FROM users')[0]
+
+    def count_pending(self):
+        return self._read('SELECT COUNT(*) FROM pending_approvals')[0]
+
+    def memory_stats(self):
+        # البيانات على القرص - في الذاكرة فقط ذاكرة القراءة والزيادات المؤجلة
+        with self._lock:
+            cached = len(self._cache)
+            deltas = len(self._deltas)
+        page_count = self._read('PRAGMA page_count')[0]
+        page_size = self._read('PRAGMA page_size')[0]
+        return {
+            'cached_users': cached,
+            'pending_deltas': deltas,
+            'db_size_kb': round(page_count * page_size / 1024, 1)
+        }
+
+    def close(self):
+        self._closed = True
+        self._flush_event.set()
+        self.flush()
+
+
+class PendingSweeper:
+    """خيط خلفي دوري: تذكير المدير بطلبات الموافقة المتأخرة وإنهاء الطلبات المنتهية"""
+
+    def __init__(self, store, ttl, remind_after=0, interval=60.0, on_remind=None, on_expire=None):
+        # on_remind(user_id, data) و on_expire(user_id, data) - تستدعى من خيط التنظيف
+        self.store = store
+        self.ttl = ttl
+        self.remind_after = remind_after
+        self.interval = interval
+        self.on_remind = on_remind
+        self.on_expire = on_expire
+        self._stopped = threading.Event()
+        self._thread = None
+        self.reminded = 0
+        self.expired = 0
+        self.last_sweep = None
+
+    def start(self):
+        if self._thread is None and (self.ttl or self.remind_after):
+            self._thread = threading.Thread(target=self._run, name='pending-sweeper', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                self.sweep()
+            except Exception as e:
+                logger.error(f"❌ خطأ في تنظيف طلبات الموافقة: {e}")
+
+    def sweep(self):
+        reminders, expired = self.store.sweep_pending(self.ttl, self.remind_after)
+        for callback, entries in ((self.on_remind, reminders), (self.on_expire, expired)):
+            for user_id, data in entries:
+                if callback is None:
+                    continue
+                try:
+                    callback(user_id, data)
+                except Exception as e:
+                    logger.error(f"❌ خطأ في معالجة طلب الموافقة المتأخر {user_id}: {e}")
+        self.reminded += len(reminders)
+        self.expired += len(expired)
+        self.last_sweep = time.time()
+        if expired:
+            logger.info(f"⌛ انتهت صلاحية {len(expired)} طلب موافقة")
+        return reminders, expired
+
+    def stats(self):
+        return {
+            'ttl': self.ttl,
+            'remind_after': self.remind_after,
+            'reminded': self.reminded,
+            'expired': self.expired,
+            'last_sweep': datetime.fromtimestamp(self.last_sweep).isoformat() if self.last_sweep else None
+        }
+
+
+def create_state_store(backend='sqlite', path='bot_state.db'):
+    """إنشاء مخزن الحالة حسب الإعدادات"""
+    if backend == 'memory':
+        logger.info("💾 تخزين الحالة في الذاكرة")
+        return MemoryStateStore()
+    if backend == 'sqlite':
+        logger.info(f"💾 تخزين الحالة في SQLite: {path}")
+        return SQLiteStateStore(path)
+    raise ValueError(f"نوع تخزين غير معروف: {backend}")
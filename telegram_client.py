@@ -0,0 +1,310 @@
+import asyncio
+import logging
+import random
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+try:
+    import aiohttp
+except ImportError:
+    # مطلوب فقط لوضع الخادم غير المتزامن
+    aiohttp = None
+
+logger = logging.getLogger(__name__)
+
+
+class FloodWait(Exception):
+    """429 لإرسال إلى دردشة طلب المستدعي إعادة جدولته: المجدول يطبق المهلة بدل الانتظار داخل العامل"""
+
+    def __init__(self, method, chat_id, retry_after):
+        super().__init__(f"{method} للدردشة {chat_id}: الانتظار {retry_after} ثانية")
+        self.method = method
+        self.chat_id = chat_id
+        self.retry_after = retry_after
+
+
+class TelegramClient:
+    """عميل Telegram Bot API مع اتصالات دائمة وإعادة محاولة ذكية"""
+
+    def __init__(self, token, base_url='https://api.telegram.org', pool_size=20,
+                 max_retries=3, backoff=0.5, max_backoff=30.0):
+        self.token = token
+        self.base_url = base_url.rstrip('/')
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+        self.pool_size = pool_size
+        self.session = self._create_session()
+
+        self._stats_lock = threading.Lock()
+        self._stats = {}
+        # دالة اختيارية تستدعى عند 429 لطلب موجه إلى دردشة: on_flood(chat_id, retry_after)
+        # مع reschedule=True لا ينتظر العميل المهلة بل يرفع call استثناء FloodWait ليعيد المستدعي الجدولة
+        self.on_flood = None
+        # دالة اختيارية تستدعى مع كل استجابة HTTP: on_response(method, status_code أو 'error')
+        self.on_response = None
+
+    def _create_session(self):
+        # جلسة واحدة مشتركة لإعادة استخدام اتصالات TCP+TLS بدل مصافحة جديدة لكل طلب
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=self.pool_size)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        return session
+
+    def _url(self, method):
+        return f"{self.base_url}/bot{self.token}/{method}"
+
+    def _record(self, method, elapsed, ok, retries):
+        with self._stats_lock:
+            entry = self._stats.get(method)
+            if entry is None:
+                entry = self._stats[method] = {
+                    'calls': 0, 'errors': 0, 'retries': 0,
+                    'total_ms': 0.0, 'max_ms': 0.0
+                }
+            entry['calls'] += 1
+            entry['retries'] += retries
+            if not ok:
+                entry['errors'] += 1
+            elapsed_ms = elapsed * 1000
+            entry['total_ms'] += elapsed_ms
+            if elapsed_ms > entry['max_ms']:
+                entry['max_ms'] = elapsed_ms
+
+    def _delay(self, attempt):
+        delay = min(self.max_backoff, self.backoff * (2 ** attempt))
+        return delay * (0.5 + random.random() / 2)
+
+    def _reschedules(self, payload, reschedule):
+        """هل يتولى المجدول مهلة 429 لهذا الطلب؟ فقط لإرسال إلى دردشة طلب المستدعي إعادة جدولته"""
+        return bool(reschedule and self.on_flood and (payload or {}).get('chat_id') is not None)
+
+    def _retry_delay(self, method, payload, status, body, attempt, reschedule=False):
+        """مهلة الانتظار قبل إعادة المحاولة حسب الاستجابة - None إذا لا فائدة من الإعادة"""
+        if status == 429:
+            delay = self._retry_after(body)
+            logger.warning(f"⏳ Telegram طلب الانتظار {delay} ثانية قبل {method}")
+            chat_id = (payload or {}).get('chat_id')
+            if self.on_flood and chat_id is not None:
+                self.on_flood(chat_id, delay)
+            if self._reschedules(payload, reschedule):
+                # المجدول يؤخر الدردشة ويعيد المهمة - لا نوم داخل العامل
+                return None
+            return min(delay, self.max_backoff)
+        if status >= 500:
+            return self._delay(attempt)
+        # أخطاء 4xx الأخرى لا فائدة من إعادة المحاولة فيها
+        return None
+
+    @staticmethod
+    def _retry_after(body):
+        return float(((body or {}).get('parameters') or {}).get('retry_after', 1))
+
+    def _result(self, method, payload, body, reschedule=False):
+        """نتيجة call: القيمة أو None عند الفشل - FloodWait عند 429 إذا كان المجدول يتولى المهلة"""
+        if body and body.get('ok'):
+            return body.get('result', True)
+        if self._reschedules(payload, reschedule) and body and body.get('error_code') == 429:
+            raise FloodWait(method, (payload or {}).get('chat_id'), self._retry_after(body))
+        return None
+
+    def _finish(self, method, started, body, attempt):
+        ok = bool(body and body.get('ok'))
+        self._record(method, time.monotonic() - started, ok, attempt)
+        if not ok:
+            logger.error(f"❌ فشل استدعاء {method}: {body.get('error_code')} {body.get('description', '')}")
+        return body
+
+    def request(self, method, payload=None, timeout=10, reschedule=False):
+        """استدعاء طريقة من Bot API وإرجاع الاستجابة كاملة (ok, result, error_code, ...)"""
+        started = time.monotonic()
+        attempt = 0
+        body = None
+        while True:
+            try:
+                response = self.session.post(self._url(method), json=payload or {}, timeout=timeout)
+                if self.on_response:
+                    self.on_response(method, response.status_code)
+                try:
+                    body = response.json()
+                except ValueError:
+                    body = {'ok': False, 'error_code': response.status_code, 'description': response.text[:200]}
+
+                if response.status_code == 200 and body.get('ok', True):
+                    break
+                delay = self._retry_delay(method, payload, response.status_code, body, attempt, reschedule)
+                if delay is None:
+                    break
+            except requests.RequestException as e:
+                if self.on_response:
+                    self.on_response(method, 'error')
+                body = {'ok': False, 'error_code': None, 'description': str(e)}
+                delay = self._delay(attempt)
+
+            if attempt >= self.max_retries:
+                break
+            attempt += 1
+            time.sleep(delay)
+
+        return self._finish(method, started, body, attempt)
+
+    def call(self, method, payload=None, timeout=10, reschedule=False):
+        """استدعاء طريقة من Bot API وإرجاع النتيجة أو None عند الفشل"""
+        return self._result(method, payload, self.request(method, payload, timeout, reschedule), reschedule)
+
+    def send_message(self, chat_id, text, parse_mode='HTML', reply_markup=None, reschedule=False):
+        payload = {
+            'chat_id': chat_id,
+            'text': str(text)[:4000],
+            'parse_mode': parse_mode
+        }
+        if reply_markup:
+            payload['reply_markup'] = reply_markup
+        return self.call('sendMessage', payload, reschedule=reschedule)
+
+    def send_messages(self, messages):
+        """إرسال عدة رسائل عبر نفس الاتصال - كل عنصر (chat_id, text) أو قاموس بنفس معاملات send_message"""
+        results = []
+        for message in messages:
+            if isinstance(message, dict):
+                results.append(self.send_message(**message))
+            else:
+                results.append(self.send_message(*message))
+        return results
+
+    def answer_callback_query(self, callback_id, text=None):
+        payload = {'callback_query_id': callback_id}
+        if text:
+            payload['text'] = text
+        return self.call('answerCallbackQuery', payload, timeout=5)
+
+    def edit_message_reply_markup(self, chat_id, message_id, reply_markup=None, reschedule=False):
+        payload = {
+            'chat_id': chat_id,
+            'message_id': message_id,
+            'reply_markup': reply_markup or {'inline_keyboard': []}
+        }
+        return self.call('editMessageReplyMarkup', payload, timeout=5, reschedule=reschedule)
+
+    def edit_message_text(self, chat_id, message_id, text, parse_mode='HTML', reply_markup=None, reschedule=False):
+        payload = {
+            'chat_id': chat_id,
+            'message_id': message_id,
+            'text': str(text)[:4000],
+            'parse_mode': parse_mode
+        }
+        if reply_markup:
+            payload['reply_markup'] = reply_markup
+        return self.call('editMessageText', payload, reschedule=reschedule)
+
+    def set_webhook(self, url, allowed_updates=None, drop_pending_updates=True):
+        payload = {
+            'url': url,
+            'drop_pending_updates': drop_pending_updates,
+            'allowed_updates': allowed_updates or ['message', 'callback_query']
+        }
+        return self.call('setWebhook', payload)
+
+    def delete_webhook(self, drop_pending_updates=False):
+        return self.call('deleteWebhook', {'drop_pending_updates': drop_pending_updates})
+
+    def get_updates(self, offset=None, limit=100, timeout=50, allowed_updates=None):
+        """جلب التحديثات بالاستطلاع الطويل - مهلة HTTP أطول من مهلة Telegram"""
+        payload = {
+            'limit': limit,
+            'timeout': timeout,
+            'allowed_updates': allowed_updates or ['message', 'callback_query']
+        }
+        if offset is not None:
+            payload['offset'] = offset
+        return self.call('getUpdates', payload, timeout=timeout + 10)
+
+    def stats(self):
+        """عدادات زمن الاستجابة لكل طريقة"""
+        with self._stats_lock:
+            result = {}
+            for method, entry in self._stats.items():
+                result[method] = dict(entry)
+                result[method]['avg_ms'] = round(entry['total_ms'] / entry['calls'], 2) if entry['calls'] else 0.0
+                result[method]['total_ms'] = round(entry['total_ms'], 2)
+                result[method]['max_ms'] = round(entry['max_ms'], 2)
+            return result
+
+    def close(self):
+        self.session.close()
+
+
+class AsyncTelegramClient(TelegramClient):
+    """نسخة غير متزامنة عبر aiohttp - نفس الدوال لكنها تعيد coroutines يجب انتظارها"""
+
+    def __init__(self, token, base_url='https://api.telegram.org', pool_size=100, **kwargs):
+        if aiohttp is None:
+            raise RuntimeError("وضع الخادم غير المتزامن يتطلب تثبيت aiohttp")
+        super().__init__(token, base_url, pool_size=pool_size, **kwargs)
+
+    def _create_session(self):
+        # تنشأ الجلسة عند أول طلب داخل حلقة الأحداث
+        return None
+
+    def _http(self):
+        if self.session is None or self.session.closed:
+            connector = aiohttp.TCPConnector(limit=self.pool_size)
+            self.session = aiohttp.ClientSession(connector=connector)
+        return self.session
+
+    async def request(self, method, payload=None, timeout=10, reschedule=False):
+        """استدعاء طريقة من Bot API وإرجاع الاستجابة كاملة (ok, result, error_code, ...)"""
+        session = self._http()
+        started = time.monotonic()
+        attempt = 0
+        body = None
+        while True:
+            try:
+                async with session.post(self._url(method), json=payload or {},
+                                        timeout=aiohttp.ClientTimeout(total=timeout)) as response:
+                    if self.on_response:
+                        self.on_response(method, response.status)
+                    try:
+                        body = await response.json(content_type=None)
+                    except ValueError:
+                        body = {'ok': False, 'error_code': response.status,
+                                'description': (await response.text())[:200]}
+                    status = response.status
+
+                if status == 200 and body.get('ok', True):
+                    break
+                delay = self._retry_delay(method, payload, status, body, attempt, reschedule)
+                if delay is None:
+                    break
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                if self.on_response:
+                    self.on_response(method, 'error')
+                body = {'ok': False, 'error_code': None, 'description': str(e) or type(e).__name__}
+                delay = self._delay(attempt)
+
+            if attempt >= self.max_retries:
+                break
+            attempt += 1
+            await asyncio.sleep(delay)
+
+        return self._finish(method, started, body, attempt)
+
+    async def call(self, method, payload=None, timeout=10, reschedule=False):
+        """استدعاء طريقة من Bot API وإرجاع النتيجة أو None عند الفشل"""
+        return self._result(method, payload, await self.request(method, payload, timeout, reschedule), reschedule)
+
+    async def send_messages(self, messages):
+        """إرسال عدة رسائل بالتوازي عبر نفس الجلسة"""
+        return await asyncio.gather(*(
+            self.send_message(**message) if isinstance(message, dict) else self.send_message(*message)
+            for message in messages
+        ))
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
@@ -0,0 +1,171 @@
+import json
+import logging
+import os
+import re
+import threading
+import time
+import unicodedata
+from collections import namedtuple
+
+logger = logging.getLogger(__name__)
+
+Violation = namedtuple('Violation', ['rule', 'severity', 'match'])
+
+# القواعد الافتراضية عند غياب ملف الإعدادات (مطابقة للقائمة القديمة)
+DEFAULT_CONFIG = {
+    'allowlist': [],
+    'rules': [
+        {'name': 'url_scheme', 'pattern': r'https?://', 'severity': 1, 'triggers': ['://']},
+        {'name': 'www', 'pattern': r'\bwww\.', 'severity': 1, 'triggers': ['www.']},
+        {'name': 'telegram_link', 'pattern': r'\b(?:t|telegram)\.me\b', 'severity': 1, 'triggers': ['.me']},
+        {'name': 'domain', 'pattern': r'\b[a-z0-9][a-z0-9-]*\.(?:com|org|net)\b', 'severity': 1,
+         'triggers': ['.com', '.org', '.net']}
+    ]
+}
+
+# أشكال النقطة البديلة التي تستخدم لتجاوز الفحص
+_DOT_CHARS = '。｡․‧·•٫۔∙⋅'
+_NORMALIZE_MAP = {char: '.' for char in _DOT_CHARS}
+# الأرقام العربية-الهندية والفارسية إلى أرقام لاتينية
+_NORMALIZE_MAP.update({chr(0x0660 + digit): str(digit) for digit in range(10)})
+_NORMALIZE_MAP.update({chr(0x06F0 + digit): str(digit) for digit in range(10)})
+# المحارف غير المرئية والتطويل
+_NORMALIZE_MAP.update({char: '' for char in '\u200b\u200c\u200d\u200e\u200f\u2060\ufeff\u0640'})
+
+# الاستبدال بتعبير نمطي أسرع بكثير من str.translate لأن أغلب الرسائل لا تحتوي هذه المحارف
+_SPECIAL_CHARS = re.compile('[' + re.escape(''.join(_NORMALIZE_MAP)) + ']')
+_SPOKEN_DOT = re.compile(r'\s*(?:\[dot\]|\(dot\)|\bdot\b|نقطة)\s*')
+# النطاقات التي يعاد وصلها إذا فصلت مسافات عن النقطة ("google . com")
+_HOST_TLDS = ('com', 'net', 'org', 'me', 'info', 'io', 'co', 'biz', 'xyz', 'ly', 'app', 'dev', 'sa', 'ae')
+# تطابق حساسة لحالة الأحرف قبل التحويل إلى أحرف صغيرة: اسم مضيف صغير غير مسبوق بحرف أو فاصلة عليا أو نقطة
+# ونطاق معروف صغير غير متبوع بحرف أو شرطة - فلا تدمج الجمل ("amount. Net" و "can't. me" و "2. Com-pany")
+# ولا الاختصارات ("e.g. net" و "i.e. net")
+_SPACED_DOT = re.compile(
+    r"(?<![\w'’.])([a-z0-9][a-z0-9-]*)\s*\.\s*(" + '|'.join(_HOST_TLDS) + r")(?![\w-])"
+)
+
+
+def _join_host(match):
+    label = match.group(1)
+    # أرقام فقط (رقم بند أو فقرة) ليست اسم مضيف، ولا حرف واحد ملتصق بالنقطة (بند "a. net")
+    # بخلاف "t . me" حيث المسافة قبل النقطة محاولة تجاوز
+    if label.isdigit() or (len(label) == 1 and match.string[match.end(1)] == '.'):
+        return match.group()
+    return f"{label}.{match.group(2)}"
+
+
+def normalize_text(text):
+    """توحيد النص قبل الفحص: NFKC، أحرف صغيرة، النقاط البديلة، الأرقام والمسافات حول النقاط"""
+    text = unicodedata.normalize('NFKC', str(text))
+    text = _SPECIAL_CHARS.sub(lambda match: _NORMALIZE_MAP[match.group()], text)
+    # وصل المسافات حول النقطة قبل التحويل إلى أحرف صغيرة: الحرف الكبير بعد النقطة بداية جملة
+    if ' .' in text or '. ' in text:
+        text = _SPACED_DOT.sub(_join_host, text)
+    text = text.lower()
+    if 'dot' in text or 'نقطة' in text:
+        text = _SPOKEN_DOT.sub('.', text)
+    return text
+
+
+class ViolationEngine:
+    """محرك كشف المخالفات: قواعد من ملف إعدادات مجمعة في تعبير نمطي واحد"""
+
+    def __init__(self, path=None, reload_interval=2.0):
+        self.path = path
+        self.reload_interval = reload_interval
+        self._lock = threading.Lock()
+        self._mtime = None
+        self._checked = 0.0
+        self._compile(DEFAULT_CONFIG)
+        if path:
+            self.reload(force=True)
+
+    def _compile(self, config):
+        rules = []
+        parts = []
+        triggers = set()
+        for index, rule in enumerate(config.get('rules', [])):
+            pattern = rule['pattern']
+            if rule.get('literal'):
+                pattern = re.escape(pattern)
+            # التحقق من صحة كل قاعدة على حدة لإظهار اسمها عند الخطأ
+            re.compile(pattern)
+            rules.append((rule.get('name', f'rule_{index}'), int(rule.get('severity', 1))))
+            parts.append(f'(?P<r{index}>{pattern})')
+            # نصوص لا تتطابق القاعدة بدونها - قاعدة بلا triggers تلغي الفحص المسبق
+            if triggers is not None and rule.get('triggers'):
+                triggers.update(str(item).lower() for item in rule['triggers'])
+            else:
+                triggers = None
+
+        allowlist = [normalize_text(item) for item in config.get('allowlist', []) if item]
+        combined = re.compile('|'.join(parts)) if parts else None
+        allowed = None
+        if allowlist:
+            # العنصر المسموح يشمل البروتوكول و www والمسار التابع له
+            hosts = '|'.join(re.escape(item) for item in allowlist)
+            allowed = re.compile(rf'(?:https?://)?(?:www\.)?(?:{hosts})(?![\w.-]*\w)(?:/\S*)?')
+
+        prefilter = None
+        if triggers:
+            prefilter = re.compile('|'.join(re.escape(item) for item in sorted(triggers)))
+
+        # استبدال ذري حتى لا يرى الفحص الجاري حالة نصف محدثة
+        self._state = (combined, rules, allowed, prefilter)
+
+    def reload(self, force=False):
+        """إعادة تحميل القواعد إذا تغير الملف - يحتفظ بالقواعد الحالية عند وجود خطأ"""
+        if not self.path:
+            return False
+        with self._lock:
+            self._checked = time.monotonic()
+            try:
+                mtime = os.path.getmtime(self.path)
+            except OSError:
+                if force:
+                    logger.warning(f"⚠️ ملف قواعد المخالفات غير موجود: {self.path} - استخدام القواعد الافتراضية")
+                return False
+            if not force and mtime == self._mtime:
+                return False
+            try:
+                with open(self.path, encoding='utf-8') as handle:
+                    self._compile(json.load(handle))
+                self._mtime = mtime
+                logger.info(f"✅ تم تحميل قواعد المخالفات من {self.path}")
+                return True
+            except (ValueError, KeyError, re.error) as e:
+                self._mtime = mtime
+                logger.error(f"❌ خطأ في ملف قواعد المخالفات: {e}")
+                return False
+
+    def _maybe_reload(self):
+        if self.path and time.monotonic() - self._checked >= self.reload_interval:
+            self.reload()
+
+    def scan(self, text):
+        """جميع المخالفات في النص"""
+        if not text:
+            return []
+        self._maybe_reload()
+        combined, rules, allowed, prefilter = self._state
+        if combined is None:
+            return []
+
+        normalized = normalize_text(text)
+        # فحص مسبق سريع: أغلب الرسائل لا تحتوي أي نص محفز فلا حاجة للتعبير المجمع
+        if prefilter is not None and not prefilter.search(normalized):
+            return []
+        if allowed is not None:
+            normalized = allowed.sub(' ', normalized)
+        found = []
+        for match in combined.finditer(normalized):
+            name, severity = rules[int(match.lastgroup[1:])]
+            found.append(Violation(name, severity, match.group()))
+        return found
+
+    def detect(self, text):
+        """أشد مخالفة في النص أو None"""
+        found = self.scan(text)
+        if not found:
+            return None
+        return max(found, key=lambda violation: violation.severity)